@@ -20,7 +20,7 @@ apt -y install mesa-common-dev libgl1-mesa-dev libglu1-mesa-dev
 apt -y install python3-dev python3-numpy python3-matplotlib python3-opencv python3-scipy python3-pygame python3-pip
 
 # Install python pkgs for MBot OLED
-apt -y install python3-qrcode python3-luma.oled
+apt -y install python3-qrcode python3-luma.oled python3-dbus python3-gi
 
 
 # Clone pico-sdk
@@ -9,6 +9,21 @@ SERVICE_LIST="mbot-start-network
 # Copy the scripts we need for the services.
 sudo cp mbot_ros_oled_display.py /usr/local/etc/
 sudo chmod +x /usr/local/etc/mbot_ros_oled_display.py
+# Helper modules shared with the LCM OLED daemon.
+sudo cp ../../services/mbot_sysinfo.py /usr/local/etc/
+sudo cp ../../services/mbot_sampler.py /usr/local/etc/
+sudo cp ../../services/mbot_scheduler.py /usr/local/etc/
+sudo cp ../../services/mbot_oled_device.py /usr/local/etc/
+sudo cp ../../services/mbot_oled_render.py /usr/local/etc/
+sudo cp ../../services/mbot_oled_layout.py /usr/local/etc/
+sudo cp ../../services/mbot_metrics.py /usr/local/etc/
+sudo cp ../../services/mbot_logging.py /usr/local/etc/
+sudo cp ../../services/mbot_replay.py /usr/local/etc/
+sudo cp ../../services/mbot_telemetry.py /usr/local/etc/
+sudo cp ../../services/mbot_netlink.py /usr/local/etc/
+sudo cp ../../services/mbot_power.py /usr/local/etc/
+sudo cp ../../services/mbot_wifi_connect.py /usr/local/etc/
+sudo cp ../../services/mbot_config.py /usr/local/etc/
 sudo cp mbot_start_networking.sh /usr/local/etc/
 sudo chmod +x /usr/local/etc/mbot_start_networking.sh
 
@@ -1,123 +1,225 @@
 #!/usr/bin/python3
 import os
-import re
 import time
+import errno
 import logging
 import subprocess
-import threading
-from luma.core.interface.serial import i2c
-from luma.core.render import canvas
-from luma.oled.device import ssd1306
+from functools import partial
 from PIL import ImageFont
-from logging.handlers import RotatingFileHandler
-import signal
-
-import rclpy
-from rclpy.node import Node
-from rclpy.qos import QoSProfile, QoSReliabilityPolicy
-
-# This is for the battery subscription.
-# To be compatible with the firmware, best effort is used.
-qos_profile = QoSProfile(
-    depth=10,
-    reliability=QoSReliabilityPolicy.BEST_EFFORT
-)
-
-# Attempt to import the custom BatteryADC message. If it is unavailable we will
-# continue to run the application, but omit the battery-level subscription.
-try:
-    from mbot_interfaces.msg import BatteryADC
-    BATTERY_SUPPORT = True
-except ImportError as e:
-    BatteryADC = None  # type: ignore  # Placeholder so the name is defined
-    BATTERY_SUPPORT = False
+
+import mbot_sysinfo
+from mbot_oled_device import create_device
+from mbot_oled_layout import LayoutPainter
+from mbot_sampler import SnapshotCache, Sampler
+from mbot_scheduler import ScreenScheduler
+from mbot_metrics import METRICS, METRICS_FILE, MetricsWriter
+from mbot_logging import setup_logging
+from mbot_telemetry import HEALTH_TOPIC, encode_health, health_message
+from mbot_netlink import AddressMonitor
+from mbot_power import PowerPolicy
+from mbot_config import Identity
+from mbot_replay import REPLAY_TOPIC, Recorder, ReplayClock, apply_record, decode_record
 
 # Define constants
+# Ubuntu 24 optimized fonts for OLED displays
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
 SCREEN_CHANGE_DELAY = 3
+METRICS_INTERVAL = 10  # How often the metrics file is rewritten, in seconds
+HEALTH_RATE = 1  # Health messages published per second, 0 to disable
+IDLE_DIM_AFTER = 600  # Seconds without events before the display dims and slows down, 0 to disable
+IDLE_OFF_AFTER = 0  # Seconds without events before the display switches off, 0 to disable
+PROBE_THREADS = 2  # Executor threads for the probes, on top of the one that draws
 DIS_WIDTH = 128  # OLED display width, in pixels
 DIS_HEIGHT = 64  # OLED display height, in pixels
 
-# Setup logging
-log_file = "/var/log/mbot/mbot_ros_oled_display.log"
-os.makedirs(os.path.dirname(log_file), exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3),
-        logging.StreamHandler()
-    ]
-)
+# How long each screen is shown, in seconds
+SCREEN_DURATIONS = {
+    "wifi": SCREEN_CHANGE_DELAY,
+    "battery": SCREEN_CHANGE_DELAY,
+    "resources": SCREEN_CHANGE_DELAY,
+    "top": SCREEN_CHANGE_DELAY,
+}
+
 
 class MBotOLED:
-    def __init__(self):
-        # Initialize OLED device and fonts
+    def __init__(self, backend="i2c", health_rate=HEALTH_RATE, dim_after=IDLE_DIM_AFTER, off_after=IDLE_OFF_AFTER,
+                 record=None, replay=False):
+        # Initialize OLED device and the font the splash screen needs
         self.device = None
         self.font = None
         self.font_small = None
+        self.last_frame_key = None
         
         try:
             logging.info("Attempting to initialize OLED device...")
-            self.device = ssd1306(i2c(port=1, address=0x3C))
+            self.device = create_device(backend)
             logging.info("OLED device initialized successfully")
         except Exception as e:
             logging.error(f"Failed to initialize OLED device: {e}")
-            
+
+        self.font = self.load_font(14)
+        # Draws the screens in mbot_oled_layout.py, fonts are added as they are loaded
+        self.painter = LayoutPainter(self.device, {"regular": self.font})
+
+        # The hostname is read once and watched once main_loop starts
+        self.identity = Identity(on_change=self.identity_changed)
+
+        # The IP is tracked from kernel notifications once main_loop starts
+        self.address_monitor = AddressMonitor(on_change=self.address_changed)
+
+        # Show the hostname and IP before anything slow is loaded
+        self.ip_str = self.get_ip()
+        self.show_splash()
+
+        self.font_small = self.load_font(10)
+        self.painter.fonts["small"] = self.font_small
+
+        # Text is drawn from glyphs rasterized once instead of on every frame
+        if self.device and self.font_small:
+            self.painter.frame = self.create_frame_buffer()
+
+        # Set up display variables
+        self.battery_voltage = -1
+
+        # The inputs can be recorded to a file and replayed, see mbot_replay.py.
+        # While replaying, the clock follows the recording time.
+        self.replay = replay
+        self.clock = ReplayClock() if replay else time.monotonic
+        self.recorder = Recorder(record, "ros2", self.clock) if record else None
+
+        # Probes run on a background sampler; the screens only read the cache
+        self.cache = SnapshotCache()
+        self.sampler = Sampler(self.cache, on_sample=self.recorder.probe if self.recorder else None)
+        # Keeps the process table between samples of the top processes screen
+        self.process_top = mbot_sysinfo.ProcessTop()
+
+        # The display dims and slows down when nothing happens for a while
+        self.power = PowerPolicy(self.device, dim_after, off_after) if self.device else None
+
+        # Screens rotate on a deadline scheduler
+        self.scheduler = ScreenScheduler(on_rotation=self.start_rotation, power=self.power)
+
+        # Track the last received message time
+        self.last_message_time = self.clock()
+        self.message_timeout = 10  # Set a threshold in seconds to detect message timeout
+
+        self.battery_support = False
+        self.ros_node = None
+        self.executor = None
+        self.health_rate = health_rate
+        self.health_publisher = None
+        self.setup_ros()
+
+    def load_font(self, size):
         try:
-            logging.info("Attempting to load fonts...")
-            # Ubuntu 24 optimized fonts for OLED displays
-            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
-            
-            self.font = ImageFont.truetype(font_path, 14)
-            self.font_small = ImageFont.truetype(font_path, 10)
-            logging.info(f"Fonts loaded successfully from: {font_path}")
-                
+            font = ImageFont.truetype(FONT_PATH, size)
+            logging.info(f"Font size {size} loaded successfully from: {FONT_PATH}")
+            return font
         except Exception as e:
             logging.error(f"Failed to load fonts: {e}")
             logging.info("Attempting to use default font...")
             try:
-                self.font = ImageFont.load_default()
-                self.font_small = ImageFont.load_default()
-                logging.info("Default fonts loaded successfully")
+                font = ImageFont.load_default()
+                logging.info("Default font loaded successfully")
+                return font
             except Exception as e2:
                 logging.error(f"Failed to load default fonts: {e2}")
+                return None
 
-        # Set up display variables
-        self.battery_voltage = -1
-        self.ip_str = "IP Not Found"
+    def create_frame_buffer(self):
+        # numpy is imported here, after the splash, as it is slow to load
+        try:
+            from mbot_oled_render import FrameBuffer
+        except ImportError:
+            logging.warning("numpy not installed. The screens are drawn with PIL.")
+            return None
+        frame = FrameBuffer(DIS_WIDTH, DIS_HEIGHT)
+        for font in self.painter.fonts.values():
+            frame.add_font(font)
+        return frame
+
+    def show_splash(self):
+        if self.font:
+            self.show("splash", hostname=self.get_hostname(), ip=self.ip_str)
+        try:
+            logging.info(f"First frame drawn {mbot_sysinfo.get_process_age():.2f} s after process start")
+        except (OSError, ValueError, IndexError) as e:
+            logging.error(f"Failed to get process start time: {e}")
 
-        # Track the last received message time
-        self.last_message_time = time.time()
-        self.message_timeout = 10  # Set a threshold in seconds to detect message timeout
+    def setup_ros(self):
+        # rclpy and the message packages are imported here, after the splash,
+        # as loading them takes seconds on a cold boot.
+        try:
+            import rclpy
+            from rclpy.node import Node
+            from rclpy.executors import MultiThreadedExecutor
+            from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+            from rclpy.qos import QoSProfile, QoSReliabilityPolicy
+            from std_msgs.msg import String
+        except ImportError as e:
+            logging.error(f"Failed to import rclpy: {e}")
+            return
 
-        # Initialize ROS 2 subscription in a background thread
+        # Attempt to import the custom BatteryADC message. If it is unavailable we will
+        # continue to run the application, but omit the battery-level subscription.
+        try:
+            from mbot_interfaces.msg import BatteryADC
+            self.battery_support = True
+        except ImportError:
+            BatteryADC = None
+            self.battery_support = False
+
+        # This is for the battery subscription.
+        # To be compatible with the firmware, best effort is used.
+        qos_profile = QoSProfile(
+            depth=10,
+            reliability=QoSReliabilityPolicy.BEST_EFFORT
+        )
+
+        # Everything runs as callbacks on one executor. rclpy.init installs
+        # the SIGINT and SIGTERM handlers that make spin() return.
         try:
             rclpy.init(args=None)
             self.ros_node = Node('mbot_oled_display')
+            # Drawing, the battery value and the health message only change
+            # in this group, so its callbacks never run concurrently.
+            self.display_group = MutuallyExclusiveCallbackGroup()
+            # Probes may block (nmcli, procfs). Each group runs one at a time,
+            # so they never take more than PROBE_THREADS executor threads and
+            # the display always has one.
+            self.probe_groups = [MutuallyExclusiveCallbackGroup() for _ in range(PROBE_THREADS)]
+            self.executor = MultiThreadedExecutor(num_threads=1 + PROBE_THREADS)
+            self.executor.add_node(self.ros_node)
             # Subscribe to the battery topic published by the firmware
-            if BATTERY_SUPPORT:
+            if self.battery_support:
                 self.ros_node.create_subscription(
                     BatteryADC,
                     'battery_adc',  # Topic name must match the publisher in mbot firmware
                     self.battery_info_callback,
-                    qos_profile
+                    qos_profile,
+                    callback_group=self.display_group
                 )
                 logging.info("Battery subscription created successfully.")
             else:
                 logging.info("BatteryADC message not available; skipping battery subscription.")
 
-            # Inform the user if battery support is unavailable
-            if not BATTERY_SUPPORT:
-                logging.warning("BatteryADC message not found. Battery display will be disabled, but the rest of the UI will function.")
+            # The IP, probe outputs and clock while replaying, see mbot_replay.py
+            if self.replay:
+                self.ros_node.create_subscription(String, REPLAY_TOPIC, self.replay_message, 10,
+                                                  callback_group=self.display_group)
+                logging.info(f"Replay mode, waiting for records on {REPLAY_TOPIC}")
 
-            # Spin the ROS node in a daemon thread so our main loop can run concurrently
-            self.ros_spin_thread = threading.Thread(target=rclpy.spin, args=(self.ros_node,), daemon=True)
-            self.ros_spin_thread.start()
-            logging.info("ROS 2 node started")
+            # Other processes read the sampled values from here instead of probing themselves
+            if self.health_rate > 0:
+                self.health_msg_type = String
+                self.health_publisher = self.ros_node.create_publisher(String, HEALTH_TOPIC, 10)
+                self.ros_node.create_timer(1.0 / self.health_rate, self.publish_health,
+                                           callback_group=self.display_group)
 
-            # Simple signal handler for fast quit
-            signal.signal(signal.SIGTERM, self._fast_quit)
-            signal.signal(signal.SIGINT, self._fast_quit)
+            # Inform the user if battery support is unavailable
+            if not self.battery_support:
+                logging.warning("BatteryADC message not found. Battery display will be disabled, but the rest of the UI will function.")
+            logging.info("ROS 2 node created")
         except Exception as e:
             logging.error(f"Failed to initialize ROS 2 subscription: {e}")
             # Make sure rclpy is shutdown cleanly if initialization partially succeeded
@@ -126,137 +228,191 @@ class MBotOLED:
             except Exception:
                 pass
             self.ros_node = None
-
-    def draw(self, draw_func):
+            self.executor = None
+
+    def start_sampler(self):
+        # Each value is refreshed at its own rate (seconds)
+        self.sampler.add("uptime", self.get_uptime, 15)
+        self.sampler.add("ssid", self.get_connected_ssid, 10)
+        if not self.address_monitor.running:
+            self.sampler.add("ip", self.get_ip, 5)
+        self.sampler.add("mem", self.get_mem_free, 5)
+        self.sampler.add("load_avg", self.get_load_avg, 2)
+        self.sampler.add("top", self.get_top_processes, 2)
+        if self.executor is None:
+            self.sampler.start()
+            return
+        # Probes run as timers on the executor, spread over the probe groups.
+        # Each is sampled once right away so the first screens have values.
+        for i, (key, interval) in enumerate(self.sampler.intervals().items()):
+            self.sampler.sample(key)
+            self.ros_node.create_timer(interval, partial(self.sampler.sample, key),
+                                       callback_group=self.probe_groups[i % len(self.probe_groups)])
+
+    def show(self, layout, **values):
+        # Draws a layout with its fields set to values. A frame showing the
+        # same as the last one is not drawn again.
         if self.device:
-            with canvas(self.device) as draw:
-                draw_func(draw)
+            if (layout, values) == self.last_frame_key:
+                METRICS.count("frames_unchanged")
+                return
+            self.last_frame_key = (layout, values)
+            self.painter.paint(layout, values)
 
     # Information Fetching Methods
     def get_hostname(self):
-        try:
-            return subprocess.check_output(["hostname"]).decode().strip()
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to get hostname: {e}")
-            return "Error"
+        return self.identity.hostname()
 
     def get_uptime(self):
         try:
-            uptime_output = subprocess.check_output(["uptime", "-p"]).decode().strip()
-            pattern = r'up (\d+) hour[s]*, (\d+) minute[s]*|up (\d+) minute[s]*'
-            match = re.match(pattern, uptime_output)
-
-            if match:
-                hours, minutes, minutes_only = match.groups()
-                return f'{minutes_only}m' if minutes_only else f'{hours}h{minutes}m'
-            else:
-                return uptime_output[3:]
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_uptime()
+        except (OSError, ValueError, IndexError) as e:
             logging.error(f"Failed to get uptime: {e}")
             return "Error"
 
     def get_connected_ssid(self):
         try:
-            # Try iwgetid first (if available)
-            return subprocess.check_output(["/usr/sbin/iwgetid", "-r"]).decode().strip() or "N/A"
-        except subprocess.CalledProcessError:
+            # Read the ESSID through the wireless extensions ioctl first
+            return mbot_sysinfo.get_connected_ssid() or "N/A"
+        except OSError:
             try:
                 # Fallback to nmcli (NetworkManager command line)
-                output = subprocess.check_output(["nmcli", "-t", "-f", "active,ssid", "dev", "wifi"]).decode()
+                with METRICS.timer("subprocess.nmcli"):
+                    output = subprocess.check_output(["nmcli", "-t", "-f", "active,ssid", "dev", "wifi"]).decode()
                 for line in output.strip().split('\n'):
                     if line.startswith('yes:'):
                         return line.split(':', 1)[1] or "N/A"
                 return "N/A"
-            except subprocess.CalledProcessError as e:
+            except (subprocess.CalledProcessError, OSError) as e:
                 logging.error(f"Failed to get connected SSID: {e}")
                 return "Error"
 
     def get_mem_free(self):
         try:
-            mem_output = subprocess.check_output("free -m | awk 'NR==2{printf \"%.2f%%\", $3*100/$2 }'", shell=True).decode().strip()
-            return mem_output
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_mem_used_percent()
+        except (OSError, ValueError, KeyError) as e:
             logging.error(f"Failed to get memory usage: {e}")
             return "Error"
 
     def get_load_avg(self):
         try:
-            load_output = subprocess.check_output(["top", "-bn1"]).decode()
-            return re.search(r'load average: (.*)', load_output).group(1)
-        except (subprocess.CalledProcessError, AttributeError) as e:
+            return mbot_sysinfo.get_load_avg()
+        except (OSError, ValueError) as e:
             logging.error(f"Failed to get load average: {e}")
             return "Error"
 
+    def get_top_processes(self):
+        try:
+            return [(name, round(cpu), round(rss)) for name, cpu, rss in self.process_top.sample()]
+        except (OSError, ValueError, IndexError) as e:
+            logging.error(f"Failed to get top processes: {e}")
+            return []
+
     def get_ip(self):
+        # Try multiple network interface names common in Ubuntu
+        interfaces = ["wlan0", "wlp0s20f3", "wifi0"]
+        for interface in interfaces:
+            if self.address_monitor.running:
+                address = self.address_monitor.get_address(interface)
+                if address:
+                    return address
+                continue
+            try:
+                return mbot_sysinfo.get_interface_ip(interface)
+            except OSError:
+                continue
+
+        # If no specific interface found, use the source address of the default route
         try:
-            # Try multiple network interface names common in Ubuntu
-            interfaces = ["wlan0", "wlp0s20f3", "wifi0"]
-            for interface in interfaces:
-                try:
-                    command_output = subprocess.check_output(["ip", "addr", "show", interface]).decode()
-                    ip_match = re.search(r'inet ([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)', command_output)
-                    if ip_match:
-                        self.ip_str = ip_match.group(1)
-                        return
-                except subprocess.CalledProcessError:
-                    continue
-            
-            # If no specific interface found, try to get any wireless interface IP
-            command_output = subprocess.check_output(["ip", "route", "get", "8.8.8.8"]).decode()
-            ip_match = re.search(r'src ([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)', command_output)
-            self.ip_str = ip_match.group(1) if ip_match else "IP Not Found"
-            
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_default_route_ip()
+        except OSError as e:
+            if e.errno in (errno.ENETUNREACH, errno.EADDRNOTAVAIL):
+                return "IP Not Found"
             logging.error(f"Failed to get IP: {e}")
-            self.ip_str = "Error"
+            return "Error"
+
+    def address_changed(self, ifname):
+        # Called by the address monitor, a new IP is shown right away
+        self.ip_changed(self.get_ip())
+
+    def ip_changed(self, ip_str):
+        # Also called with the recorded addresses while replaying
+        if self.recorder:
+            self.recorder.ip(ip_str)
+        # No expiry, the value is only replaced on the next change
+        self.cache.set("ip", ip_str, float("inf"))
+        if ip_str != self.ip_str:
+            logging.info(f"IP changed to {ip_str}")
+            self.ip_str = ip_str
+            if self.power:
+                self.power.wake("IP change")
+            self.scheduler.redraw()
+
+    def identity_changed(self, name):
+        # Called by the identity watcher when /etc/hostname changed
+        if name == "hostname":
+            hostname = self.get_hostname()
+            logging.info(f"Hostname changed to {hostname}")
+            self.set_hostname(hostname)
+            if self.power:
+                self.power.wake("hostname change")
+            self.scheduler.redraw()
+
+    def set_hostname(self, hostname):
+        # No expiry, the value is only replaced when /etc/hostname changes
+        self.cache.set("hostname", hostname, float("inf"))
+        if self.recorder:
+            self.recorder.probe("hostname", hostname)
+
+    def replay_message(self, msg):
+        # Called with the records mbot_replay.py sends
+        try:
+            apply_record(self, decode_record(msg.data))
+        except Exception as e:
+            logging.error(f"Failed to apply replayed record: {e}")
+
+    def get_health(self):
+        return health_message(self.cache.snapshot(), self.battery_voltage)
+
+    def publish_health(self):
+        try:
+            data = encode_health(self.get_health())
+            self.health_publisher.publish(self.health_msg_type(data=data.decode()))
+            METRICS.count("telemetry.published")
+        except Exception as e:
+            logging.error(f"Failed to publish health message: {e}")
 
     def battery_info_callback(self, msg):
+        METRICS.count("callback.battery")
+        if self.recorder:
+            self.recorder.battery(msg.volts)
         self.battery_voltage = msg.volts[3]
-        self.last_message_time = time.time()
+        self.last_message_time = self.clock()
 
     # Screen Display Methods
     def display_wifi_info(self):
-        ssid = self.get_connected_ssid()
-        hostname = self.get_hostname()
-        uptime = self.get_uptime()
-
-        def draw_wifi(draw):
-            draw.text((1, 1), hostname, font=self.font, fill="white")
-            draw.text((1, 17), f"SSID: {ssid}", font=self.font, fill="white")
-            draw.text((1, 33), f"Uptime: {uptime}", font=self.font_small, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-        self.draw(draw_wifi)
+        self.show("wifi", hostname=self.cache.get("hostname", "..."), ssid=self.cache.get("ssid", "..."),
+                  uptime=self.cache.get("uptime", "..."), ip=self.ip_str)
 
     def display_resources(self):
-        mem_str = self.get_mem_free()
-        load_avg_str = self.get_load_avg()
+        self.show("resources", load_avg=self.cache.get("load_avg", "..."), mem=self.cache.get("mem", "..."),
+                  ip=self.ip_str)
 
-        def draw_resources(draw):
-            draw.text((1, 1), "Load Average: ", font=self.font_small, fill="white")
-            draw.text((20, 17), load_avg_str, font=self.font_small, fill="white")
-            draw.text((1, 33), f"RAM Used: {mem_str}", font=self.font_small, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-        self.draw(draw_resources)
+    def display_top_processes(self):
+        rows = {f"row{row}": process for row, process in enumerate(self.cache.get("top", []))}
+        self.show("top", ip=self.ip_str, **rows)
 
     def display_battery_info(self):
-        if BATTERY_SUPPORT:
+        if self.battery_support:
             self.check_message_timeout()
-        
-        def draw_battery(draw):
-            if self.battery_voltage == -1:
-                draw.text((1, 1), "Battery Info", font=self.font, fill="white")
-                draw.text((1, 24), f"Voltage: ???", font=self.font, fill="white")
-            else:
-                draw.text((1, 1), "Battery Info", font=self.font, fill="white")
-                draw.text((1, 24), f"Voltage: {self.battery_voltage:.2f} V", font=self.font, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-        self.draw(draw_battery)
+
+        if self.battery_voltage == -1:
+            self.show("battery_unknown", ip=self.ip_str)
+        else:
+            self.show("battery", voltage=round(self.battery_voltage, 2), ip=self.ip_str)
 
     def check_message_timeout(self):
-        current_time = time.time()
+        current_time = self.clock()
         if current_time - self.last_message_time > self.message_timeout:
             logging.debug("Battery topic timeout – showing ??? on display.")
             self.battery_voltage = -1
@@ -266,32 +422,84 @@ class MBotOLED:
             logging.error("Initialization failed. Exiting application.")
             return
 
-        while True:
-            try:
-                self.get_ip()
-
-                self.display_wifi_info()
-                time.sleep(SCREEN_CHANGE_DELAY)
-                self.display_battery_info()
-                time.sleep(SCREEN_CHANGE_DELAY)
-                self.display_resources()
-                time.sleep(SCREEN_CHANGE_DELAY)
-
-            except Exception as e:
-                logging.error(f"Unhandled exception during main loop: {e}")
-                time.sleep(5)
-                continue
+        METRICS.add_source("display", self.device.stats)
+        METRICS.add_source("power", self.power.stats)
+        MetricsWriter(path=os.environ.get("MBOT_OLED_METRICS", METRICS_FILE), interval=METRICS_INTERVAL).start()
+
+        self.identity.start()
+        self.set_hostname(self.get_hostname())
+        if self.replay:
+            # The IP and probe outputs come from mbot_replay.py
+            if self.executor is None:
+                logging.error("Replay mode needs ROS 2, nothing will be replayed.")
+        else:
+            if self.address_monitor.start():
+                self.address_changed("wlan0")
+            self.start_sampler()
+        self.add_screens()
+        if self.executor is None:
+            # Without ROS 2 the scheduler runs its own loop
+            self.scheduler.run()
+            return
 
-    # ------------------------- Fast-Quit Signal Handler -------------------------
-    def _fast_quit(self, signum, frame):
-        """Terminate the process quickly on SIGTERM/SIGINT while letting ROS shutdown."""
-        logging.info(f"Received signal {signum}; shutting down OLED service immediately.")
+        self.start_scheduler()
+        from rclpy.executors import ExternalShutdownException
         try:
-            rclpy.shutdown()
-        except Exception:
+            self.executor.spin()
+        except (KeyboardInterrupt, ExternalShutdownException):
             pass
-        os._exit(0)
+        finally:
+            self.shutdown()
+
+    def start_scheduler(self):
+        # One timer, re-armed after every step for the next deadline. Events
+        # from other threads trigger a guard condition in the same group.
+        self.scheduler.start()
+        self.rotation_timer = self.ros_node.create_timer(SCREEN_CHANGE_DELAY, self.step_scheduler,
+                                                         callback_group=self.display_group)
+        guard = self.ros_node.create_guard_condition(self.step_scheduler, callback_group=self.display_group)
+        self.scheduler.wakeup = guard.trigger
+        guard.trigger()
+
+    def step_scheduler(self):
+        deadline = self.scheduler.step()
+        if deadline is None:
+            # The panel is off until the next event
+            self.rotation_timer.cancel()
+            return
+        self.rotation_timer.timer_period_ns = max(int((deadline - time.monotonic()) * 1e9), 1000000)
+        self.rotation_timer.reset()
+
+    def shutdown(self):
+        logging.info("Shutting down OLED service")
+        import rclpy
+        self.scheduler.stop()
+        self.address_monitor.stop()
+        self.identity.stop()
+        self.executor.shutdown()
+        self.ros_node.destroy_node()
+        if self.recorder:
+            self.recorder.close()
+        rclpy.try_shutdown()
+        # Let the writer thread send the last frame
+        if hasattr(self.device, "flush"):
+            self.device.flush(1.0)
+
+    def add_screens(self):
+        self.scheduler.add_screen("wifi", self.display_wifi_info, SCREEN_DURATIONS["wifi"])
+        self.scheduler.add_screen("battery", self.display_battery_info, SCREEN_DURATIONS["battery"])
+        self.scheduler.add_screen("resources", self.display_resources, SCREEN_DURATIONS["resources"])
+        self.scheduler.add_screen("top", self.display_top_processes, SCREEN_DURATIONS["top"])
+
+    def start_rotation(self):
+        # Called by the scheduler each time the rotation starts over
+        self.ip_str = self.cache.get("ip", self.ip_str)
+        logging.debug(f"OLED frame stats: {self.device.stats()}")
 
 if __name__ == '__main__':
-    mbot_oled = MBotOLED()
+    setup_logging("/var/log/mbot/mbot_ros_oled_display.log")
+    # MBOT_OLED_BACKEND=memory runs without the OLED attached
+    # MBOT_OLED_RECORD=<file> records the inputs, MBOT_OLED_REPLAY=1 takes them from mbot_replay.py
+    mbot_oled = MBotOLED(backend=os.environ.get("MBOT_OLED_BACKEND", "i2c"),
+                         record=os.environ.get("MBOT_OLED_RECORD"), replay=os.environ.get("MBOT_OLED_REPLAY") == "1")
     mbot_oled.main_loop()
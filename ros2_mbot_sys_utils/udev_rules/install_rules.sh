@@ -10,6 +10,7 @@ sudo udevadm trigger
 echo "✅ MBot USB CDC rules installed."
 echo "   /dev/mbot_debug  -> Debug/printf console"
 echo "   /dev/mbot_microros    -> MicroROS communication"
+echo "   /dev/mbot_bootldr     -> RP2040 bootloader, while flashing"
 echo "   Verify with: ls -l /dev/mbot_*"
 
 # Add current user to the 'video' group (for camera access without sudo)
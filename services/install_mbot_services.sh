@@ -9,8 +9,27 @@ SERVICE_LIST="mbot-start-network
 # Copy the scripts we need for the services.
 sudo cp mbot_start_networking.sh /usr/local/etc/
 sudo chmod +x /usr/local/etc/mbot_start_networking.sh
-sudo cp mbot_publish_info.sh /usr/local/etc/
+sudo cp mbot_wifi_connect.py /usr/local/etc/
+sudo cp mbot_config.py /usr/local/etc/
+sudo cp mbot_publish_info.py /usr/local/etc/
+sudo chmod +x /usr/local/etc/mbot_publish_info.py
 sudo cp mbot_oled_display.py /usr/local/etc/
+sudo cp mbot_sysinfo.py /usr/local/etc/
+sudo cp mbot_sampler.py /usr/local/etc/
+sudo cp mbot_scheduler.py /usr/local/etc/
+sudo cp mbot_lcm_receiver.py /usr/local/etc/
+sudo cp mbot_battery.py /usr/local/etc/
+sudo cp mbot_oled_device.py /usr/local/etc/
+sudo cp mbot_oled_graphics.py /usr/local/etc/
+sudo cp mbot_oled_render.py /usr/local/etc/
+sudo cp mbot_oled_layout.py /usr/local/etc/
+sudo cp mbot_service_monitor.py /usr/local/etc/
+sudo cp mbot_metrics.py /usr/local/etc/
+sudo cp mbot_logging.py /usr/local/etc/
+sudo cp mbot_replay.py /usr/local/etc/
+sudo cp mbot_telemetry.py /usr/local/etc/
+sudo cp mbot_netlink.py /usr/local/etc/
+sudo cp mbot_power.py /usr/local/etc/
 sudo cp arial.ttf /usr/local/etc/
 
 # Copy the services.
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# Battery voltage filtering, state classification and discharge estimate.
+#
+# Raw ADC samples go through a short median filter and an EMA. The median is
+# classified into the same ranges the battery screen always used, with
+# hysteresis so a noisy reading near a threshold does not flicker between
+# states. The EMA would pass through every range in between on a step, such
+# as the barrel plug being pulled, so it only smooths the voltage shown and
+# starts over from the median when the range changes. One filtered point every trend_interval seconds is kept in
+# a fixed size ring buffer, with running sums for a least squares fit of the
+# discharge rate. Every sample costs O(1) time and memory stays bounded.
+from array import array
+
+# Voltage ranges of the battery screen states, (name, low, high) in volts.
+# Anything outside these ranges is "normal" and shows the voltage.
+JUMPER_6V = "jumper_6v"
+UNPLUGGED = "unplugged"
+NO_CAP = "no_cap"
+LOW = "low"
+NORMAL = "normal"
+UNKNOWN = "unknown"
+
+
+def battery_regions(jumper_6v_low, jumper_6v_high, unplug_low, unplug_high,
+                    no_cap_low, no_cap_high, battery_low):
+    return [
+        (JUMPER_6V, jumper_6v_low, jumper_6v_high),
+        (UNPLUGGED, unplug_low, unplug_high),
+        (NO_CAP, no_cap_low, no_cap_high),
+        (LOW, jumper_6v_high, battery_low),
+    ]
+
+
+class BatteryHistory:
+    def __init__(self, regions, empty_voltage, hysteresis=0.2, ema_alpha=0.3,
+                 median_window=5, trend_interval=10.0, capacity=720):
+        self.regions = regions
+        self.empty_voltage = empty_voltage
+        self.hysteresis = hysteresis
+        self.ema_alpha = ema_alpha
+        self.trend_interval = trend_interval
+        self.capacity = capacity
+
+        self._window = array("d", [0.0] * median_window)
+        self._times = array("d", [0.0] * capacity)
+        self._volts = array("d", [0.0] * capacity)
+        self._head = 0
+        self._count = 0
+        self._t0 = None
+        self._sums = [0.0] * 5  # n, t, v, t*t, t*v over the ring buffer
+        self.invalidate()
+
+    def invalidate(self):
+        # Forget the filter state, e.g. after the message stream timed out.
+        # The trend history is kept.
+        self._window_len = 0
+        self._window_pos = 0
+        self.voltage = -1
+        self.region = UNKNOWN
+
+    def add(self, timestamp, volts):
+        self._window[self._window_pos] = volts
+        self._window_pos = (self._window_pos + 1) % len(self._window)
+        self._window_len = min(self._window_len + 1, len(self._window))
+        median = sorted(self._window[:self._window_len])[self._window_len // 2]
+
+        region = self._classify(median)
+        if self.voltage == -1 or region != self.region:
+            self.voltage = median
+        else:
+            self.voltage += self.ema_alpha * (median - self.voltage)
+        self.region = region
+
+        if self._count == 0:
+            self._record(timestamp, self.voltage)
+        else:
+            last = self._t0 + self._times[(self._head - 1) % self.capacity]
+            if timestamp - last >= self.trend_interval:
+                self._record(timestamp, self.voltage)
+
+    def _classify(self, volts):
+        # Stay in the current region until the voltage leaves it by more
+        # than the hysteresis margin.
+        for name, low, high in self.regions:
+            if name == self.region and low - self.hysteresis < volts < high + self.hysteresis:
+                return name
+        for name, low, high in self.regions:
+            if low < volts < high:
+                return name
+        return NORMAL
+
+    def _record(self, timestamp, volts):
+        if self._t0 is None:
+            self._t0 = timestamp
+        t = timestamp - self._t0
+        if self._count == self.capacity:
+            old_t, old_v = self._times[self._head], self._volts[self._head]
+            self._update_sums(old_t, old_v, -1)
+        else:
+            self._count += 1
+        self._times[self._head] = t
+        self._volts[self._head] = volts
+        self._head = (self._head + 1) % self.capacity
+        self._update_sums(t, volts, 1)
+        if self._head == 0:
+            self._rebase()
+
+    def _rebase(self):
+        # Once per trip around the ring, shift the time origin to the oldest
+        # point and recompute the sums so rounding errors cannot build up
+        # over days of uptime. Amortized this is still O(1) per point.
+        shift = self._times[self._head]
+        self._t0 += shift
+        self._sums = [0.0] * 5
+        for i in range(self._count):
+            self._times[i] -= shift
+            self._update_sums(self._times[i], self._volts[i], 1)
+
+    def _update_sums(self, t, v, sign):
+        sums = self._sums
+        sums[0] += sign
+        sums[1] += sign * t
+        sums[2] += sign * v
+        sums[3] += sign * t * t
+        sums[4] += sign * t * v
+
+    def discharge_rate(self):
+        # Volts per hour lost, from a least squares fit over the history.
+        # None until there are enough points to fit.
+        n, st, sv, stt, stv = self._sums
+        if n < 3:
+            return None
+        denom = n * stt - st * st
+        if denom <= 0:
+            return None
+        return -(n * stv - st * sv) / denom * 3600
+
+    def time_to_empty(self):
+        # Seconds until the filtered voltage reaches empty_voltage at the
+        # current discharge rate, None when not discharging.
+        rate = self.discharge_rate()
+        if rate is None or rate <= 0.01 or self.voltage <= self.empty_voltage:
+            return None
+        return (self.voltage - self.empty_voltage) / rate * 3600
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# MBot configuration and identity, shared by the services.
+#
+# mbot_config.txt is parsed once and the hostname is read once; both are
+# kept in memory. Identity watches the directories of /etc/hostname and the
+# boot config with inotify and re-reads a file only when the kernel reports
+# that it was written or replaced, so a hostname or config change shows up
+# right away without polling. Directories are watched rather than the files
+# since hostnamectl and most editors replace a file instead of writing it.
+#
+# The shell scripts read keys through the same parser:
+#   python3 mbot_config.py [--config <file>] <key>...
+# prints the value of each key on its own line, an empty line if unset.
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+import socket
+import struct
+import logging
+import argparse
+import selectors
+import threading
+
+CONFIG_FILES = ["/boot/mbot_config.txt", "/boot/firmware/mbot_config.txt"]
+HOSTNAME_FILE = "/etc/hostname"
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Written files are only re-read once closed, not while half written.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+def parse_config(text):
+    # key=value lines, anything else and comments are ignored.
+    values = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep and key and not key.startswith("#"):
+            values[key] = value
+    return values
+
+
+def read_config(config_files=CONFIG_FILES):
+    # Returns (path, {key: value}) of the first config file found.
+    for config_file in config_files:
+        try:
+            with open(config_file, "r") as f:
+                return config_file, parse_config(f.read())
+        except FileNotFoundError:
+            continue
+    return None, {}
+
+
+class Identity:
+    def __init__(self, config_files=CONFIG_FILES, hostname_file=HOSTNAME_FILE, on_change=None):
+        # on_change(name) is called from the watch thread with "hostname" or
+        # "config" after the cached value changed.
+        self.config_files = list(config_files)
+        self.hostname_file = hostname_file
+        self.on_change = on_change
+        self.running = False
+        self._lock = threading.Lock()
+        self._fd = None
+        self._watches = {}  # watch descriptor -> directory
+        self.config_file, self._config = read_config(self.config_files)
+        self._hostname = self._read_hostname()
+
+    def hostname(self):
+        with self._lock:
+            return self._hostname
+
+    def config(self):
+        with self._lock:
+            return dict(self._config)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._config.get(key, default)
+
+    def _read_hostname(self):
+        # The kernel hostname, which hostnamectl updates together with
+        # /etc/hostname. No process is started for it.
+        try:
+            return socket.gethostname()
+        except OSError as e:
+            logging.error(f"Failed to get hostname: {e}")
+            return "Error"
+
+    def reload(self):
+        # Re-reads both and reports what changed. Also used when inotify is
+        # not available.
+        config_file, config = read_config(self.config_files)
+        hostname = self._read_hostname()
+        with self._lock:
+            changed = []
+            if config != self._config or config_file != self.config_file:
+                changed.append("config")
+            if hostname != self._hostname:
+                changed.append("hostname")
+            self.config_file, self._config, self._hostname = config_file, config, hostname
+        self._notify(changed)
+        return changed
+
+    def start(self):
+        # Returns False when inotify is not available; the values then stay
+        # as read at start until reload() is called.
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            self._fd = fd
+            directories = {os.path.dirname(path) for path in self.config_files + [self.hostname_file]}
+            for directory in sorted(directories):
+                wd = libc.inotify_add_watch(fd, directory.encode(), WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.ENOENT:
+                        continue  # e.g. /boot/firmware on bullseye
+                    raise OSError(err, f"inotify_add_watch {directory} failed")
+                self._watches[wd] = directory
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify not available, the config is only read at start: {e}")
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            return False
+        self.running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        # Catch anything written between reading the files and the watch.
+        self.reload()
+        return True
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._fd, selectors.EVENT_READ)
+            while self.running:
+                # The timeout only bounds how long stop() takes to be noticed.
+                if not selector.select(timeout=1.0):
+                    continue
+                try:
+                    data = os.read(self._fd, 65536)
+                except BlockingIOError:
+                    continue
+                if self._touches_watched(data):
+                    self.reload()
+        self.running = False
+        os.close(self._fd)
+
+    def _touches_watched(self, data):
+        watched = set(self.config_files + [self.hostname_file])
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if os.path.join(self._watches.get(wd, ""), name) in watched:
+                return True
+        return False
+
+    def _notify(self, changed):
+        if self.on_change:
+            for name in changed:
+                try:
+                    self.on_change(name)
+                except Exception as e:
+                    logging.error(f"Failed to handle {name} change: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print values from mbot_config.txt, one per line")
+    parser.add_argument("--config", help="path of mbot_config.txt, looked up in /boot by default")
+    parser.add_argument("keys", nargs="+")
+    args = parser.parse_args()
+
+    config_file, config = read_config([args.config] if args.config else CONFIG_FILES)
+    if config_file is None:
+        print(f"ERROR: {args.config or ' or '.join(CONFIG_FILES)} not found", file=sys.stderr)
+        return 1
+    for key in args.keys:
+        print(config.get(key, ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# LCM receive loop that only decodes the newest message on a channel.
+#
+# The loop sleeps in select() on the LCM file descriptor instead of polling
+# handle_timeout(). When it wakes it drains every queued message, keeping
+# only the raw bytes of the latest one, and decodes that single message.
+# Message rate, decode time and inter-arrival jitter are tracked as it goes.
+import time
+import logging
+import selectors
+
+
+class LatestMessageReceiver:
+    def __init__(self, lc, channel, decode, on_message):
+        self.lc = lc
+        self.channel = channel
+        self.decode = decode
+        self.on_message = on_message
+        self._latest = None
+        self._running = False
+        self.reset_stats()
+        self.subscription = lc.subscribe(channel, self._handler)
+
+    def reset_stats(self):
+        self.received = 0
+        self.decoded = 0
+        self.decode_time_total = 0.0
+        self.decode_time_max = 0.0
+        self.jitter = 0.0
+        self._first_arrival = None
+        self._last_arrival = None
+        self._last_interval = None
+
+    def stats(self):
+        elapsed = (self._last_arrival - self._first_arrival) if self.received > 1 else 0.0
+        return {
+            "received": self.received,
+            "decoded": self.decoded,
+            "rate_hz": (self.received - 1) / elapsed if elapsed > 0 else 0.0,
+            "decode_time_avg_ms": self.decode_time_total / max(self.decoded, 1) * 1e3,
+            "decode_time_max_ms": self.decode_time_max * 1e3,
+            "jitter_ms": self.jitter * 1e3,
+        }
+
+    def _handler(self, channel, data):
+        now = time.monotonic()
+        if self._last_arrival is not None:
+            interval = now - self._last_arrival
+            if self._last_interval is not None:
+                # Smoothed inter-arrival jitter as in RFC 3550.
+                self.jitter += (abs(interval - self._last_interval) - self.jitter) / 16
+            self._last_interval = interval
+        else:
+            self._first_arrival = now
+        self._last_arrival = now
+        self.received += 1
+        self._latest = data
+
+    def _drain(self, selector):
+        # Handle everything already queued on the socket before decoding.
+        self.lc.handle()
+        while selector.select(timeout=0):
+            self.lc.handle()
+
+    def _dispatch(self):
+        data, self._latest = self._latest, None
+        if data is None:
+            return
+        start = time.perf_counter()
+        msg = self.decode(data) if self.decode else data
+        elapsed = time.perf_counter() - start
+        self.decoded += 1
+        self.decode_time_total += elapsed
+        self.decode_time_max = max(self.decode_time_max, elapsed)
+        self.on_message(msg)
+
+    def run(self):
+        self._running = True
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.lc.fileno(), selectors.EVENT_READ)
+            while self._running:
+                # The timeout only bounds how long stop() takes to be noticed.
+                if not selector.select(timeout=1.0):
+                    continue
+                try:
+                    self._drain(selector)
+                    self._dispatch()
+                except Exception as e:
+                    logging.error(f"Failed to handle {self.channel} message: {e}")
+
+    def stop(self):
+        self._running = False
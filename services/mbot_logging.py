@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# Logging for the OLED daemons that keeps SD card writes down.
+#
+# Records are only put on a queue by the thread that logs them. A listener
+# thread writes them to the rotating log file and stderr (which journald
+# captures). A message that repeats, like the LCM timeout warning every
+# rotation, is written once per repeat_interval per message; the copies in
+# between are counted and written as one "repeated N times" line. The log
+# file is written out every flush_interval seconds instead of after every
+# record. Errors are written right away, so a killed daemon only loses the
+# last few seconds of lower level records.
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+from mbot_metrics import METRICS
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+REPEAT_INTERVAL = 60  # Seconds between writes of the same message, 0 to write every copy
+FLUSH_INTERVAL = 5  # Seconds the log file is buffered for, 0 to write every record
+
+
+class BatchedFileHandler(logging.FileHandler):
+    # Rotating log file that is written out by flush_batch(), or right away
+    # for errors. RotatingFileHandler seeks to check the size before every
+    # record, which writes the buffer out, so the size is counted here.
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding=None):
+        super().__init__(filename, mode="a", encoding=encoding)
+        self.max_bytes = maxBytes
+        self.backup_count = backupCount
+        self.size = os.fstat(self.stream.fileno()).st_size
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        self.acquire()
+        try:
+            if self.stream and not self.stream.closed:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def rollover(self):
+        # log.2 -> log.3, log.1 -> log.2, log -> log.1, like RotatingFileHandler
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.baseFilename}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.baseFilename}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.baseFilename, f"{self.baseFilename}.1")
+        self.stream = self._open()
+        self.size = 0
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+                self.size = os.fstat(self.stream.fileno()).st_size
+            msg = self.format(record) + self.terminator
+            length = len(msg.encode(self.stream.encoding, "replace"))
+            if self.max_bytes > 0 and self.size > 0 and self.size + length > self.max_bytes:
+                self.rollover()
+            self.stream.write(msg)
+            self.size += length
+        except Exception:
+            self.handleError(record)
+            return
+        if record.levelno >= logging.ERROR:
+            self.flush_batch()
+
+
+class DedupListener(QueueListener):
+    # Collapses repeated messages and writes the file in batches, all on the
+    # listener thread.
+    def __init__(self, log_queue, *handlers, repeat_interval=REPEAT_INTERVAL, flush_interval=FLUSH_INTERVAL):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.repeat_interval = repeat_interval
+        self.flush_interval = flush_interval
+        # message -> [time last written, copies not written, last copy]
+        self._repeats = {}
+        self._next_tick = time.monotonic() + flush_interval
+        self.written = 0
+        self.suppressed = 0
+
+    def dequeue(self, block):
+        # Waits at most until the next tick, the summaries and the batch are
+        # written while the queue is idle too.
+        while True:
+            timeout = self._next_tick - time.monotonic()
+            if timeout > 0:
+                try:
+                    return self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+            self.tick()
+
+    def handle(self, record):
+        now = time.monotonic()
+        if self.repeat_interval > 0:
+            # The message is already formatted by QueueHandler.prepare().
+            key = (record.levelno, record.msg)
+            repeat = self._repeats.get(key)
+            if repeat is not None and now - repeat[0] < self.repeat_interval:
+                repeat[1] += 1
+                repeat[2] = record
+                self.suppressed += 1
+                METRICS.count("log.suppressed")
+                return
+            if repeat is not None and repeat[1]:
+                self._write_summary(repeat, now)
+            self._repeats[key] = [now, 0, record]
+        self._write(record)
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def _write(self, record):
+        self.written += 1
+        super().handle(record)
+
+    def _write_summary(self, repeat, now):
+        last_time, count, record = repeat
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f"{record.msg} (repeated {count} times in {now - last_time:.0f} s)"
+        self._write(summary)
+
+    def tick(self):
+        # Writes the summaries that are due, forgets quiet messages and
+        # writes out the batch.
+        now = time.monotonic()
+        for key, repeat in list(self._repeats.items()):
+            if now - repeat[0] >= self.repeat_interval:
+                if repeat[1]:
+                    self._write_summary(repeat, now)
+                    self._repeats[key] = [now, 0, repeat[2]]
+                else:
+                    del self._repeats[key]
+        self.flush()
+        self._next_tick = now + max(self.flush_interval, 0.1)
+
+    def flush(self):
+        for handler in self.handlers:
+            if isinstance(handler, BatchedFileHandler):
+                handler.flush_batch()
+            else:
+                handler.flush()
+
+    def stop(self):
+        # Writes what is still pending before the process exits.
+        if self._thread is not None:
+            super().stop()
+            self.tick()
+
+
+def setup_logging(log_file, level=logging.INFO, stream=None,
+                  repeat_interval=REPEAT_INTERVAL, flush_interval=FLUSH_INTERVAL):
+    # Replaces the root logger's handlers. Returns the listener, which is
+    # stopped at exit.
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = BatchedFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3)
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = DedupListener(log_queue, file_handler, stream_handler,
+                             repeat_interval=repeat_interval, flush_interval=flush_interval)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+# Lightweight instrumentation for the OLED daemons.
+#
+# Timings go into fixed bucket histograms and events into counters, both
+# kept in memory by a process wide registry (METRICS). Recording a value is
+# a perf_counter() call and a bisect, no I/O. MetricsWriter periodically
+# dumps a snapshot as JSON, by default under /run, so it can be read with
+# cat or jq without talking to the daemon.
+import os
+import json
+import time
+import bisect
+import logging
+import resource
+import threading
+
+METRICS_FILE = "/run/mbot/mbot_oled_metrics.json"
+
+# Histogram bucket upper bounds, in milliseconds.
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1e3
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th value, capped at the
+        # largest value seen.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count if self.count else 0.0,
+            "max_ms": self.max,
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+        }
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        # Name of the screen being drawn, set by the scheduler, so the device
+        # can attribute flush time to a screen.
+        self.screen = "splash"
+        self._histograms = {}
+        self._counters = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last_snapshot = (self._started, {})
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        return _Timer(self, name) if self.enabled else _NullTimer()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def add_source(self, name, func):
+        # func() returns a dict that is included in every snapshot, e.g. the
+        # frame stats the display device already keeps.
+        self._sources[name] = func
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            histograms = {name: h.summary() for name, h in sorted(self._histograms.items())}
+            counters = dict(self._counters)
+        last_time, last_counters = self._last_snapshot
+        self._last_snapshot = (now, counters)
+        elapsed = now - last_time
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        uptime = now - self._started
+        cpu = usage.ru_utime + usage.ru_stime
+        snapshot = {
+            "time": time.time(),
+            "uptime_s": uptime,
+            "cpu_s": cpu,
+            "cpu_percent": cpu / uptime * 100 if uptime > 0 else 0.0,
+            "children_cpu_s": children.ru_utime + children.ru_stime,
+            "max_rss_kb": usage.ru_maxrss,
+            "counters": {
+                name: {"total": total,
+                       "rate_hz": (total - last_counters.get(name, 0)) / elapsed if elapsed > 0 else 0.0}
+                for name, total in sorted(counters.items())
+            },
+            "histograms": histograms,
+        }
+        for name, func in list(self._sources.items()):
+            try:
+                snapshot[name] = func()
+            except Exception as e:
+                snapshot[name] = {"error": str(e)}
+        return snapshot
+
+
+METRICS = Metrics()
+
+
+class MetricsWriter:
+    def __init__(self, metrics=METRICS, path=METRICS_FILE, interval=10):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def write(self):
+        # Written to a temporary file and renamed so readers never see a
+        # partial snapshot.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.metrics.snapshot(), f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f"Failed to write metrics to {self.path}: {e}")
+                return
+
+    def start(self):
+        # The services get /run/mbot from RuntimeDirectory=. Run by hand,
+        # the user has to be able to write to the directory.
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logging.error(f"Metrics disabled, cannot create {directory}: {e}")
+            return
+        if not os.access(directory, os.W_OK):
+            logging.error(f"Metrics disabled, cannot write to {directory}")
+            return
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
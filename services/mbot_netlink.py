@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# Interface address tracking over rtnetlink.
+#
+# Instead of asking for the IP every few seconds, AddressMonitor subscribes
+# to the kernel's link and IPv4 address notifications and keeps a table of
+# interface -> addresses. The table is filled with one dump at start and
+# then only changes when the kernel reports a change, e.g. when DHCP
+# finishes or the access point comes up, so it costs nothing while idle.
+import socket
+import struct
+import logging
+import selectors
+import threading
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFLA_IFNAME = 3
+IFF_UP = 0x1
+
+NLMSGHDR = struct.Struct("=IHHII")   # length, type, flags, seq, pid
+IFADDRMSG = struct.Struct("=BBBBI")  # family, prefixlen, flags, scope, index
+IFINFOMSG = struct.Struct("=BxHiII")  # family, type, index, flags, change
+RTATTR = struct.Struct("=HH")        # length, type
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_attributes(data, offset):
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def parse_messages(data):
+    # Yields (type, payload) for each netlink message in a datagram.
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield msg_type, data[offset + NLMSGHDR.size:offset + length]
+        offset += _align(length)
+
+
+class AddressMonitor:
+    def __init__(self, on_change=None):
+        # on_change(ifname) is called from the monitor thread whenever the
+        # addresses or the up state of an interface change.
+        self.on_change = on_change
+        self.running = False
+        self._links = {}      # index -> [name, up]
+        self._addresses = {}  # index -> list of IPv4 addresses
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def get_address(self, ifname):
+        # First IPv4 address of an interface that is up, or None.
+        with self._lock:
+            for index, (name, up) in self._links.items():
+                if name == ifname and up and self._addresses.get(index):
+                    return self._addresses[index][0]
+        return None
+
+    def addresses(self):
+        with self._lock:
+            return {name: list(self._addresses.get(index, []))
+                    for index, (name, up) in self._links.items() if up}
+
+    def start(self):
+        # Returns False when netlink is not available, so callers can fall
+        # back to polling.
+        try:
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self._sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+            self._dump(RTM_GETLINK, socket.AF_UNSPEC)
+            self._dump(RTM_GETADDR, socket.AF_INET)
+        except OSError as e:
+            logging.warning(f"rtnetlink not available, polling the IP instead: {e}")
+            if self._sock:
+                self._sock.close()
+                self._sock = None
+            return False
+        self.running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+
+    def _dump(self, msg_type, family):
+        # Request the current table and handle the replies until NLMSG_DONE.
+        # Notifications that arrive meanwhile are handled the same way.
+        payload = IFINFOMSG.pack(family, 0, 0, 0, 0) if msg_type == RTM_GETLINK else IFADDRMSG.pack(family, 0, 0, 0, 0)
+        header = NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, msg_type, 0)
+        self._sock.send(header + payload)
+        while True:
+            data = self._sock.recv(65536)
+            done = False
+            for reply_type, reply in parse_messages(data):
+                if reply_type == NLMSG_DONE:
+                    done = True
+                elif reply_type == NLMSG_ERROR:
+                    raise OSError(-struct.unpack_from("=i", reply)[0], "netlink dump failed")
+                else:
+                    self._handle(reply_type, reply)
+            if done:
+                return
+
+    def _run(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._sock, selectors.EVENT_READ)
+            while self.running:
+                # The timeout only bounds how long stop() takes to be noticed.
+                if not selector.select(timeout=1.0):
+                    continue
+                try:
+                    data = self._sock.recv(65536)
+                except OSError as e:
+                    # ENOBUFS means notifications were dropped, dump again.
+                    logging.error(f"rtnetlink receive failed: {e}")
+                    self._resync()
+                    continue
+                self._notify(self._handle(msg_type, payload) for msg_type, payload in parse_messages(data))
+        self.running = False
+        self._sock.close()
+
+    def _resync(self):
+        with self._lock:
+            self._links.clear()
+            self._addresses.clear()
+        try:
+            self._dump(RTM_GETLINK, socket.AF_UNSPEC)
+            self._dump(RTM_GETADDR, socket.AF_INET)
+        except OSError as e:
+            logging.error(f"rtnetlink dump failed: {e}")
+        with self._lock:
+            names = [name for name, _ in self._links.values()]
+        self._notify(names)
+
+    def _notify(self, ifnames):
+        changed = {ifname for ifname in ifnames if ifname}
+        if self.on_change:
+            for ifname in changed:
+                try:
+                    self.on_change(ifname)
+                except Exception as e:
+                    logging.error(f"Failed to handle address change on {ifname}: {e}")
+
+    def _handle(self, msg_type, payload):
+        # Applies one message to the table, returns the interface name it
+        # changed or None.
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            _, _, index, flags, _ = IFINFOMSG.unpack_from(payload)
+            attrs = parse_attributes(payload, IFINFOMSG.size)
+            with self._lock:
+                old = self._links.get(index)
+                if msg_type == RTM_DELLINK:
+                    self._links.pop(index, None)
+                    self._addresses.pop(index, None)
+                    return old[0] if old else None
+                name = attrs[IFLA_IFNAME].rstrip(b"\0").decode() if IFLA_IFNAME in attrs else (old[0] if old else str(index))
+                new = [name, bool(flags & IFF_UP)]
+                self._links[index] = new
+            return name if new != old else None
+
+        if msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            family, _, _, _, index = IFADDRMSG.unpack_from(payload)
+            if family != socket.AF_INET:
+                return None
+            attrs = parse_attributes(payload, IFADDRMSG.size)
+            # IFA_LOCAL is the interface's own address, IFA_ADDRESS the peer
+            # on point to point links and the same address otherwise.
+            raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if raw is None:
+                return None
+            address = socket.inet_ntoa(raw)
+            with self._lock:
+                addresses = self._addresses.setdefault(index, [])
+                if msg_type == RTM_NEWADDR and address not in addresses:
+                    addresses.append(address)
+                elif msg_type == RTM_DELADDR and address in addresses:
+                    addresses.remove(address)
+                else:
+                    return None
+                link = self._links.get(index)
+            return link[0] if link else str(index)
+        return None
@@ -0,0 +1,1852 @@
+#!/usr/bin/python3
+# Benchmarks for the MBot OLED daemon helpers.
+#
+# Usage: python3 mbot_oled_bench.py <benchmark> [--cycles N]
+# Runs on any Linux box, no OLED or robot hardware needed.
+import os
+import sys
+import time
+import json
+import argparse
+import shutil
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mbot_sysinfo
+from mbot_service_monitor import ServiceMonitor
+
+
+def fork_count():
+    # Total number of processes created since boot, system wide.
+    with open("/proc/stat", "r") as f:
+        for line in f:
+            if line.startswith("processes "):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_time():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime +
+            child_usage.ru_utime + child_usage.ru_stime)
+
+
+def measure(cycle_func, cycles):
+    forks_before = fork_count()
+    cpu_before = cpu_time()
+    wall_before = time.perf_counter()
+    for _ in range(cycles):
+        cycle_func()
+    wall = time.perf_counter() - wall_before
+    cpu = cpu_time() - cpu_before
+    forks = fork_count() - forks_before
+    return wall / cycles, cpu / cycles, forks / cycles
+
+
+def report(name, result):
+    wall, cpu, forks = result
+    print(f"{name:<12} wall {wall * 1e3:8.3f} ms/cycle   cpu {cpu * 1e3:8.3f} ms/cycle   forks {forks:6.1f}/cycle")
+
+
+# The probes every display rotation used to run before mbot_sysinfo existed.
+LEGACY_PROBES = [
+    (["ifconfig", "wlan0"], False),
+    (["iwgetid", "-r"], False),
+    (["hostname"], False),
+    (["uptime", "-p"], False),
+    ("free -m | awk 'NR==2{printf \"%.2f%%\", $3*100/$2 }'", True),
+    (["top", "-bn1"], False),
+]
+
+
+def legacy_sysinfo_cycle():
+    for cmd, shell in LEGACY_PROBES:
+        try:
+            subprocess.check_output(cmd, shell=shell, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            pass
+
+
+def native_sysinfo_cycle():
+    for probe in (lambda: mbot_sysinfo.get_interface_ip("wlan0"),
+                  mbot_sysinfo.get_connected_ssid,
+                  mbot_sysinfo.get_hostname,
+                  mbot_sysinfo.get_uptime,
+                  mbot_sysinfo.get_mem_used_percent,
+                  mbot_sysinfo.get_load_avg):
+        try:
+            probe()
+        except OSError:
+            pass
+
+
+def bench_sysinfo(args):
+    print(f"System info probes, {args.cycles} cycles")
+    report("subprocess", measure(legacy_sysinfo_cycle, args.cycles))
+    report("procfs", measure(native_sysinfo_cycle, args.cycles))
+
+
+BENCH_UNITS = ["mbot-start-network", "mbot-publish-info", "mbot-rplidar-driver", "mbot-lcm-serial",
+               "mbot-web-server", "mbot-motion-controller", "mbot-slam", "mbot-oled"]
+
+
+def legacy_services_cycle():
+    for unit in BENCH_UNITS:
+        try:
+            subprocess.check_output(f"systemctl status {unit} | head -3 | tail -1",
+                                    shell=True, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            pass
+
+
+def bench_services(args):
+    print(f"Service states for {len(BENCH_UNITS)} units, {args.cycles} cycles")
+    monitor = ServiceMonitor(BENCH_UNITS, poll_interval=0)
+    report("status", measure(legacy_services_cycle, args.cycles))
+    report("show", measure(monitor.get_states, args.cycles))
+
+
+STUB_SYSTEMD = """#!{python}
+# Stand-in for the systemd manager on a private bus: the units given are
+# running, any other unit is not found. SetState(unit, active, sub,
+# invalidate) changes a unit and emits PropertiesChanged, with the values or
+# with only their names in the invalidated list.
+import sys, json, dbus, dbus.service
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+MANAGER_IFACE = "org.freedesktop.systemd1.Manager"
+UNIT_IFACE = "org.freedesktop.systemd1.Unit"
+SERVICE_IFACE = "org.freedesktop.systemd1.Service"
+PROPERTIES_IFACE = "org.freedesktop.DBus.Properties"
+
+def unit_path(name):
+    return "/org/freedesktop/systemd1/unit/" + "".join(c if c.isalnum() else f"_{{ord(c):02x}}" for c in name)
+
+class Unit(dbus.service.Object):
+    def __init__(self, bus, name, found):
+        super().__init__(bus, unit_path(name))
+        self.found = found
+        self.props = {{"LoadState": "loaded" if found else "not-found", "ActiveState": "active" if found else "inactive",
+                      "SubState": "running" if found else "dead", "Result": "success"}}
+
+    @dbus.service.method(PROPERTIES_IFACE, in_signature="s", out_signature="a{{sv}}")
+    def GetAll(self, interface):
+        if interface == SERVICE_IFACE and not self.found:
+            raise dbus.exceptions.DBusException("Unknown interface", name="org.freedesktop.DBus.Error.UnknownInterface")
+        if interface == SERVICE_IFACE:
+            return {{"Result": self.props["Result"]}}
+        return {{key: value for key, value in self.props.items() if key != "Result"}}
+
+    @dbus.service.signal(PROPERTIES_IFACE, signature="sa{{sv}}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+class Manager(dbus.service.Object):
+    def __init__(self, bus, units):
+        super().__init__(bus, "/org/freedesktop/systemd1")
+        self.bus = bus
+        self.units = {{}}
+        self.found = set(units)
+
+    @dbus.service.method(MANAGER_IFACE)
+    def Subscribe(self):
+        pass
+
+    @dbus.service.method(MANAGER_IFACE, in_signature="s", out_signature="o")
+    def LoadUnit(self, name):
+        if name not in self.units:
+            self.units[name] = Unit(self.bus, name, name.removesuffix(".service") in self.found)
+        return unit_path(name)
+
+    @dbus.service.method(MANAGER_IFACE, in_signature="sssb")
+    def SetState(self, name, active, sub, invalidate):
+        unit = self.units[name]
+        unit.props.update(ActiveState=active, SubState=sub)
+        if invalidate:
+            unit.PropertiesChanged(UNIT_IFACE, dbus.Dictionary({{}}, signature="sv"), ["ActiveState", "SubState"])
+        else:
+            unit.PropertiesChanged(UNIT_IFACE, dbus.Dictionary({{"ActiveState": active, "SubState": sub}},
+                                                              signature="sv"), dbus.Array([], signature="s"))
+
+DBusGMainLoop(set_as_default=True)
+bus = dbus.bus.BusConnection(sys.argv[1])
+manager = Manager(bus, json.loads(sys.argv[2]))
+name = dbus.service.BusName("org.freedesktop.systemd1", bus)
+print("ready", flush=True)
+GLib.MainLoop().run()
+"""
+
+
+def bench_systemd(args):
+    import tempfile
+    import threading
+
+    # ServiceMonitor against a stub systemd on a private session bus: the
+    # states fetched on start, and the time from a unit changing state to
+    # on_change, for changed and for invalidated properties.
+    dbus_daemon = shutil.which("dbus-daemon")
+    try:
+        import dbus
+        import gi  # noqa: F401
+    except ImportError:
+        dbus = None
+    if dbus_daemon is None or dbus is None:
+        print("systemd      skipped, needs dbus-daemon, python3-dbus and python3-gi")
+        return
+
+    units = ["mbot-slam", "mbot-web-server"]
+    bus_process = subprocess.Popen([dbus_daemon, "--session", "--print-address", "--nofork"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    stub_process = None
+    try:
+        address = bus_process.stdout.readline().strip()
+        with tempfile.TemporaryDirectory() as root:
+            stub = os.path.join(root, "stub_systemd")
+            with open(stub, "w") as f:
+                f.write(STUB_SYSTEMD.format(python=sys.executable))
+            stub_process = subprocess.Popen([sys.executable, stub, address, json.dumps(units)],
+                                            stdout=subprocess.PIPE, text=True)
+            assert stub_process.stdout.readline().strip() == "ready", "the stub systemd did not start"
+
+            changes = []
+            changed = threading.Event()
+
+            def on_change(unit, state):
+                changes.append((unit, state))
+                changed.set()
+
+            monitor = ServiceMonitor(units + ["mbot-missing"], bus_address=address, on_change=on_change)
+            assert monitor.start(), "ServiceMonitor did not subscribe over D-Bus"
+            expected = {"mbot-slam": "active (running)", "mbot-web-server": "active (running)",
+                        "mbot-missing": "not found"}
+            assert monitor.get_states() == expected, monitor.get_states()
+
+            control = dbus.Interface(dbus.bus.BusConnection(address).get_object(
+                "org.freedesktop.systemd1", "/org/freedesktop/systemd1"), "org.freedesktop.systemd1.Manager")
+            latencies = {False: [], True: []}
+            for i in range(args.cycles):
+                # Stopped and started again, then the same with invalidated properties
+                invalidate = i % 4 >= 2
+                active, sub = ("inactive", "dead") if i % 2 == 0 else ("active", "running")
+                changed.clear()
+                del changes[:]
+                start = time.perf_counter()
+                control.SetState("mbot-slam.service", active, sub, invalidate)
+                assert changed.wait(5), "no on_change after PropertiesChanged"
+                latencies[invalidate].append(time.perf_counter() - start)
+                assert changes == [("mbot-slam", f"{active} ({sub})")], changes
+                expected["mbot-slam"] = f"{active} ({sub})"
+                assert monitor.get_states() == expected, monitor.get_states()
+    finally:
+        if stub_process is not None:
+            stub_process.terminate()
+            stub_process.wait()
+        bus_process.terminate()
+        bus_process.wait()
+
+    print(f"Unit state change to on_change over a private bus, {args.cycles} changes")
+    for invalidate, name in ((False, "changed"), (True, "invalidated")):
+        values = sorted(latencies[invalidate])
+        if not values:
+            continue
+        print(f"{name:<12} median {values[len(values) // 2] * 1e3:8.3f} ms   max {values[-1] * 1e3:8.3f} ms")
+
+
+class CountingSerial:
+    # Stands in for luma's i2c interface and counts the bytes put on the bus.
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def command(self, *cmd):
+        self.bytes_sent += len(cmd)
+
+    def data(self, data):
+        self.bytes_sent += len(data)
+
+    def cleanup(self):
+        pass
+
+
+def bench_display(args):
+    from PIL import ImageFont
+    from luma.core.render import canvas
+    from luma.oled.device import ssd1306
+    from mbot_oled_device import DiffingSSD1306
+
+    font = ImageFont.load_default()
+
+    def draw_frame(device, i):
+        # The wifi screen, where only the uptime changes every few frames.
+        with canvas(device) as draw:
+            draw.text((1, 1), "mbot-0000", font=font, fill="white")
+            draw.text((1, 17), "SSID: HomeWifiSSID", font=font, fill="white")
+            draw.text((1, 33), f"Uptime: {i // 4}m", font=font, fill="white")
+            draw.line((0, 48, 127, 48), fill="white")
+            draw.text((1, 49), "192.168.3.1", font=font, fill="white")
+
+    print(f"SSD1306 frames, {args.cycles} cycles")
+    for name, device_class in (("full", ssd1306), ("diff", DiffingSSD1306)):
+        serial = CountingSerial()
+        device = device_class(serial)
+        serial.bytes_sent = 0
+        frame = iter(range(args.cycles))
+        wall, cpu, _ = measure(lambda: draw_frame(device, next(frame)), args.cycles)
+        print(f"{name:<12} wall {wall * 1e3:8.3f} ms/frame   cpu {cpu * 1e3:8.3f} ms/frame   "
+              f"i2c {serial.bytes_sent / args.cycles:7.1f} bytes/frame")
+
+
+def bench_qr(args):
+    import qrcode
+    from PIL import Image, ImageDraw, ImageFont
+    from luma.core.render import canvas
+    from luma.oled.device import ssd1306
+    from mbot_oled_graphics import QRCodeCache
+
+    font = ImageFont.load_default()
+    ip_str = "192.168.3.1"
+
+    def legacy_qr_screen(device):
+        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
+        qr.add_data(f"http://{ip_str}")
+        qr.make(fit=True)
+        qr_img = qr.make_image(fill_color="black", back_color="white").resize((48, 48))
+        with canvas(device) as draw:
+            draw.text((1, 1), "WebApp", font=font, fill="white")
+            draw.text((1, 49), ip_str, font=font, fill="white")
+            draw.line((0, 48, 127, 48), fill="white")
+            draw.bitmap((80, 0), qr_img, fill="white")
+
+    qr_cache = QRCodeCache(48)
+    screen = {}
+
+    def cached_qr_screen(device):
+        if screen.get("ip") != ip_str:
+            image = Image.new("1", (128, 64))
+            draw = ImageDraw.Draw(image)
+            draw.text((1, 1), "WebApp", font=font, fill="white")
+            draw.text((1, 49), ip_str, font=font, fill="white")
+            draw.line((0, 48, 127, 48), fill="white")
+            draw.bitmap((80, 0), qr_cache.get(f"http://{ip_str}"), fill="white")
+            screen.update(ip=ip_str, image=image)
+        device.display(screen["image"])
+
+    print(f"WebApp QR screen, {args.cycles} cycles")
+    device = ssd1306(CountingSerial())
+    for name, render in (("rebuild", legacy_qr_screen), ("cached", cached_qr_screen)):
+        wall, cpu, _ = measure(lambda: render(device), args.cycles)
+        print(f"{name:<12} wall {wall * 1e3:8.3f} ms/screen   cpu {cpu * 1e3:8.3f} ms/screen")
+
+
+def bench_alert(args):
+    import logging
+    import threading
+    import mbot_battery
+    from mbot_oled_device import AsyncSSD1306, MemorySerial
+
+    # Time from the battery callback that turns the battery low to the alert
+    # frame landing in the display RAM, while the rotation sits on a screen:
+    # battery filter, scheduler preemption, rendering and the writer thread.
+    logging.disable(logging.ERROR)
+    daemon = load_daemon("mbot_oled_display", lcm_url="memq://")
+    if daemon is None:
+        print("alert        skipped, the daemon could not be created")
+        logging.disable(logging.NOTSET)
+        return
+
+    class WatchedSerial(MemorySerial):
+        # Notes the time the RAM first holds one of the alert frames.
+        targets = ()
+        landed = None
+
+        def data(self, data):
+            super().data(data)
+            if self.landed is None and bytes(self.ram) in self.targets:
+                self.landed = time.perf_counter()
+
+    # The writer thread of the I2C backend, with the memory interface
+    serial = WatchedSerial()
+    device = AsyncSSD1306(serial)
+    daemon.device = daemon.painter.device = daemon.power.device = device
+    daemon.service_monitor = FakeServiceMonitor(daemon.service_monitor.units)
+    daemon.mbot_lcm_installed = True
+
+    targets = []
+    for invert in (False, True):
+        daemon.flash_message("LOW BATTERY", invert)
+        device.flush()
+        targets.append(bytes(serial.ram))
+    serial.targets = targets
+
+    daemon.add_screens()
+    thread = threading.Thread(target=daemon.scheduler.run, daemon=True)
+    thread.start()
+
+    latencies = []
+    for _ in range(args.cycles):
+        # Back to a normal battery and off the alert
+        while daemon.battery.region != mbot_battery.NORMAL:
+            daemon.battery_info_callback(FakeBatteryMessage(11.5))
+        deadline = time.monotonic() + 5
+        while bytes(serial.ram) in targets and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        serial.landed = None
+        while True:
+            raised = time.perf_counter()
+            daemon.battery_info_callback(FakeBatteryMessage(8.5))
+            if daemon.battery.region == mbot_battery.LOW:
+                break
+        deadline = time.monotonic() + 5
+        while serial.landed is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+        if serial.landed is not None:
+            latencies.append(serial.landed - raised)
+    daemon.scheduler.stop()
+    thread.join(5)
+    device.cleanup()
+    logging.disable(logging.NOTSET)
+
+    print(f"Battery callback to alert frame in the display RAM, {args.cycles} alerts")
+    if not latencies:
+        print("alert        the alert frame never landed")
+        return
+    latencies.sort()
+    print(f"{'daemon':<12} median {latencies[len(latencies) // 2] * 1e3:8.3f} ms   "
+          f"max {latencies[-1] * 1e3:8.3f} ms   {args.cycles - len(latencies)} missed   "
+          f"(blocking sleep chain: up to ~30000 ms)")
+
+
+def bench_battery(args):
+    import random
+    import mbot_battery
+    from mbot_oled_display import (JUMPER_6V_LOW, JUMPER_6V_HIGH, UNPLUG_BARREL_LOW, UNPLUG_BARREL_HIGH,
+                                   NO_CAP_LOW, NO_CAP_HIGH, BATTERY_LIMIT_LOW)
+
+    # Steps and a slow discharge, with ADC noise, through the battery filter
+    # of the LCM daemon. A step must go straight to its new state without
+    # the states in between, like a low battery alert when the barrel plug
+    # is pulled.
+    regions = mbot_battery.battery_regions(JUMPER_6V_LOW, JUMPER_6V_HIGH, UNPLUG_BARREL_LOW, UNPLUG_BARREL_HIGH,
+                                           NO_CAP_LOW, NO_CAP_HIGH, BATTERY_LIMIT_LOW)
+
+    class EmaClassified(mbot_battery.BatteryHistory):
+        # The first version, which classified the smoothed voltage.
+        def add(self, timestamp, volts):
+            super().add(timestamp, volts)
+            median = sorted(self._window[:self._window_len])[self._window_len // 2]
+            if not hasattr(self, "_ema"):
+                self._ema = median
+            self._ema += self.ema_alpha * (median - self._ema)
+            self.region = self._classify(self._ema)
+
+    rng = random.Random(0)
+    scenarios = [
+        ("barrel pulled", [11.5] * 20 + [4.8] * 20, mbot_battery.UNPLUGGED),
+        ("barrel plugged", [4.8] * 20 + [11.5] * 20, mbot_battery.NORMAL),
+        ("6V jumper", [11.5] * 20 + [6.5] * 20, mbot_battery.JUMPER_6V),
+        ("discharge", [9.6 - i * 0.005 for i in range(200)], mbot_battery.LOW),
+    ]
+    samples = 0
+    elapsed = 0.0
+    print("Battery states along voltage steps and a discharge, 50 mV noise")
+    for name, volts, final in scenarios:
+        noisy = [v + rng.uniform(-0.05, 0.05) for v in volts]
+        for method, cls in (("ema", EmaClassified), ("median", mbot_battery.BatteryHistory)):
+            history = cls(regions, empty_voltage=BATTERY_LIMIT_LOW)
+            seen = []
+            start = time.perf_counter()
+            for i, v in enumerate(noisy):
+                history.add(i * 0.1, v)
+                if not seen or seen[-1] != history.region:
+                    seen.append(history.region)
+            if method == "median":
+                elapsed += time.perf_counter() - start
+                samples += len(noisy)
+                assert seen[-1] == final, f"{name}: ended {seen[-1]}, expected {final}"
+                # Straight to the new state, and the alert only when the battery runs low
+                assert len(seen) == 2, f"{name}: went through {seen}"
+                assert final == mbot_battery.LOW or mbot_battery.LOW not in seen, f"{name}: reported low"
+            print(f"{name:<16} {method:<7} {' -> '.join(seen)}")
+    print(f"{'median':<16} {elapsed / samples * 1e6:.1f} us/sample")
+
+
+def bench_lcm(args):
+    import struct
+    import threading
+    import lcm
+    from mbot_lcm_receiver import LatestMessageReceiver
+
+    # Loopback publisher of mbot_analog_t sized messages (int64 utime,
+    # int16 raw[6], float volts[6]) at a high rate on a private channel.
+    url = "udpm://239.255.76.67:7667?ttl=0"
+    channel = "MBOT_ANALOG_IN_BENCH"
+    messages = args.cycles * 100
+    payload_format = ">q6h6f"
+
+    def decode(data):
+        return struct.unpack(payload_format, data)
+
+    def publish():
+        publisher = lcm.LCM(url)
+        for i in range(messages):
+            publisher.publish(channel, struct.pack(payload_format, i, *range(6), *([11.1] * 6)))
+            if i % 100 == 0:
+                time.sleep(0.001)
+
+    def run(name, receive):
+        received = []
+        lc = lcm.LCM(url)
+        stop = receive(lc, received)
+        cpu_before = cpu_time()
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        publisher.join()
+        time.sleep(0.2)
+        cpu = cpu_time() - cpu_before
+        stats = stop()
+        print(f"{name:<12} cpu {cpu * 1e3:8.1f} ms   decoded {len(received):6d}/{messages}   {stats}")
+
+    def every_message(lc, received):
+        lc.subscribe(channel, lambda channel, data: received.append(decode(data)))
+        state = {"running": True}
+
+        def loop():
+            while state["running"]:
+                lc.handle_timeout(10)
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+
+        def stop():
+            state["running"] = False
+            thread.join()
+            return ""
+        return stop
+
+    def latest_only(lc, received):
+        receiver = LatestMessageReceiver(lc, channel, decode, received.append)
+        thread = threading.Thread(target=receiver.run, daemon=True)
+        thread.start()
+
+        def stop():
+            receiver.stop()
+            thread.join()
+            stats = receiver.stats()
+            return (f"rate {stats['rate_hz']:.0f} Hz, decode {stats['decode_time_avg_ms'] * 1e3:.1f} us, "
+                    f"jitter {stats['jitter_ms']:.3f} ms")
+        return stop
+
+    print(f"LCM receive of {messages} loopback messages")
+    run("decode-all", every_message)
+    run("latest", latest_only)
+
+
+# Contents of the fake procfs tree the rotation benchmark points
+# mbot_sysinfo at, so every run sees the same values. net/wireless only has
+# its headers, so no wireless ioctl is made.
+FAKE_PROC = {
+    "uptime": "93784.12 370211.40\n",
+    "loadavg": "0.42 0.37 0.30 2/311 12345\n",
+    "meminfo": "MemTotal:        3884320 kB\nMemFree:          812344 kB\nMemAvailable:    2456780 kB\n",
+    "net/wireless": "Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE\n"
+                    " face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22\n",
+    "self/stat": "1 (python3) S " + " ".join(["0"] * 18 + ["9000000"] + ["0"] * 30) + "\n",
+}
+
+FALLBACK_FONTS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+]
+
+
+def make_fake_proc(root):
+    for name, content in FAKE_PROC.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+class FakeBatteryMessage:
+    # Just the field the battery callbacks read from mbot_analog_t / BatteryADC.
+    def __init__(self, volts):
+        self.volts = [0.0, 0.0, 0.0, volts, 0.0, 0.0]
+
+
+class FakeServiceMonitor:
+    def __init__(self, units):
+        self.units = units
+
+    def get_states(self):
+        return {unit: "active (running)" for unit in self.units}
+
+
+class ProbeRecorder:
+    # Takes the place of the daemon's Sampler and keeps the probes it is given.
+    def __init__(self):
+        self.probes = []
+
+    def add(self, key, func, interval, ttl=None):
+        self.probes.append((key, func))
+
+    def start(self):
+        pass
+
+
+def load_daemon(module_name, **kwargs):
+    import importlib
+    module = importlib.import_module(module_name)
+    if not os.path.exists(module.FONT_PATH):
+        fonts = [path for path in FALLBACK_FONTS if os.path.exists(path)]
+        if not fonts:
+            return None
+        module.FONT_PATH = fonts[0]
+    daemon = module.MBotOLED(backend="memory", **kwargs)
+    if daemon.device is None or daemon.font is None:
+        return None
+    return daemon
+
+
+def bench_rotation(args):
+    import logging
+    import tempfile
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    "ros2_mbot_sys_utils", "services"))
+    # Failed interface lookups on a machine without wlan0 are expected here.
+    logging.disable(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as proc_root:
+        make_fake_proc(proc_root)
+        mbot_sysinfo.PROC_ROOT = proc_root
+
+        print(f"Full screen rotation on the in-memory display, {args.cycles} cycles")
+        for name, module_name, kwargs in (("lcm", "mbot_oled_display", {"lcm_url": "memq://"}),
+                                          ("ros2", "mbot_ros_oled_display", {})):
+            daemon = load_daemon(module_name, **kwargs)
+            if daemon is None:
+                print(f"{name:<12} skipped, the daemon could not be created")
+                continue
+            if hasattr(daemon, "service_monitor"):
+                daemon.service_monitor = FakeServiceMonitor(daemon.service_monitor.units)
+            if hasattr(daemon, "mbot_lcm_installed"):
+                daemon.mbot_lcm_installed = True
+            daemon.sampler = ProbeRecorder()
+            daemon.start_sampler()
+            daemon.add_screens()
+
+            device = daemon.device
+            screen_time = {}
+            screen_bytes = {}
+            cycle = iter(range(args.cycles))
+
+            def rotation():
+                i = next(cycle)
+                # A slowly discharging battery, so the battery screen changes.
+                daemon.battery_info_callback(FakeBatteryMessage(11.5 - i * 0.01))
+                for key, probe in daemon.sampler.probes:
+                    daemon.cache.set(key, probe(), 3600)
+                daemon.start_rotation()
+                for screen, render, _, pages in daemon.scheduler.screens:
+                    if pages is None:
+                        calls = [()]
+                    else:
+                        calls = [(page,) for page in range(daemon.scheduler._page_count(pages))]
+                    for page_args in calls:
+                        sent = device.bytes_sent
+                        start = time.perf_counter()
+                        render(*page_args)
+                        screen_time[screen] = screen_time.get(screen, 0.0) + time.perf_counter() - start
+                        screen_bytes[screen] = screen_bytes.get(screen, 0) + device.bytes_sent - sent
+
+            device.reset_stats()
+            report(name, measure(rotation, args.cycles))
+            for screen, total in screen_time.items():
+                print(f"  {screen:<10} render {total / args.cycles * 1e3:8.3f} ms/rotation   "
+                      f"i2c {screen_bytes[screen] / args.cycles:7.1f} bytes/rotation")
+            stats = device.stats()
+            print(f"  {'frames':<10} {stats['frames']} drawn, {stats['frames_skipped']} unchanged, "
+                  f"{stats['bytes_per_frame']:.1f} bytes/frame")
+    mbot_sysinfo.PROC_ROOT = "/proc"
+    logging.disable(logging.NOTSET)
+
+
+def bench_metrics(args):
+    import tempfile
+    from mbot_metrics import Metrics, MetricsWriter
+
+    # Cost of the instrumentation on the hot path, per 1000 timed sections,
+    # and of writing one snapshot file.
+    metrics = Metrics()
+
+    def timed_sections():
+        for i in range(1000):
+            with metrics.timer(f"render.screen{i % 8}"):
+                pass
+            metrics.count("callback.battery")
+
+    print(f"Instrumentation overhead, {args.cycles} cycles of 1000 timed sections")
+    for enabled in (False, True):
+        metrics.enabled = enabled
+        report("enabled" if enabled else "disabled", measure(timed_sections, args.cycles))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = MetricsWriter(metrics, os.path.join(tmp, "metrics.json"))
+        wall, cpu, _ = measure(writer.write, args.cycles)
+        print(f"{'snapshot':<12} wall {wall * 1e3:8.3f} ms/write    cpu {cpu * 1e3:8.3f} ms/write    "
+              f"{os.path.getsize(writer.path)} bytes")
+
+
+def bench_telemetry(args):
+    import threading
+    import lcm
+    from mbot_telemetry import HealthPublisher, decode_health, health_message
+
+    # Health messages published on the udpm loopback at a fixed rate, as
+    # seen by a separate subscriber.
+    url = "udpm://239.255.76.67:7667?ttl=0"
+    channel = "MBOT_SYSTEM_HEALTH_BENCH"
+    rate_hz = 50
+    values = {
+        "hostname": "mbot-0000", "ip": "192.168.3.1", "ssid": "HomeWifiSSID", "uptime": "2h5m",
+        "mem": "42.10%", "load_avg": "0.42, 0.37, 0.30",
+        "services": {short: "active (running)" for short in
+                     ("start-net", "pub-info", "lidar-drv", "lcm-ser", "webapp", "motion", "slam", "oled")},
+    }
+
+    arrivals = []
+    sizes = []
+
+    def on_message(channel, data):
+        decode_health(data)
+        arrivals.append(time.monotonic())
+        sizes.append(len(data))
+
+    subscriber = lcm.LCM(url)
+    subscriber.subscribe(channel, on_message)
+    state = {"running": True}
+
+    def receive():
+        while state["running"]:
+            subscriber.handle_timeout(10)
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+
+    publisher_lc = lcm.LCM(url)
+    publisher = HealthPublisher(lambda: health_message(values, 11.52),
+                                lambda data: publisher_lc.publish(channel, data), rate_hz)
+    publisher.start()
+    time.sleep(args.cycles / rate_hz)
+    publisher.stop()
+    time.sleep(0.1)
+    state["running"] = False
+    thread.join()
+
+    print(f"Health messages at {rate_hz} Hz on the LCM loopback, {args.cycles / rate_hz:.1f} s")
+    if len(arrivals) < 2:
+        print(f"{'received':<12} {len(arrivals)} messages")
+        return
+    intervals = [b - a for a, b in zip(arrivals, arrivals[1:])]
+    print(f"{'received':<12} {len(arrivals)}/{publisher.published} messages   "
+          f"rate {(len(arrivals) - 1) / (arrivals[-1] - arrivals[0]):6.1f} Hz   "
+          f"max gap {max(intervals) * 1e3:6.1f} ms   size {sum(sizes) / len(sizes):6.1f} bytes")
+
+
+def bench_netlink(args):
+    import socket
+    import threading
+    from mbot_netlink import AddressMonitor
+
+    # Time from an address being added to the monitor's callback. This adds
+    # and removes addresses, so it only runs inside an empty network namespace.
+    if any(name != "lo" for _, name in socket.if_nameindex()):
+        print("netlink: run inside a new network namespace, e.g. sudo unshare -n python3 mbot_oled_bench.py netlink")
+        return
+
+    ifname = "mbotbench0"
+    if subprocess.run(["ip", "link", "add", ifname, "type", "dummy"], stderr=subprocess.DEVNULL).returncode != 0:
+        ifname = "lo"  # Kernels without the dummy driver
+    subprocess.run(["ip", "link", "set", ifname, "up"], check=True)
+
+    changed = threading.Event()
+    monitor = AddressMonitor(on_change=lambda name: changed.set() if name == ifname else None)
+    if not monitor.start():
+        return
+
+    latencies = []
+    for i in range(args.cycles):
+        address = f"10.77.{i // 250}.{i % 250 + 1}"
+        for action in ("add", "del"):
+            changed.clear()
+            start = time.perf_counter()
+            subprocess.run(["ip", "addr", action, f"{address}/32", "dev", ifname], check=True)
+            if changed.wait(5):
+                latencies.append(time.perf_counter() - start)
+            expected = address if action == "add" else None
+            if monitor.get_address(ifname) not in (expected, "127.0.0.1"):
+                print(f"netlink: table out of date after {action} {address}")
+    cpu_before = cpu_time()
+    time.sleep(1)
+    idle_cpu = cpu_time() - cpu_before
+    monitor.stop()
+
+    latencies.sort()
+    print(f"Address change to callback on {ifname}, {len(latencies)} changes")
+    print(f"{'netlink':<12} median {latencies[len(latencies) // 2] * 1e3:8.3f} ms   "
+          f"max {latencies[-1] * 1e3:8.3f} ms   idle cpu {idle_cpu * 1e3:.3f} ms/s   "
+          f"(polling every 5 s: 2500 ms on average)")
+
+
+def bench_identity(args):
+    import tempfile
+    import threading
+    from mbot_config import Identity
+
+    # Time from the boot config being rewritten to the identity callback,
+    # for an in-place write and for an editor style replace, and the cost of
+    # reading the cached hostname.
+    with tempfile.TemporaryDirectory() as root:
+        config_file = os.path.join(root, "mbot_config.txt")
+        with open(config_file, "w") as f:
+            f.write("mbot_hostname=mbot-0000\n")
+        changed = threading.Event()
+        identity = Identity(config_files=[config_file], hostname_file=os.path.join(root, "hostname"),
+                            on_change=lambda name: changed.set() if name == "config" else None)
+        if not identity.start():
+            return
+
+        latencies = {"write": [], "replace": []}
+        for i in range(args.cycles):
+            for method, found in latencies.items():
+                changed.clear()
+                start = time.perf_counter()
+                path = config_file if method == "write" else config_file + ".tmp"
+                with open(path, "w") as f:
+                    f.write(f"mbot_hostname=mbot-{i:04d}\nmbot_oled_services=mbot-{method}:x\n")
+                if method == "replace":
+                    os.replace(path, config_file)
+                if changed.wait(5):
+                    found.append(time.perf_counter() - start)
+                if identity.get("mbot_oled_services") != f"mbot-{method}:x":
+                    print(f"identity: config out of date after {method}")
+        cpu_before = cpu_time()
+        time.sleep(1)
+        idle_cpu = cpu_time() - cpu_before
+        identity.stop()
+
+    print(f"Config change to callback, {args.cycles} changes each")
+    for method, found in latencies.items():
+        found.sort()
+        print(f"{method:<12} median {found[len(found) // 2] * 1e3:8.3f} ms   max {found[-1] * 1e3:8.3f} ms")
+    wall, _, _ = measure(identity.hostname, args.cycles * 100)
+    print(f"{'hostname':<12} {wall * 1e6:8.3f} us per call   idle cpu {idle_cpu * 1e3:.3f} ms/s   "
+          f"(sampled every 300 s before)")
+
+
+class DegradedSerial(CountingSerial):
+    # A slow I2C bus (clock stretched to about 40 kHz) that NAKs every
+    # fail_every-th data write.
+    def __init__(self, seconds_per_byte=0.0002, fail_every=5):
+        super().__init__()
+        self.seconds_per_byte = seconds_per_byte
+        self.fail_every = fail_every
+        self.writes = 0
+
+    def command(self, *cmd):
+        time.sleep(len(cmd) * self.seconds_per_byte)
+        super().command(*cmd)
+
+    def data(self, data):
+        self.writes += 1
+        time.sleep(len(data) * self.seconds_per_byte)
+        if self.fail_every and self.writes % self.fail_every == 0:
+            raise OSError(121, "Remote I/O error")
+        super().data(data)
+
+
+def bench_i2c(args):
+    import threading
+    import logging
+    from PIL import ImageFont
+    from luma.core.render import canvas
+    from mbot_oled_device import DiffingSSD1306, AsyncSSD1306
+    from mbot_scheduler import ScreenScheduler
+
+    # The low battery flasher on a degraded bus: how far the frame times
+    # drift from the flash interval when the bus is written synchronously
+    # and from the writer thread.
+    font = ImageFont.load_default()
+    interval = 0.1
+    logging.disable(logging.ERROR)
+
+    print(f"Flashing alert every {interval * 1e3:.0f} ms on a slow bus that NAKs every 5th write, {args.cycles} frames")
+    for name, device_class in (("sync", DiffingSSD1306), ("async", AsyncSSD1306)):
+        device = device_class(DegradedSerial(fail_every=0))
+        device._serial_interface.fail_every = 5
+        frame_times = []
+        done = threading.Event()
+
+        def flash(frame):
+            frame_times.append(time.monotonic())
+            try:
+                with canvas(device) as draw:
+                    if frame % 2:
+                        draw.rectangle(device.bounding_box, outline="white", fill="white")
+                    draw.text((1, 20), "LOW BATTERY", font=font, fill="black" if frame % 2 else "white")
+            except OSError:
+                pass
+            if len(frame_times) >= args.cycles:
+                done.set()
+
+        scheduler = ScreenScheduler()
+        scheduler.add_alert("flash", flash, interval, lambda: not done.is_set())
+        scheduler.add_screen("idle", lambda: None, 30)
+        thread = threading.Thread(target=scheduler.run, daemon=True)
+        thread.start()
+        done.wait()
+        scheduler.stop()
+        thread.join()
+
+        gaps = sorted(b - a for a, b in zip(frame_times, frame_times[1:]))
+        stats = device.stats()
+        print(f"{name:<12} interval median {gaps[len(gaps) // 2] * 1e3:7.1f} ms   max {gaps[-1] * 1e3:7.1f} ms   "
+              f"sent {stats['frames']} coalesced {stats.get('frames_coalesced', 0)} "
+              f"bus errors {stats.get('write_errors', '-')}")
+        if device_class is AsyncSSD1306:
+            device._serial_interface.fail_every = 0
+            device.cleanup()
+    logging.disable(logging.NOTSET)
+
+
+def bench_power(args):
+    import threading
+    from PIL import ImageFont
+    from luma.core.render import canvas
+    from mbot_oled_device import DiffingSSD1306, MemorySerial
+    from mbot_power import PowerPolicy
+    from mbot_scheduler import ScreenScheduler
+
+    # Wakeups and frames of a fast rotation while active, dimmed and off,
+    # then how long an event takes to bring the display back.
+    font = ImageFont.load_default()
+    phase = 2.0
+    device = DiffingSSD1306(MemorySerial())
+    power = PowerPolicy(device, dim_after=phase, off_after=2 * phase, slowdown=4)
+    drawn = threading.Event()
+
+    def screen(name):
+        def render():
+            with canvas(device) as draw:
+                draw.text((1, 1), name, font=font, fill="white")
+            drawn.set()
+        return render
+
+    scheduler = ScreenScheduler(power=power)
+    for name in ("wifi", "battery", "resources"):
+        scheduler.add_screen(name, screen(name), 0.1)
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+
+    print(f"Rotation of 100 ms screens, dimmed after {phase:.0f} s and off after {2 * phase:.0f} s idle")
+    power.stats()
+    for _ in range(3):
+        time.sleep(phase)
+        stats = power.stats()
+        print(f"{stats['state']:<12} wakeups {stats['wakeups_per_s']:7.1f}/s   frames {stats['frames_per_min']:7.1f}/min")
+
+    drawn.clear()
+    start = time.perf_counter()
+    power.wake("bench")
+    scheduler.notify()
+    drawn.wait(5)
+    print(f"{'wake':<12} first frame after {(time.perf_counter() - start) * 1e3:.3f} ms")
+    scheduler.stop()
+
+
+REGISTER_MBOT = """import os, sys, json
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+os.makedirs("data", exist_ok=True)
+with open(f"data/{args['-hostname']}.json", "w") as f:
+    json.dump({"hostname": args["-hostname"], "ip": args["-ip"]}, f)
+"""
+
+
+def make_registry(root):
+    # A bare registry repo like the shared one, with register_mbot.py and
+    # a data file per robot.
+    bare = os.path.join(root, "registry.git")
+    seed = os.path.join(root, "seed")
+    subprocess.run(["git", "init", "--quiet", "--bare", "-b", "main", bare], check=True)
+    subprocess.run(["git", "-C", bare, "config", "uploadpack.allowFilter", "true"], check=True)
+    subprocess.run(["git", "clone", "--quiet", bare, seed], check=True, stderr=subprocess.DEVNULL)
+    os.makedirs(os.path.join(seed, "data"))
+    with open(os.path.join(seed, "register_mbot.py"), "w") as f:
+        f.write(REGISTER_MBOT)
+    for i in range(200):
+        with open(os.path.join(seed, "data", f"old-robot-{i}.json"), "w") as f:
+            f.write(f'{{"hostname": "old-robot-{i}", "ip": "10.1.0.{i % 250}"}}')
+    for cmd in (["add", "."], ["-c", "user.name=seed", "-c", "user.email=seed", "commit", "--quiet", "-m", "seed"],
+                ["push", "--quiet", "origin", "HEAD:main"]):
+        subprocess.run(["git", "-C", seed] + cmd, check=True)
+    return bare
+
+
+def legacy_publish(url, path, hostname, ip):
+    # The sequence mbot_publish_info.sh ran on every boot.
+    shutil.rmtree(path, ignore_errors=True)
+    steps = [["git", "clone", "--quiet", "--depth=1", url, path],
+             ["git", "-C", path, "config", "--local", "user.email", hostname],
+             ["git", "-C", path, "config", "--local", "user.name", hostname],
+             ["git", "-C", path, "pull", "--quiet", url],
+             [sys.executable, "register_mbot.py", "-hostname", hostname, "-ip", ip, "-log", os.devnull],
+             ["git", "-C", path, "add", f"data/{hostname}.json"],
+             ["git", "-C", path, "commit", "--quiet", "-m", f"Auto update {hostname} IP"],
+             ["git", "-C", path, "push", "--quiet", url]]
+    for step in steps:
+        if subprocess.run(step, cwd=path if step[0] == sys.executable else None,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+            return False
+    shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+def bench_publish(args):
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    # A classroom of robots publishing their IP at the same moment against
+    # a local bare registry repo.
+    robots = 24
+    publisher = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mbot_publish_info.py")
+
+    def new_publish(url, path, hostname, ip):
+        result = subprocess.run([sys.executable, publisher, "--hostname", hostname, "--ip", ip, "--url", url,
+                                 "--path", path, "--log", os.path.join(os.path.dirname(path), "publish.log")],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def boot(name, publish, url, root, ip_base):
+        forks_before = fork_count()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=robots) as pool:
+            results = list(pool.map(lambda i: publish(url, os.path.join(root, f"robot-{i}"), f"robot-{i}",
+                                                      f"{ip_base}.{i + 1}"), range(robots)))
+        wall = time.perf_counter() - start
+        forks = fork_count() - forks_before
+        commits = subprocess.run(["git", "-C", url, "rev-list", "--count", "HEAD"],
+                                 stdout=subprocess.PIPE, text=True).stdout.strip()
+        print(f"{name:<12} wall {wall:6.2f} s   published {sum(results):3d}/{robots}   "
+              f"forks {forks / robots:5.1f}/robot   registry commits {commits}")
+
+    print(f"{robots} robots publishing their IP at once to a local bare registry")
+    with tempfile.TemporaryDirectory() as root:
+        url = make_registry(os.path.join(root, "legacy"))
+        boot("clone", legacy_publish, url, os.path.join(root, "legacy"), "10.0.0")
+    with tempfile.TemporaryDirectory() as root:
+        url = make_registry(root)
+        boot("checkout", new_publish, url, root, "10.0.0")
+        boot("reboot", new_publish, url, root, "10.0.0")
+        boot("new ip", new_publish, url, root, "10.0.1")
+
+
+FAKE_NMCLI = """#!{python}
+# Stand-in for nmcli with the delays of a real scan and connect.
+import sys, json, time
+SCAN, CONNECT, AUTH_FAIL = {scan}, {connect}, {auth_fail}
+NETWORKS = {networks}
+PASSWORD = {password!r}
+STATE = {state!r}
+
+def esc(value):
+    return value.replace("\\\\", "\\\\\\\\").replace(":", "\\\\:")
+
+def load():
+    try:
+        with open(STATE) as f:
+            return json.load(f)
+    except OSError:
+        return {{"connected": None, "profiles": [], "secrets": {{}}}}
+
+args, options = [], []
+argv = sys.argv[1:]
+while argv:
+    arg = argv.pop(0)
+    if arg in ("-f", "--fields", "-m", "--mode", "-w", "--wait", "-g", "--get-values"):
+        options += [arg, argv.pop(0)]
+    elif arg in ("-t", "--terse", "-s", "--show-secrets"):
+        options.append(arg)
+    else:
+        args.append(arg)
+state = load()
+command = " ".join(args[:3])
+if args[:2] in (["c", "show"], ["connection", "show"]):
+    if "--active" in args:
+        if state["connected"]:
+            print(f"{{esc(state['connected'])}}:wlan0:activated")
+    elif len(args) > 2:
+        if args[2] not in state["profiles"]:
+            sys.exit(10)
+        for value in state.get("secrets", {{}}).get(args[2], []):
+            print(esc(value))
+    else:
+        print("NAME  UUID  TYPE  DEVICE")
+        for name in state["profiles"]:
+            print(f"{{name}}  0000  wifi  --")
+elif command in ("dev wifi list", "device wifi list"):
+    time.sleep(SCAN)
+    for bssid, ssid, chan, signal in NETWORKS:
+        if "multiline" in options:
+            print(f"BSSID:{{esc(bssid)}}\\nSSID:{{ssid}}\\nCHAN:{{chan}}\\nSIGNAL:{{signal}}")
+        else:
+            print(f"{{esc(bssid)}}:{{esc(ssid)}}:{{chan}}:{{signal}}")
+    # Without saving the state it read before a connect finished
+    sys.exit(0)
+elif command == "device wifi connect":
+    target = args[3].replace("\\\\:", ":")
+    password = args[5] if len(args) > 5 else ""
+    matches = [n for n in NETWORKS if target in (n[0], n[1])]
+    if not matches or password != PASSWORD:
+        time.sleep(AUTH_FAIL if matches else 0.05)
+        print("Error: Connection activation failed.", file=sys.stderr)
+        sys.exit(4 if matches else 10)
+    time.sleep(CONNECT)
+    state["connected"] = matches[0][1]
+    if matches[0][1] not in state["profiles"]:
+        state["profiles"].append(matches[0][1])
+elif args[:2] == ["device", "status"]:
+    print("DEVICE  TYPE  STATE  CONNECTION")
+    if state["connected"]:
+        print(f"wlan0  wifi  connected  {{state['connected']}}")
+elif args[:2] == ["connection", "up"]:
+    time.sleep(0.2)
+    state["connected"] = args[2]
+elif args[:2] == ["connection", "add"]:
+    name = args[args.index("con-name") + 1]
+    state["profiles"].append(name)
+    if "wifi-sec.psk" in args:
+        state.setdefault("secrets", {{}})[name] = [args[args.index("ssid") + 1], args[args.index("wifi-sec.psk") + 1]]
+elif args[:2] == ["connection", "delete"]:
+    if args[2] not in state["profiles"]:
+        sys.exit(10)
+    state["profiles"].remove(args[2])
+with open(STATE, "w") as f:
+    json.dump(state, f)
+"""
+
+LEGACY_NETWORKING = """log_file=/dev/null
+# Check if there is an active WiFi connection
+start_ap=false
+wifi_status=$(nmcli -t -f NAME,DEVICE,STATE c show --active | grep 'wlan0:activated')
+if [[ -n "$wifi_status" ]]; then
+    active_wifi_name=$(echo "$wifi_status" | cut -d: -f1)
+    echo "Connected to active WiFi network '$active_wifi_name'. Done." | tee -a "$log_file"
+else
+    echo "Looking for home network '$home_wifi_ssid'" | tee -a "$log_file"
+    available_networks=$(nmcli -m multiline --terse --fields BSSID,SSID,CHAN,SIGNAL dev wifi list | grep -v '^IN-USE')
+
+    # Parse available networks and prioritize by signal strength
+    while read -r bssid && read -r ssid && read -r channel && read -r signal; do
+        bssid=${bssid#*:}
+        ssid=${ssid#*:}
+        channel=${channel#*:}
+        signal=${signal#*:}
+        if [[ "$ssid" == "$home_wifi_ssid" ]]; then
+            echo "$bssid $ssid $channel $signal" | tee -a "$log_file"
+            available_networks_sorted+="$signal $channel $bssid $ssid\\n"
+        fi
+    done <<< "$available_networks"
+
+    sorted_avail=$(echo -e "$available_networks_sorted" | sort -nr)
+
+    if grep -q "$home_wifi_ssid" <<< "$sorted_avail"; then
+        if ! nmcli connection show | grep -q "$home_wifi_ssid"; then
+            home_wifi_bssid=$(echo "$sorted_avail" | head -n 1 | awk '{print $3}')
+            echo "Connecting to BSSID: $home_wifi_bssid" | tee -a "$log_file"
+            nmcli device wifi connect "$home_wifi_bssid" password "$home_wifi_password"
+        else
+            echo "Connecting to SSID: $home_wifi_ssid" | tee -a "$log_file"
+            nmcli device wifi connect "$home_wifi_ssid" password "$home_wifi_password"
+        fi
+
+        # If not connected, start the access point.
+        if ! nmcli device status | grep "$home_wifi_ssid" | grep -q "connected"; then
+            echo "Connection failed! Check your password!" | tee -a "$log_file"
+            start_ap=true
+        fi
+    else
+        echo "Home network not found." | tee -a "$log_file"
+        start_ap=true
+    fi
+fi
+
+if [[ $start_ap == true ]]; then
+    echo "Starting Access Point" | tee -a "$log_file"
+    nmcli connection show | grep -q "mbot_wifi_ap" && nmcli connection delete mbot_wifi_ap
+    nmcli connection add type wifi ifname '*' con-name mbot_wifi_ap autoconnect no ssid "$ap_ssid"
+    nmcli connection modify mbot_wifi_ap 802-11-wireless.mode ap 802-11-wireless.band a ipv4.method shared
+    nmcli connection modify mbot_wifi_ap wifi-sec.key-mgmt wpa-psk wifi-sec.psk "$ap_password"
+    nmcli connection modify mbot_wifi_ap ipv4.addresses 192.168.3.1/24 ipv4.gateway 192.168.3.1
+    echo "Access point created successfully." | tee -a "$log_file"
+    sleep "$ap_start_delay"
+    nmcli connection up mbot_wifi_ap
+    echo "Access point started." | tee -a "$log_file"
+fi
+"""
+
+
+def bench_network(args):
+    import logging
+    import tempfile
+    import mbot_wifi_connect
+
+    # Time to connected against a fake nmcli, for the old serial sequence of
+    # mbot_start_networking.sh and for mbot_wifi_connect.py with and without
+    # a cached BSSID. Delays are scaled down, a real scan takes 3-5 s.
+    scan, connect, auth_fail, ap_start_delay = 1.5, 0.5, 1.5, 2
+    home = [["AA:BB:CC:00:00:01", "HomeNet", "36", "72"], ["AA:BB:CC:00:00:02", "HomeNet", "1", "48"],
+            ["DE:AD:BE:EF:00:01", "Neighbor", "11", "60"]]
+    away = [["DE:AD:BE:EF:00:01", "Neighbor", "11", "60"]]
+    mbot_wifi_connect.AP_START_DELAY = ap_start_delay
+    logging.disable(logging.INFO)
+
+    def run(root, name, networks, password, method):
+        fake = os.path.join(root, "nmcli")
+        state = os.path.join(root, "nmcli_state.json")
+        with open(state, "w") as f:
+            f.write('{"connected": null, "profiles": []}')
+        with open(fake, "w") as f:
+            f.write(FAKE_NMCLI.format(python=sys.executable, scan=scan, connect=connect, auth_fail=auth_fail,
+                                      networks=networks, password=password, state=state))
+        os.chmod(fake, 0o755)
+        forks_before = fork_count()
+        start = time.perf_counter()
+        if method == "legacy":
+            env = dict(os.environ, PATH=f"{root}:{os.environ['PATH']}", home_wifi_ssid="HomeNet",
+                       home_wifi_password="secret", ap_ssid="mbot-AP", ap_password="mbot-pass",
+                       ap_start_delay=str(ap_start_delay))
+            subprocess.run(["bash", "-c", LEGACY_NETWORKING], env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            result = None
+        else:
+            mbot_wifi_connect.NMCLI = fake
+            result = mbot_wifi_connect.bring_up("HomeNet", "secret", "mbot-AP", "mbot-pass",
+                                                os.path.join(root, "wifi_last_good.json"))
+        elapsed = time.perf_counter() - start
+        with open(state) as f:
+            connected = json.load(f)["connected"]
+        print(f"{name:<22} {method:<8} connected to {str(connected):<14} after {elapsed:5.2f} s   "
+              f"forks {fork_count() - forks_before:3d}" + (f"   ({result})" if result else ""))
+
+    print(f"Fake nmcli: scan {scan} s, connect {connect} s, failed auth {auth_fail} s, AP start delay {ap_start_delay} s")
+    for name, networks, password in (("home network", home, "secret"), ("home network moved", home, "secret"),
+                                     ("away from home", away, "secret"), ("wrong password", home, "wrong")):
+        with tempfile.TemporaryDirectory() as root:
+            run(root, name, networks, password, "legacy")
+            run(root, name, networks, password, "cold")
+            if name == "home network moved":
+                # The cached access point is gone, the scan finds another one.
+                with open(os.path.join(root, "wifi_last_good.json"), "w") as f:
+                    f.write('{"ssid": "HomeNet", "bssid": "AA:BB:CC:00:00:09", "channel": "149"}')
+            run(root, name, networks, password, "cached")
+    logging.disable(logging.NOTSET)
+
+
+FAKE_PICOTOOL = """#!{python}
+# Stand-in for picotool that writes the UF2 to a flash image file.
+import sys, time, shutil, filecmp
+FLASH = {flash!r}
+command = sys.argv[1]
+if command == "load":
+    time.sleep({load_time})
+    shutil.copyfile(sys.argv[2], FLASH)
+elif command == "verify":
+    time.sleep({verify_time})
+    sys.exit(0 if filecmp.cmp(sys.argv[2], FLASH, shallow=False) else 1)
+"""
+
+
+def bench_firmware(args):
+    import tempfile
+    import threading
+
+    # Flashes a fake board through gpio-sim: a thread plays the RP2040,
+    # creating the udev links in a fake /dev a while after RUN goes high,
+    # and a fake picotool writes the UF2 to a file. Needs root and the
+    # gpio-sim module (sudo modprobe gpio-sim).
+    sim_root = "/sys/kernel/config/gpio-sim"
+    if not os.path.isdir(sim_root):
+        print("firmware: needs gpio-sim, run sudo modprobe gpio-sim and mount configfs on /sys/kernel/config")
+        return
+    uploader = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mbot-upload-firmware")
+    btld, run = 4, 17
+    load_time, verify_time = 0.8, 0.4
+
+    sim = os.path.join(sim_root, f"mbot-bench-{os.getpid()}")
+    os.mkdir(sim)
+    os.mkdir(os.path.join(sim, "bank0"))
+    with open(os.path.join(sim, "bank0", "num_lines"), "w") as f:
+        f.write("32")
+    with open(os.path.join(sim, "live"), "w") as f:
+        f.write("1")
+    try:
+        with open(os.path.join(sim, "bank0", "chip_name")) as f:
+            chip_name = f.read().strip()
+        with open(os.path.join(sim, "dev_name")) as f:
+            dev_name = f.read().strip()
+
+        def level(line):
+            with open(f"/sys/devices/platform/{dev_name}/{chip_name}/sim_gpio{line}/value") as f:
+                return f.read().strip() == "1"
+
+        with tempfile.TemporaryDirectory() as root:
+            dev = os.path.join(root, "dev")
+            os.mkdir(dev)
+            uf2 = os.path.join(root, "mbot_firmware.uf2")
+            with open(uf2, "wb") as f:
+                f.write(os.urandom(256 * 1024))
+            picotool = os.path.join(root, "picotool")
+            with open(picotool, "w") as f:
+                f.write(FAKE_PICOTOOL.format(python=sys.executable, flash=os.path.join(root, "flash.bin"),
+                                             load_time=load_time, verify_time=verify_time))
+            os.chmod(picotool, 0o755)
+
+            running = True
+            enumerate_delay = [0.3]
+            tty_name = ["mbot_tty"]
+
+            def board():
+                # Enumerates as the bootloader or the firmware after a reset.
+                was_running = level(run)
+                while running:
+                    is_running = level(run)
+                    if is_running and not was_running:
+                        name = "mbot_bootldr" if not level(btld) else tty_name[0]
+                        time.sleep(enumerate_delay[0])
+                        os.symlink("null", os.path.join(dev, ".tmp-" + name))
+                        os.replace(os.path.join(dev, ".tmp-" + name), os.path.join(dev, name))
+                    elif was_running and not is_running:
+                        for name in ("mbot_bootldr", "mbot_tty", "mbot_microros"):
+                            if os.path.lexists(os.path.join(dev, name)):
+                                os.remove(os.path.join(dev, name))
+                    was_running = is_running
+                    time.sleep(0.001)
+
+            thread = threading.Thread(target=board, daemon=True)
+            thread.start()
+            print(f"Fake board on gpio-sim {chip_name}, fake picotool load {load_time} s, verify {verify_time} s")
+            # The LCM and the ROS 2 firmware, whose serial ports udev names differently
+            for flavor, delay in (("lcm", 0.3), ("lcm", 0.8), ("ros2", 0.3)):
+                tty_name[0] = "mbot_tty" if flavor == "lcm" else "mbot_microros"
+                enumerate_delay[0] = delay
+                start = time.perf_counter()
+                result = subprocess.run([sys.executable, uploader, "flash", uf2, "--chip", f"/dev/{chip_name}",
+                                         "--btld", str(btld), "--run", str(run), "--dev", dev,
+                                         "--picotool", picotool], stdout=subprocess.DEVNULL)
+                wall = time.perf_counter() - start
+                # The old script slept 0.1 + 0.1 + 0.5 + 0.5 s before loading,
+                # 0.5 + 0.5 s before rebooting and loaded without verifying.
+                # It ran picotool 0.5 s after releasing RUN.
+                legacy = 2.2 + load_time
+                legacy_note = "ok" if delay <= 0.5 else "picotool finds no board"
+                print(f"{flavor:<5} enumerate {delay:.1f} s   uploader {wall:5.2f} s ({'ok' if result.returncode == 0 else 'failed'}), "
+                      f"verified and running   old fixed delays {legacy:5.2f} s ({legacy_note}), unverified")
+            running = False
+            thread.join()
+    finally:
+        with open(os.path.join(sim, "live"), "w") as f:
+            f.write("0")
+        os.rmdir(os.path.join(sim, "bank0"))
+        os.rmdir(sim)
+
+
+def bench_glyphs(args):
+    from PIL import ImageFont
+    from luma.core.render import canvas
+    from mbot_oled_device import DiffingSSD1306, MemorySerial
+    from mbot_oled_render import FrameBuffer
+
+    fonts = [path for path in FALLBACK_FONTS if os.path.exists(path)]
+    if not fonts:
+        print("glyphs       skipped, no TrueType font found")
+        return
+    font, font_small, font_medium, font_large = (ImageFont.truetype(fonts[0], size) for size in (14, 10, 12, 18))
+
+    def draw_frame(draw, i):
+        # Text of every size the screens use, with values that change.
+        draw.text((1, 1), "mbot-0000", font=font, fill="white")
+        draw.text((1, 17), f"Voltage: {11.5 - i * 0.01:.2f} V", font=font_medium, fill="white")
+        draw.text((1, 33), f"Uptime: {i // 60}h{i % 60:02d}m, load {i % 100 / 100:.2f}", font=font_small, fill="white")
+        draw.line((0, 48, 127, 48), fill="white")
+        draw.text((1, 49), f"192.168.3.{i % 254 + 1}", font=font, fill="white")
+        if i % 2:
+            draw.rectangle((0, 0, 127, 47), outline="white", fill="white")
+            draw.text((1, 20), "LOW BATTERY", font=font_large, fill="black")
+
+    start = time.perf_counter()
+    frame = FrameBuffer(128, 64)
+    for f in (font, font_small, font_medium, font_large):
+        frame.add_font(f)
+    atlas_time = time.perf_counter() - start
+
+    paths = (("canvas", canvas), ("numpy", frame.canvas))
+    # The same frames on both paths, compared pixel by pixel in display RAM.
+    # This also measures the character pairs, so the timing below is for a
+    # daemon that has been running for a while.
+    serials = {name: MemorySerial() for name, _ in paths}
+    devices = {name: DiffingSSD1306(serials[name]) for name, _ in paths}
+    mismatched = 0
+    for i in range(args.cycles):
+        for name, draw_on in paths:
+            with draw_on(devices[name]) as d:
+                draw_frame(d, i)
+        mismatched += sum(bin(a ^ b).count("1") for a, b in zip(serials["canvas"].ram, serials["numpy"].ram))
+
+    print(f"Frames of text in 4 sizes from {os.path.basename(fonts[0])}, {args.cycles} cycles")
+    for name, draw_on in paths:
+        device = DiffingSSD1306(CountingSerial())
+        cycle = iter(range(args.cycles))
+
+        def draw():
+            i = next(cycle)
+            with draw_on(device) as d:
+                draw_frame(d, i)
+        report(name, measure(draw, args.cycles))
+    print(f"  atlas built in {atlas_time * 1e3:.1f} ms, "
+          f"{mismatched / args.cycles:.1f} of 8192 pixels differ from canvas() per frame")
+
+
+def bench_layout(args):
+    from PIL import ImageFont
+    from mbot_oled_device import DiffingSSD1306, MemorySerial
+    from mbot_oled_render import FrameBuffer
+    from mbot_oled_layout import LayoutPainter
+
+    fonts = [path for path in FALLBACK_FONTS if os.path.exists(path)]
+    if not fonts:
+        print("layout       skipped, no TrueType font found")
+        return
+    roles = {role: ImageFont.truetype(fonts[0], size)
+             for role, size in (("regular", 14), ("small", 10), ("medium", 12), ("large", 18))}
+
+    def screens(i):
+        # One rotation where, like on the robot, only some values change.
+        rows = {"row0": ("start-net", "active (exited)"), "row1": ("pub-info", "active (exited)"),
+                "row2": ("lidar-drv", "failed" if i % 10 == 0 else "active (running)")}
+        return [
+            ("wifi", {"hostname": "mbot-0000", "ssid": "HomeWifiSSID", "uptime": f"{i // 60}h{i % 60}m",
+                      "ip": "192.168.3.1"}),
+            ("battery_trend", {"voltage": round(11.5 - i * 0.001, 2), "trend": "-0.42 V/h, 3h05m left",
+                               "ip": "192.168.3.1"}),
+            ("resources", {"load_avg": f"{i % 100 / 100:.2f}, 0.37, 0.30", "mem": "42.10%", "ip": "192.168.3.1"}),
+            ("services", dict(rows, ip="192.168.3.1")),
+        ]
+
+    print(f"Screen layouts, {args.cycles} rotations of 4 screens")
+    serials = {}
+    for name, frame in (("canvas", None), ("layered", FrameBuffer(128, 64))):
+        serials[name] = MemorySerial()
+        painter = LayoutPainter(DiffingSSD1306(serials[name]), roles, frame)
+        # The first rotation builds the atlas and static layers.
+        for layout, values in screens(0):
+            painter.paint(layout, values)
+        cycle = iter(range(1, args.cycles + 1))
+        drawn = [0]
+
+        def rotation():
+            i = next(cycle)
+            for layout, values in screens(i):
+                drawn[0] += painter.paint(layout, values)
+        report(name, measure(rotation, args.cycles))
+        print(f"  {drawn[0] / args.cycles:.1f} fields drawn per rotation")
+    # The last frames of both paths must be the same.
+    mismatched = sum(bin(a ^ b).count("1") for a, b in zip(serials["canvas"].ram, serials["layered"].ram))
+    print(f"  {mismatched} of 8192 pixels differ from canvas() in the last frame")
+
+
+def write_syscalls():
+    # Write system calls of this process, all threads included.
+    with open("/proc/self/io", "r") as f:
+        for line in f:
+            if line.startswith("syscw:"):
+                return int(line.split()[1])
+    return 0
+
+
+def bench_logging(args):
+    import logging
+    import tempfile
+    from logging.handlers import RotatingFileHandler
+    import mbot_logging
+
+    # A daemon with silent firmware and a failing probe: every rotation logs
+    # the same warning and error, now and then something new. The time is
+    # scaled down 300 times, a 3 s rotation takes 10 ms and the 60 s repeat
+    # interval 0.2 s.
+    rotations = args.cycles * 4
+
+    def run(log_file):
+        main_thread = 0.0
+        start = write_syscalls()
+        for i in range(rotations):
+            t = time.perf_counter()
+            logging.warning("No new LCM messages received for a while.")
+            logging.error("Failed to get connected SSID: [Errno 19] No such device")
+            if i % 25 == 0:
+                logging.info(f"wlan0 IP changed to 192.168.3.{i % 254 + 1}")
+            main_thread += time.perf_counter() - t
+            time.sleep(0.01)
+        return main_thread, start
+
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    print(f"Logging {rotations} rotations of a daemon with silent firmware")
+    with tempfile.TemporaryDirectory() as root_dir, open(os.devnull, "w") as devnull:
+        for name in ("direct", "pipeline"):
+            log_file = os.path.join(root_dir, name, "mbot_oled.log")
+            os.makedirs(os.path.dirname(log_file))
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            if name == "direct":
+                # What the daemons did before mbot_logging.py.
+                formatter = logging.Formatter(mbot_logging.LOG_FORMAT)
+                handlers = [RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3),
+                            logging.StreamHandler(devnull)]
+                for handler in handlers:
+                    handler.setFormatter(formatter)
+                    root.addHandler(handler)
+                root.setLevel(logging.INFO)
+                main_thread, start = run(log_file)
+                for handler in handlers:
+                    handler.close()
+            else:
+                listener = mbot_logging.setup_logging(log_file, stream=devnull,
+                                                      repeat_interval=0.2, flush_interval=0.1)
+                main_thread, start = run(log_file)
+                listener.stop()
+            syscalls = write_syscalls() - start
+            with open(log_file, "r") as f:
+                lines = f.readlines()
+            records = rotations * 2 + (rotations + 24) // 25
+            print(f"{name:<12} main thread {main_thread / records * 1e6:6.1f} us/record   "
+                  f"{len(lines):5d} lines, {sum(map(len, lines)) / 1024:6.1f} KiB   "
+                  f"{syscalls:5d} write syscalls")
+        print(f"  last line: {lines[-1].strip()}")
+
+        # Records below ERROR stay in the buffer until flush_batch(), and
+        # the file still rolls over at maxBytes.
+        log_file = os.path.join(root_dir, "batched", "mbot_oled.log")
+        os.makedirs(os.path.dirname(log_file))
+        handler = mbot_logging.BatchedFileHandler(log_file, maxBytes=4096, backupCount=3)
+        handler.setFormatter(logging.Formatter(mbot_logging.LOG_FORMAT))
+        record = logging.makeLogRecord({"levelno": logging.INFO, "levelname": "INFO", "msg": "wlan0 IP changed"})
+        start = write_syscalls()
+        for _ in range(20):
+            handler.handle(record)
+        assert os.path.getsize(log_file) == 0, "BatchedFileHandler wrote before flush_batch()"
+        handler.flush_batch()
+        assert os.path.getsize(log_file) == handler.size > 0
+        batch_syscalls = write_syscalls() - start
+        for _ in range(200):
+            handler.handle(record)
+        handler.close()
+        sizes = [os.path.getsize(path) for path in (log_file, f"{log_file}.1", f"{log_file}.2")]
+        assert all(0 < size <= 4096 for size in sizes), sizes
+        print(f"batched      20 records in {batch_syscalls} write syscalls, rolled over at {sizes[1]} bytes")
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in saved_handlers:
+        root.addHandler(handler)
+    root.setLevel(saved_level)
+
+
+def naive_top(count=3):
+    # Opens and parses every /proc/<pid>/stat on each sample, kernel threads
+    # included.
+    usage = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        fields = stat[stat.rfind(")") + 2:].split()
+        usage.append((int(fields[11]) + int(fields[12]), stat[stat.find("(") + 1:stat.rfind(")")]))
+    usage.sort(reverse=True)
+    return usage[:count]
+
+
+def bench_proctop(args):
+    # The sample cost with the processes of a busy robot and with a few
+    # hundred more, which the screen has to keep up with.
+    top = shutil.which("top")
+    children = []
+    try:
+        children.append(subprocess.Popen([sys.executable, "-c", "while True: pass"]))
+        for extra in (0, 300):
+            while len(children) < extra + 1:
+                children.append(subprocess.Popen(["sleep", "600"]))
+            processes = sum(1 for name in os.listdir("/proc") if name.isdigit())
+            print(f"{processes} processes")
+            if top:
+                report("top -bn1", measure(lambda: subprocess.run([top, "-bn1"], stdout=subprocess.DEVNULL),
+                                           max(args.cycles // 10, 1)))
+            report("naive scan", measure(naive_top, args.cycles))
+            process_top = mbot_sysinfo.ProcessTop()
+            process_top.sample()
+            report("ProcessTop", measure(process_top.sample, args.cycles))
+            time.sleep(0.5)
+            rows = process_top.sample()
+            print(f"  {len(process_top._fds)} stat files kept open (max {process_top.max_open}), top three:")
+            for name, cpu, rss in rows:
+                print(f"    {name:<16} {cpu:5.1f}% {rss:6.1f} MB")
+            process_top.close()
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+def make_recording(path, duration):
+    # A robot on battery: probes at their usual rates, an IP change, the
+    # battery messages stopping for 40% of the time (longer than a rotation
+    # at the default duration), the barrel plug pulled for a while and the
+    # battery running low at the end. Returns the number of records.
+    import random
+    import mbot_replay
+
+    now = [0.0]
+    recorder = mbot_replay.Recorder(path, "lcm", clock=lambda: now[0])
+    rng = random.Random(1)
+    probes = {"uptime": 15, "ssid": 10, "mem": 5, "load_avg": 2, "top": 2, "services": 5}
+    recorder.probe("hostname", "mbot-0042")
+    recorder.ip("192.168.3.14")
+    for step in range(int(duration * 10)):
+        now[0] = step / 10
+        if step == int(duration * 3):
+            recorder.ip("10.0.0.7")
+        phase = now[0] / duration
+        if not 0.3 <= phase < 0.7:
+            if 0.7 <= phase < 0.8:
+                volts = 4.5
+            elif phase >= 0.85:
+                volts = 8.6
+            else:
+                volts = 11.6 - phase * 1.5
+            recorder.battery([0.0, 0.0, 0.0, volts + rng.uniform(-0.05, 0.05), 0.0, 0.0])
+        for key, interval in probes.items():
+            if step % (interval * 10) == 0:
+                if key == "top":
+                    value = [("python3", rng.randint(20, 90), 42), ("mbot-lcm-serial", rng.randint(1, 9), 12)]
+                elif key == "services":
+                    value = {"lidar-drv": "active (running)", "webapp": "active (running)"}
+                elif key == "uptime":
+                    value = f"{int(now[0]) // 60}m"
+                elif key == "ssid":
+                    value = "MBot Lab"
+                elif key == "mem":
+                    value = f"{rng.uniform(30, 40):.2f}%"
+                else:
+                    value = f"{rng.uniform(0, 2):.2f}, 0.37, 0.30"
+                recorder.probe(key, value)
+    recorder.close()
+    return recorder.records
+
+
+def draw_screens(daemon):
+    # [(layout, CRC of the display RAM)] of every screen and page in turn.
+    import zlib
+
+    frames = []
+    for name, render, duration, pages in daemon.scheduler.screens:
+        for page in range(daemon.scheduler._page_count(pages)):
+            render(*(() if pages is None else (page,)))
+            frames.append((daemon.last_frame_key[0], zlib.crc32(daemon.device._serial_interface.ram)))
+    return frames
+
+
+def replay_frames(daemon, records):
+    # Applies the records in recording time and draws what the rotation
+    # shows at every screen change, the low battery alert in place of the
+    # screen while active. Returns [(layout, CRC of the display RAM)] and
+    # draw_screens() after the last record.
+    import zlib
+    import mbot_replay
+
+    sink = mbot_replay.DirectSink(daemon)
+    ram = daemon.device._serial_interface.ram
+    slots = []
+    for name, render, duration, pages in daemon.scheduler.screens:
+        for page in range(daemon.scheduler._page_count(pages)):
+            slots.append((render, () if pages is None else (page,), duration))
+
+    def draw(render, args):
+        render(*args)
+        return daemon.last_frame_key[0], zlib.crc32(ram)
+
+    frames = []
+    next_change = 0.0
+    slot = 0
+    for record in records:
+        while record[0] >= next_change:
+            daemon.clock.sync(next_change, 0)
+            render, args, duration = slots[slot % len(slots)]
+            alert = daemon.scheduler._active_alert()
+            frames.append(draw(alert[1], (0,)) if alert else draw(render, args))
+            next_change += duration
+            slot += 1
+        sink.send(record, 0)
+    daemon.clock.sync(records[-1][0], 0)
+    return frames, draw_screens(daemon)
+
+
+def bench_replay(args):
+    import struct
+    import logging
+    import tempfile
+    import threading
+    import mbot_replay
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    "ros2_mbot_sys_utils", "services"))
+    # The replayed battery timeout warns, and there is no wlan0 here.
+    logging.disable(logging.ERROR)
+    duration = args.cycles * 2
+
+    class AnalogMessage:
+        # mbot_analog_t without mbot_lcm_msgs: int64 utime, int16 raw[6], float volts[6]
+        format = ">q6h6f"
+
+        @staticmethod
+        def decode(data):
+            values = struct.unpack(AnalogMessage.format, data)
+            return mbot_replay.BatteryMessage(values[0], values[7:])
+
+    def new_daemon(module_name, **kwargs):
+        daemon = load_daemon(module_name, replay=True, **kwargs)
+        if daemon is not None:
+            if hasattr(daemon, "mbot_lcm_installed"):
+                daemon.mbot_lcm_installed = True
+                daemon.mbot_analog_t = AnalogMessage
+            else:
+                daemon.battery_support = True
+            daemon.add_screens()
+        return daemon
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "recording.jsonl.gz")
+        count = make_recording(path, duration)
+        _, records = mbot_replay.read_recording(path)
+        size = os.path.getsize(path)
+        print(f"Recording of {duration} s: {len(records)}/{count} records read back, {size} bytes, "
+              f"{size / len(records):.1f} bytes/record, {size / duration * 60 / 1024:.1f} KiB/min")
+
+        # In process, twice, the frames have to come out the same.
+        for name, module_name, kwargs in (("lcm", "mbot_oled_display", {"lcm_url": "memq://"}),
+                                          ("ros2", "mbot_ros_oled_display", {})):
+            runs = []
+            for _ in range(2):
+                daemon = new_daemon(module_name, **kwargs)
+                if daemon is None:
+                    break
+                start = time.perf_counter()
+                runs.append(replay_frames(daemon, records))
+                elapsed = time.perf_counter() - start
+            if len(runs) < 2:
+                print(f"{name:<12} skipped, the daemon could not be created")
+                continue
+            frames = runs[0][0]
+            shown = {}
+            for layout, _ in frames:
+                shown[layout] = shown.get(layout, 0) + 1
+            print(f"{name:<12} direct {len(records) / elapsed:8.0f} records/s   {len(frames)} frames, "
+                  f"{'identical' if runs[0] == runs[1] else 'DIFFERENT'} across runs")
+            print("  " + ", ".join(f"{layout} {n}" for layout, n in sorted(shown.items())))
+            if name == "lcm":
+                direct_final = runs[0][1]
+
+        # Over the LCM loopback into a daemon in replay mode, on its own port
+        # so a robot's own MBOT_ANALOG_IN is not picked up.
+        url = "udpm://239.255.76.67:7668?ttl=0"
+        for speed in (10, 50, 0):
+            try:
+                daemon = new_daemon("mbot_oled_display", lcm_url=url)
+            except Exception as e:
+                print(f"lcm loopback skipped: {e}")
+                break
+            if daemon is None or daemon.lc is None:
+                print("lcm loopback skipped, lcm not installed")
+                break
+            sent = {}
+            latencies = []
+            callback = daemon.battery_info_callback
+
+            def timed_callback(msg):
+                latencies.append(time.perf_counter() - sent[msg.utime])
+                callback(msg)
+            daemon.battery_info_callback = timed_callback
+
+            def encode(record):
+                utime = int(round(record[0] * 1e6))
+                sent[utime] = time.perf_counter()
+                return struct.pack(AnalogMessage.format, utime, *([0] * 6), *mbot_replay.fit(record[2:], [0.0] * 6))
+
+            daemon.start_lcm_receiver()
+            replayer = mbot_replay.Replayer(records, mbot_replay.LcmSink(daemon.lc, encode), speed)
+            thread = threading.Thread(target=replayer.run)
+            thread.start()
+            thread.join()
+            time.sleep(0.2)
+            daemon.lcm_receiver.stop()
+            daemon.clock.sync(records[-1][0], 0)
+            final = draw_screens(daemon)
+            latencies.sort()
+            print(f"lcm {'full' if speed == 0 else f'{speed}x':<8} {replayer.sent / replayer.elapsed:8.0f} records/s   "
+                  f"{len(latencies)}/{len(sent)} battery callbacks, latency p50 "
+                  f"{latencies[len(latencies) // 2] * 1e3:.3f} ms, max {latencies[-1] * 1e3:.3f} ms")
+            matching = sum(a == b for a, b in zip(final, direct_final))
+            print(f"  final battery {daemon.battery_voltage:.2f} V, {matching}/{len(final)} screens "
+                  f"match the direct replay")
+    logging.disable(logging.NOTSET)
+
+
+BENCHMARKS = {
+    "sysinfo": bench_sysinfo,
+    "services": bench_services,
+    "systemd": bench_systemd,
+    "display": bench_display,
+    "glyphs": bench_glyphs,
+    "layout": bench_layout,
+    "qr": bench_qr,
+    "alert": bench_alert,
+    "battery": bench_battery,
+    "lcm": bench_lcm,
+    "rotation": bench_rotation,
+    "metrics": bench_metrics,
+    "logging": bench_logging,
+    "replay": bench_replay,
+    "proctop": bench_proctop,
+    "telemetry": bench_telemetry,
+    "netlink": bench_netlink,
+    "identity": bench_identity,
+    "i2c": bench_i2c,
+    "power": bench_power,
+    "publish": bench_publish,
+    "network": bench_network,
+    "firmware": bench_firmware,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MBot OLED daemon benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    parser.add_argument("--cycles", type=int, default=50)
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS.items():
+        if args.benchmark in (name, "all"):
+            bench(args)
@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+# SSD1306 device that only sends the parts of a frame that changed.
+#
+# luma's ssd1306.display() pushes the whole 1 KB framebuffer over I2C for
+# every frame. This subclass keeps the last frame it sent and, for each
+# 8-pixel page, only writes the column window that differs. Identical frames
+# are not sent at all.
+#
+# Frames that are already packed into pages, e.g. by the NumPy frame buffer
+# in mbot_oled_render.py, are passed to display_pages() and skip the PIL
+# conversion.
+#
+# AsyncSSD1306 moves the bus writes to a writer thread, so a slow or failing
+# I2C bus never holds up drawing.
+#
+# create_device() picks the bus: the real I2C port, or an in-memory SSD1306
+# so the daemons can run and be benchmarked without the hardware.
+import time
+import logging
+import threading
+from PIL import Image
+from luma.oled.device import ssd1306
+
+from mbot_metrics import METRICS
+
+COLUMNADDR = 0x21
+PAGEADDR = 0x22
+
+# SSD1306 pages store the top pixel in the least significant bit, PIL packs
+# mode "1" images most significant bit first.
+REVERSE_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def pack_pages(image, pages):
+    # Transposing turns every display column into a packed row of pixels, so
+    # each byte is one column of one page once the bit order is reversed.
+    data = image.transpose(Image.TRANSPOSE).tobytes().translate(REVERSE_BITS)
+    return [data[page::pages] for page in range(pages)]
+
+
+def changed_window(old, new):
+    # First and last differing column of a page, or None when identical.
+    if old == new:
+        return None
+    first = 0
+    while old[first] == new[first]:
+        first += 1
+    last = len(new) - 1
+    while old[last] == new[last]:
+        last -= 1
+    return first, last
+
+
+class DiffingSSD1306(ssd1306):
+    def __init__(self, serial_interface=None, **kwargs):
+        # Set before ssd1306.__init__, which already displays a blank frame.
+        self._last_pages = None
+        self.reset_stats()
+        super().__init__(serial_interface, **kwargs)
+
+    def reset_stats(self):
+        self.frames = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.frame_time_total = 0.0
+        self.frame_time_max = 0.0
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return {
+            "frames": self.frames,
+            "frames_skipped": self.frames_skipped,
+            "bytes_sent": self.bytes_sent,
+            "bytes_per_frame": self.bytes_sent / frames,
+            "frame_time_avg_ms": self.frame_time_total / frames * 1e3,
+            "frame_time_max_ms": self.frame_time_max * 1e3,
+        }
+
+    def invalidate(self):
+        # Force the next frame to be sent in full, e.g. after a bus error.
+        self._last_pages = None
+
+    def display(self, image):
+        assert image.mode == self.mode
+        assert image.size == self.size
+        self._send(image, METRICS.screen)
+
+    def display_pages(self, pages):
+        # pages as pack_pages() returns them, for an unrotated display.
+        assert len(pages) == self._pages
+        self._send(list(pages), METRICS.screen)
+
+    def _send(self, frame, screen):
+        # frame is a PIL image or a list of packed pages.
+        start = time.perf_counter()
+        if isinstance(frame, list):
+            pages = frame
+        else:
+            pages = pack_pages(self.preprocess(frame), self._pages)
+        try:
+            if self._last_pages is None:
+                self._write_window(0, self._pages - 1, 0, self._w - 1, b"".join(pages))
+            else:
+                sent = False
+                for page, (old, new) in enumerate(zip(self._last_pages, pages)):
+                    window = changed_window(old, new)
+                    if window is not None:
+                        first, last = window
+                        self._write_window(page, page, first, last, new[first:last + 1])
+                        sent = True
+                if not sent:
+                    self.frames_skipped += 1
+        except Exception:
+            self._last_pages = None
+            raise
+        self._last_pages = pages
+
+        elapsed = time.perf_counter() - start
+        self.frames += 1
+        self.frame_time_total += elapsed
+        self.frame_time_max = max(self.frame_time_max, elapsed)
+        METRICS.observe(f"flush.{screen}", elapsed)
+
+    def _write_window(self, page_start, page_end, col_start, col_end, data):
+        cmd = (self._const.COLUMNADDR, self._colstart + col_start, self._colstart + col_end,
+               self._const.PAGEADDR, page_start, page_end)
+        with METRICS.timer("i2c_write"):
+            self.command(*cmd)
+            self.data(list(data))
+        self.bytes_sent += len(cmd) + len(data)
+
+
+class AsyncSSD1306(DiffingSSD1306):
+    # display() only hands the frame to a writer thread and returns. Frames
+    # drawn while a write is in flight replace each other, so only the newest
+    # one is sent next. Bus errors are retried with exponential backoff on
+    # the writer thread.
+    def __init__(self, serial_interface=None, retry_delay=0.05, max_retry_delay=2.0, **kwargs):
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._pending = None
+        self._writing = False
+        self._writer = None
+        self._cond = threading.Condition()
+        # Held for a whole frame so other commands (e.g. contrast) are not
+        # interleaved with its windows.
+        self._bus_lock = threading.RLock()
+        # The constructor's init commands and blank frame are sent synchronously.
+        super().__init__(serial_interface, **kwargs)
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def reset_stats(self):
+        super().reset_stats()
+        self.frames_coalesced = 0
+        self.write_errors = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats["frames_coalesced"] = self.frames_coalesced
+        stats["write_errors"] = self.write_errors
+        return stats
+
+    def command(self, *cmd):
+        with self._bus_lock:
+            super().command(*cmd)
+
+    def data(self, data):
+        with self._bus_lock:
+            super().data(data)
+
+    def display(self, image):
+        assert image.mode == self.mode
+        assert image.size == self.size
+        self._queue(image)
+
+    def display_pages(self, pages):
+        assert len(pages) == self._pages
+        self._queue(list(pages))
+
+    def _queue(self, frame):
+        if self._writer is None:
+            # After cleanup(), waiting for a frame the writer may still be draining
+            with self._bus_lock:
+                self._send(frame, METRICS.screen)
+            return
+        with self._cond:
+            if self._pending is not None:
+                self.frames_coalesced += 1
+            self._pending = (frame, METRICS.screen)
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        # Wait until the newest frame has been written. Returns False on timeout.
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending is None and not self._writing, timeout)
+
+    def cleanup(self):
+        # luma clears the screen on exit, send that frame before closing the bus.
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            self.flush(self.max_retry_delay)
+            with self._cond:
+                self._pending = None
+                self._cond.notify_all()
+        super().cleanup()
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or self._writer is None)
+                if self._pending is None:
+                    # Stopped, and the last frame has been sent
+                    return
+                (frame, screen), self._pending = self._pending, None
+                self._writing = True
+            try:
+                with self._bus_lock:
+                    self._send(frame, screen)
+                delay = self.retry_delay
+                failed = False
+            except Exception as e:
+                self.write_errors += 1
+                METRICS.count("i2c_error")
+                if delay == self.retry_delay:
+                    logging.error(f"OLED write failed, retrying: {e}")
+                failed = True
+
+            with self._cond:
+                self._writing = False
+                if failed and self._pending is None and self._writer is not None:
+                    # Retry this frame unless a newer one arrived meanwhile,
+                    # or the device is being cleaned up.
+                    self._pending = (frame, screen)
+                self._cond.notify_all()
+            if failed:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+
+class MemorySerial:
+    # Stands in for the I2C interface and keeps a copy of the SSD1306 display
+    # RAM, following the column and page windows set by the driver.
+    def __init__(self, width=128, height=64):
+        self.width = width
+        self.pages = height // 8
+        self.ram = bytearray(width * self.pages)
+        self.bytes_sent = 0
+        self._col_range = (0, width - 1)
+        self._page_range = (0, self.pages - 1)
+        self._col = 0
+        self._page = 0
+
+    def command(self, *cmd):
+        self.bytes_sent += len(cmd)
+        # Only the address window commands matter for the RAM contents.
+        if len(cmd) == 6 and cmd[0] == COLUMNADDR and cmd[3] == PAGEADDR:
+            self._col_range = (cmd[1], cmd[2])
+            self._page_range = (cmd[4], cmd[5])
+            self._col, self._page = cmd[1], cmd[4]
+
+    def data(self, data):
+        self.bytes_sent += len(data)
+        for byte in data:
+            self.ram[self._page * self.width + self._col] = byte
+            self._col += 1
+            if self._col > self._col_range[1]:
+                self._col = self._col_range[0]
+                self._page += 1
+                if self._page > self._page_range[1]:
+                    self._page = self._page_range[0]
+
+    def to_image(self):
+        # Inverse of pack_pages(): the display RAM as a mode "1" image.
+        data = bytearray(len(self.ram))
+        for page in range(self.pages):
+            data[page::self.pages] = self.ram[page * self.width:(page + 1) * self.width]
+        transposed = Image.frombytes("1", (self.pages * 8, self.width), bytes(data.translate(REVERSE_BITS)))
+        return transposed.transpose(Image.TRANSPOSE)
+
+    def cleanup(self):
+        pass
+
+
+def create_device(backend="i2c"):
+    if backend == "i2c":
+        from luma.core.interface.serial import i2c
+        return AsyncSSD1306(i2c(port=1, address=0x3C))
+    if backend == "memory":
+        return DiffingSSD1306(MemorySerial())
+    raise ValueError(f"Unknown display backend: {backend}")
@@ -1,18 +1,26 @@
 #!/usr/bin/python3
 import os
-import re
 import time
-import qrcode
-import math
+import errno
 import logging
-import lcm
-import subprocess
 import threading
-from luma.core.interface.serial import i2c
-from luma.core.render import canvas
-from luma.oled.device import ssd1306
 from PIL import ImageFont
-from logging.handlers import RotatingFileHandler
+
+import mbot_sysinfo
+import mbot_battery as battery
+from mbot_oled_device import create_device
+from mbot_oled_layout import LayoutPainter
+from mbot_service_monitor import ServiceMonitor, parse_service_list
+from mbot_sampler import SnapshotCache, Sampler
+from mbot_scheduler import ScreenScheduler
+from mbot_lcm_receiver import LatestMessageReceiver
+from mbot_metrics import METRICS, METRICS_FILE, MetricsWriter
+from mbot_logging import setup_logging
+from mbot_telemetry import HEALTH_CHANNEL, HealthPublisher, health_message
+from mbot_netlink import AddressMonitor
+from mbot_power import PowerPolicy
+from mbot_config import Identity
+from mbot_replay import REPLAY_CHANNEL, Recorder, ReplayClock, apply_record, decode_record
 
 # Battery = -1 means no message received
 # Battery in (0, 1.5) means missing jumper cap
@@ -21,6 +29,12 @@ from logging.handlers import RotatingFileHandler
 # Battery in (7, 12) means the jumper cap is on 12 V
 
 # Define constants
+FONT_PATH = "/usr/local/etc/arial.ttf"
+LCM_URL = "udpm://239.255.76.67:7667?ttl=0"
+METRICS_INTERVAL = 10  # How often the metrics file is rewritten, in seconds
+HEALTH_RATE = 1  # Health messages published per second, 0 to disable
+IDLE_DIM_AFTER = 600  # Seconds without events before the display dims and slows down, 0 to disable
+IDLE_OFF_AFTER = 0  # Seconds without events before the display switches off, 0 to disable
 SCREEN_CHANGE_DELAY = 3
 QR_SCREEN_CHANGE_DELAY = 8
 FLASH_INTERVAL = 0.4  # Flash interval in seconds
@@ -35,44 +49,146 @@ UNPLUG_BARREL_LOW = 3.5
 NO_CAP_HIGH = 1.5
 NO_CAP_LOW = 0
 
-# Setup logging
-log_file = "/var/log/mbot/mbot_oled.log"
-os.makedirs(os.path.dirname(log_file), exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3),
-        logging.StreamHandler()
-    ]
-)
+# How long each screen (or each page of the services screen) is shown, in seconds
+SCREEN_DURATIONS = {
+    "wifi": SCREEN_CHANGE_DELAY,
+    "battery": SCREEN_CHANGE_DELAY,
+    "qr": QR_SCREEN_CHANGE_DELAY,
+    "resources": SCREEN_CHANGE_DELAY,
+    "top": SCREEN_CHANGE_DELAY,
+    "services": SCREEN_CHANGE_DELAY,
+}
+
+# Units shown on the services screen as (systemd unit, short name). Can be
+# overridden with mbot_oled_services=unit:short,... in mbot_config.txt.
+DEFAULT_SERVICES = [
+    ("mbot-start-network", "start-net"),
+    ("mbot-publish-info", "pub-info"),
+    ("mbot-rplidar-driver", "lidar-drv"),
+    ("mbot-lcm-serial", "lcm-ser"),
+    ("mbot-web-server", "webapp"),
+    ("mbot-motion-controller", "motion"),
+    ("mbot-slam", "slam"),
+    ("mbot-oled", "oled"),
+]
+
 
 class MBotOLED:
-    def __init__(self):
-        # Initialize OLED device and fonts
+    def __init__(self, backend="i2c", lcm_url=LCM_URL, health_rate=HEALTH_RATE,
+                 dim_after=IDLE_DIM_AFTER, off_after=IDLE_OFF_AFTER, record=None, replay=False):
+        # Initialize OLED device and the font the splash screen needs
         try:
-            self.device = ssd1306(i2c(port=1, address=0x3C))
-            self.font_large = ImageFont.truetype("/usr/local/etc/arial.ttf", 18)
-            self.font = ImageFont.truetype("/usr/local/etc/arial.ttf", 14)
-            self.font_small = ImageFont.truetype("/usr/local/etc/arial.ttf", 10)
-            self.font_medium = ImageFont.truetype("/usr/local/etc/arial.ttf", 12)
+            self.device = create_device(backend)
+            self.font = ImageFont.truetype(FONT_PATH, 14)
         except Exception as e:
             logging.error(f"Initialization failed: {e}")
             self.device = None
             self.font = None
+        self.font_small = None
+        self.last_frame_key = None
+        # Draws the screens in mbot_oled_layout.py, fonts are added as they are loaded
+        self.painter = LayoutPainter(self.device, {"regular": self.font})
+
+        # The config and hostname are read once and watched once main_loop starts
+        self.identity = Identity(on_change=self.identity_changed)
+
+        # The IP is tracked from kernel notifications once main_loop starts
+        self.address_monitor = AddressMonitor(on_change=self.address_changed)
+
+        # Show the hostname and IP before anything slow is loaded
+        self.ip_str = self.get_wlan0_ip()
+        self.show_splash()
+
+        try:
+            self.font_large = ImageFont.truetype(FONT_PATH, 18)
+            self.font_small = ImageFont.truetype(FONT_PATH, 10)
+            self.font_medium = ImageFont.truetype(FONT_PATH, 12)
+            self.painter.fonts.update(small=self.font_small, medium=self.font_medium, large=self.font_large)
+        except Exception as e:
+            logging.error(f"Initialization failed: {e}")
             self.font_small = None
 
+        # Text is drawn from glyphs rasterized once instead of on every frame
+        if self.device and self.font_small:
+            self.painter.frame = self.create_frame_buffer()
+
         # Set up LCM if available
-        self.lc = lcm.LCM("udpm://239.255.76.67:7667?ttl=0") if lcm else None
+        self.lc = self.setup_lcm(lcm_url)
+        self.lcm_receiver = None
+        self.health_rate = health_rate
+        self.health_publisher = None
         self.battery_voltage = -1
-        self.ip_str = "IP Not Found"
         self.mbot_lcm_installed = self.check_mbot_lcm_installed()
-        self.low_battery_flag = False
+
+        # Filtered battery voltage with hysteresis on the screen thresholds
+        self.battery = battery.BatteryHistory(
+            battery.battery_regions(JUMPER_6V_LOW, JUMPER_6V_HIGH, UNPLUG_BARREL_LOW, UNPLUG_BARREL_HIGH,
+                                    NO_CAP_LOW, NO_CAP_HIGH, BATTERY_LIMIT_LOW),
+            empty_voltage=BATTERY_LIMIT_LOW
+        )
+
+        # Service states are fetched in one batch and kept current from systemd signals
+        self.services = parse_service_list(self.identity.get("mbot_oled_services", "")) or DEFAULT_SERVICES
+        self.service_monitor = ServiceMonitor([unit for unit, _ in self.services], on_change=self.service_changed)
+        # Short names on each page of the services screen, three per page
+        self.service_pages = [[short for _, short in self.services[i:i + 3]] for i in range(0, len(self.services), 3)]
+
+        # The inputs can be recorded to a file and replayed, see mbot_replay.py.
+        # While replaying, the clock follows the recording time.
+        self.replay = replay
+        self.clock = ReplayClock() if replay else time.monotonic
+        self.recorder = Recorder(record, "lcm", self.clock) if record else None
+
+        # Probes run on a background sampler; the screens only read the cache
+        self.cache = SnapshotCache()
+        self.sampler = Sampler(self.cache, on_sample=self.recorder.probe if self.recorder else None)
+        # Keeps the process table between samples of the top processes screen
+        self.process_top = mbot_sysinfo.ProcessTop()
+
+        # QR bitmap is rebuilt only when the IP changes.
+        # Imported here since qrcode is slow to import and not needed for the splash.
+        from mbot_oled_graphics import QRCodeCache
+        self.qr_cache = QRCodeCache(48)
+
+        # The display dims and slows down when nothing happens for a while
+        self.power = PowerPolicy(self.device, dim_after, off_after) if self.device else None
+
+        # Screens rotate on a deadline scheduler that alerts can preempt
+        self.scheduler = ScreenScheduler(on_rotation=self.start_rotation, power=self.power)
 
         # Track the last received message time
-        self.last_message_time = time.time()
+        self.last_message_time = self.clock()
         self.message_timeout = 10  # Set a threshold in seconds to detect message timeout
 
+    def show_splash(self):
+        if self.font:
+            self.show("splash", hostname=self.get_hostname(), ip=self.ip_str)
+        try:
+            logging.info(f"First frame drawn {mbot_sysinfo.get_process_age():.2f} s after process start")
+        except (OSError, ValueError, IndexError) as e:
+            logging.error(f"Failed to get process start time: {e}")
+
+    def create_frame_buffer(self):
+        # numpy is imported here, after the splash, as it is slow to load
+        try:
+            from mbot_oled_render import FrameBuffer
+        except ImportError:
+            logging.warning("numpy not installed. The screens are drawn with PIL.")
+            return None
+        frame = FrameBuffer(DIS_WIDTH, DIS_HEIGHT)
+        for font in self.painter.fonts.values():
+            frame.add_font(font)
+        return frame
+
+    def setup_lcm(self, lcm_url):
+        # lcm is imported here, after the splash, as it is slow to load
+        try:
+            import lcm
+        except ImportError:
+            logging.warning("lcm not installed. Battery information will not be available.")
+            return None
+        return lcm.LCM(lcm_url)
+
     def check_mbot_lcm_installed(self):
         try:
             from mbot_lcm_msgs.mbot_analog_t import mbot_analog_t
@@ -82,237 +198,241 @@ class MBotOLED:
             logging.warning("ImportError. Battery information will not be available.")
             return False
 
-    def draw(self, draw_func):
+    def start_sampler(self):
+        # Each value is refreshed at its own rate (seconds)
+        self.sampler.add("uptime", self.get_uptime, 15)
+        self.sampler.add("ssid", self.get_connected_ssid, 10)
+        if not self.address_monitor.running:
+            self.sampler.add("ip", self.get_wlan0_ip, 5)
+        self.sampler.add("mem", self.get_mem_free, 5)
+        self.sampler.add("load_avg", self.get_load_avg, 2)
+        self.sampler.add("top", self.get_top_processes, 2)
+        self.sampler.add("services", self.get_services, 5)
+        self.sampler.start()
+
+    def show(self, layout, **values):
+        # Draws a layout with its fields set to values. A frame showing the
+        # same as the last one is not drawn again.
         if self.device:
-            with canvas(self.device) as draw:
-                draw_func(draw)
+            if (layout, values) == self.last_frame_key:
+                METRICS.count("frames_unchanged")
+                return
+            self.last_frame_key = (layout, values)
+            self.painter.paint(layout, values)
 
     # Information Fetching Methods
     def get_hostname(self):
-        try:
-            return subprocess.check_output(["hostname"]).decode().strip()
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to get hostname: {e}")
-            return "Error"
+        return self.identity.hostname()
 
     def get_uptime(self):
         try:
-            uptime_output = subprocess.check_output(["uptime", "-p"]).decode().strip()
-            pattern = r'up (\d+) hour[s]*, (\d+) minute[s]*|up (\d+) minute[s]*'
-            match = re.match(pattern, uptime_output)
-
-            if match:
-                hours, minutes, minutes_only = match.groups()
-                return f'{minutes_only}m' if minutes_only else f'{hours}h{minutes}m'
-            else:
-                return uptime_output[3:]
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_uptime()
+        except (OSError, ValueError, IndexError) as e:
             logging.error(f"Failed to get uptime: {e}")
             return "Error"
 
     def get_connected_ssid(self):
         try:
-            return subprocess.check_output(["iwgetid", "-r"]).decode().strip() or "N/A"
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_connected_ssid() or "N/A"
+        except OSError as e:
             logging.error(f"Failed to get connected SSID: {e}")
             return "Error"
 
     def get_mem_free(self):
         try:
-            mem_output = subprocess.check_output("free -m | awk 'NR==2{printf \"%.2f%%\", $3*100/$2 }'", shell=True).decode().strip()
-            return mem_output
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_mem_used_percent()
+        except (OSError, ValueError, KeyError) as e:
             logging.error(f"Failed to get memory usage: {e}")
             return "Error"
 
     def get_load_avg(self):
         try:
-            load_output = subprocess.check_output(["top", "-bn1"]).decode()
-            return re.search(r'load average: (.*)', load_output).group(1)
-        except (subprocess.CalledProcessError, AttributeError) as e:
+            return mbot_sysinfo.get_load_avg()
+        except (OSError, ValueError) as e:
             logging.error(f"Failed to get load average: {e}")
             return "Error"
 
+    def get_top_processes(self):
+        try:
+            return [(name, round(cpu), round(rss)) for name, cpu, rss in self.process_top.sample()]
+        except (OSError, ValueError, IndexError) as e:
+            logging.error(f"Failed to get top processes: {e}")
+            return []
+
     def get_wlan0_ip(self):
+        if self.address_monitor.running:
+            return self.address_monitor.get_address("wlan0") or "IP Not Found"
         try:
-            command_output = subprocess.check_output(["ifconfig", "wlan0"]).decode()
-            ip_match = re.search(r'inet ([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)', command_output)
-            self.ip_str = ip_match.group(1) if ip_match else "IP Not Found"
-        except subprocess.CalledProcessError as e:
+            return mbot_sysinfo.get_interface_ip("wlan0")
+        except OSError as e:
+            if e.errno == errno.EADDRNOTAVAIL:
+                return "IP Not Found"
             logging.error(f"Failed to get wlan0 IP: {e}")
-            self.ip_str = "Error"
+            return "Error"
 
     def get_services(self):
         try:
-            services = ["mbot-start-network", "mbot-publish-info", "mbot-rplidar-driver",
-                        "mbot-lcm-serial", "mbot-web-server", "mbot-motion-controller", "mbot-slam", "mbot-oled"]
-            serv_short_names = ["start-net", "pub-info", "lidar-drv", "lcm-ser", "webapp", "motion", "slam", "oled"]
-            result = {}
-
-            for i, service in enumerate(services):
-                try:
-                    # Capture the status using subprocess and extract the third line equivalent
-                    serv_status = subprocess.check_output(
-                        f"systemctl status {service} | head -3 | tail -1",
-                        shell=True,
-                        stderr=subprocess.DEVNULL
-                    ).decode().strip()
-
-                    if not serv_status:
-                        result[serv_short_names[i]] = "not found"
-                    else:
-                        keywords = ["loaded", "failed", "active", "inactive"]
-                        parts = serv_status.split()
-                        activity_str = parts[1] if len(parts) > 1 and parts[1] in keywords else parts[2] if len(parts) > 2 else "unknown"
-                        result[serv_short_names[i]] = activity_str
-
-                        if activity_str != "failed" and len(parts) > 2:
-                            result[serv_short_names[i]] += f" {parts[2]}"
-                        elif activity_str == "failed" and len(parts) > 3:
-                            result[serv_short_names[i]] += f" ({parts[3]})"
-
-                except subprocess.CalledProcessError:
-                    result[serv_short_names[i]] = "failed"
-
-            return result
-
+            states = self.service_monitor.get_states()
+            return {short: states[unit] for unit, short in self.services}
         except Exception as e:
             logging.error(f"Failed to get services: {e}")
             return {}
 
+    def address_changed(self, ifname):
+        # Called by the address monitor, a new IP is shown right away
+        self.ip_changed(self.get_wlan0_ip())
+
+    def ip_changed(self, ip_str):
+        # Also called with the recorded addresses while replaying
+        if self.recorder:
+            self.recorder.ip(ip_str)
+        # No expiry, the value is only replaced on the next change
+        self.cache.set("ip", ip_str, float("inf"))
+        if ip_str != self.ip_str:
+            logging.info(f"wlan0 IP changed to {ip_str}")
+            self.ip_str = ip_str
+            self.wake("IP change")
+            self.scheduler.redraw()
+
+    def identity_changed(self, name):
+        # Called by the identity watcher when /etc/hostname or the config changed
+        if name == "hostname":
+            hostname = self.get_hostname()
+            logging.info(f"Hostname changed to {hostname}")
+            self.set_hostname(hostname)
+            self.wake("hostname change")
+            self.scheduler.redraw()
+        elif name == "config":
+            services = parse_service_list(self.identity.get("mbot_oled_services", "")) or DEFAULT_SERVICES
+            if services != self.services:
+                logging.info("mbot_oled_services changed, restart mbot-oled to apply")
+
+    def service_changed(self, unit, state):
+        # Called by the service monitor when a unit changes state
+        if state.startswith("failed"):
+            logging.warning(f"{unit} {state}")
+            self.wake(f"{unit} failure")
+            self.scheduler.notify()
+
+    def set_hostname(self, hostname):
+        # No expiry, the value is only replaced when /etc/hostname changes
+        self.cache.set("hostname", hostname, float("inf"))
+        if self.recorder:
+            self.recorder.probe("hostname", hostname)
+
+    def replay_message(self, channel, data):
+        # Called from the LCM thread with the records mbot_replay.py sends
+        try:
+            apply_record(self, decode_record(data))
+        except Exception as e:
+            logging.error(f"Failed to apply replayed record: {e}")
+
+    def wake(self, reason):
+        if self.power:
+            self.power.wake(reason)
+
+    def get_health(self):
+        return health_message(self.cache.snapshot(), self.battery_voltage)
 
-    def battery_info_callback(self, channel, data):
+    def battery_info_callback(self, battery_info):
+        # Called by the LCM receiver with only the latest decoded message
+        METRICS.count("callback.battery")
         if self.mbot_lcm_installed:
-            battery_info = self.mbot_analog_t.decode(data)
-            self.battery_voltage = battery_info.volts[3]
-            if self.battery_voltage < BATTERY_LIMIT_LOW and self.battery_voltage > JUMPER_6V_HIGH:
-                self.low_battery_flag = True
+            if self.recorder:
+                self.recorder.battery(battery_info.volts)
+            was_low = self.battery.region == battery.LOW
+            self.battery.add(self.clock(), battery_info.volts[3])
+            self.battery_voltage = self.battery.voltage
+            if self.battery.region == battery.LOW and not was_low:
+                # Wake the scheduler so the alert is shown right away
+                self.scheduler.notify()
 
-        self.last_message_time = time.time()
+        self.last_message_time = self.clock()
 
     # Screen Display Methods
     def display_wifi_info(self):
-        ssid = self.get_connected_ssid()
-        hostname = self.get_hostname()
-        uptime = self.get_uptime()
-
-        def draw_wifi(draw):
-            draw.text((1, 1), hostname, font=self.font, fill="white")
-            draw.text((1, 17), f"SSID: {ssid}", font=self.font, fill="white")
-            draw.text((1, 33), f"Uptime: {uptime}", font=self.font_small, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-        self.draw(draw_wifi)
+        self.show("wifi", hostname=self.cache.get("hostname", "..."), ssid=self.cache.get("ssid", "..."),
+                  uptime=self.cache.get("uptime", "..."), ip=self.ip_str)
 
     def display_qr_code(self):
-        qr_img = self.get_qr_code(f"http://{self.ip_str}")
-        qr_x_pos = (DIS_WIDTH - 48) # right aligned
-
-        def draw_qr(draw):
-            draw.text((1, 1), "WebApp", font=self.font, fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.bitmap((qr_x_pos, 0), qr_img, fill="white")
-        self.draw(draw_qr)
+        # The bitmap is the same object until the IP changes
+        self.show("qr", qr=self.get_qr_code(f"http://{self.ip_str}"), ip=self.ip_str)
 
     def get_qr_code(self, ip_str):
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(ip_str)
-        qr.make(fit=True)
-        return qr.make_image(fill_color="black", back_color="white").resize((48, 48))
+        return self.qr_cache.get(ip_str)
 
     def display_resources(self):
-        mem_str = self.get_mem_free()
-        load_avg_str = self.get_load_avg()
-
-        def draw_resources(draw):
-            draw.text((1, 1), "Load Average: ", font=self.font_small, fill="white")
-            draw.text((20, 17), load_avg_str, font=self.font_small, fill="white")
-            draw.text((1, 33), f"RAM Used: {mem_str}", font=self.font_small, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-        self.draw(draw_resources)
-
-    def display_services(self):
-        services = self.get_services()
-        serv_short_names = ["start-net", "pub-info", "lidar-drv", "lcm-ser", "webapp", "motion", "slam", "oled"]
-        n_screens = math.ceil(len(services) / 3)
-
-        for i in range(n_screens):
-            def draw_services(draw):
-                draw.text((1, 1), f"{serv_short_names[3*i]}: {services.get(serv_short_names[3*i], 'not found')}", font=self.font_small, fill="white")
-                if 3*i+1 < len(services):
-                    draw.text((1, 17), f"{serv_short_names[3*i+1]}: {services.get(serv_short_names[3*i+1], 'not found')}", font=self.font_small, fill="white")
-                if 3*i+2 < len(services):
-                    draw.text((1, 33), f"{serv_short_names[3*i+2]}: {services.get(serv_short_names[3*i+2], 'not found')}", font=self.font_small, fill="white")
-                draw.line((0, 48, 127, 48), fill="white")
-                draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-            self.draw(draw_services)
-            time.sleep(SCREEN_CHANGE_DELAY)
+        self.show("resources", load_avg=self.cache.get("load_avg", "..."), mem=self.cache.get("mem", "..."),
+                  ip=self.ip_str)
+
+    def display_top_processes(self):
+        rows = {f"row{row}": process for row, process in enumerate(self.cache.get("top", []))}
+        self.show("top", ip=self.ip_str, **rows)
+
+    def services_page_count(self):
+        return len(self.service_pages)
+
+    def display_services(self, i):
+        services = self.cache.get("services", {})
+        rows = {f"row{row}": (short, services.get(short, "not found"))
+                for row, short in enumerate(self.service_pages[i])}
+        self.show("services", ip=self.ip_str, **rows)
 
     def display_battery_info(self):
         # Check for message timeout
         if self.mbot_lcm_installed:
             self.check_message_timeout()
-        def draw_battery(draw):
-            if self.mbot_lcm_installed:
-                if self.battery_voltage < JUMPER_6V_HIGH and self.battery_voltage > JUMPER_6V_LOW:
-                    draw.text((1, 1), "Voltage Select Jumper 6V", font=self.font_small, fill="white")
-                    draw.text((1, 24), f"Motor Volt: {self.battery_voltage:.2f} V", font=self.font_medium, fill="white")
-                elif self.battery_voltage < UNPLUG_BARREL_HIGH and self.battery_voltage > UNPLUG_BARREL_LOW:
-                    draw.text((1, 1), f"Control Board", font=self.font, fill="white")
-                    draw.text((1, 24), f"Not Powered", font=self.font, fill="white")
-                elif self.battery_voltage < NO_CAP_HIGH and self.battery_voltage > NO_CAP_LOW:
-                    draw.text((1, 1), f"Voltage Select Jumper", font=self.font_small, fill="white")
-                    draw.text((1, 24), f"Not Detected", font=self.font_medium, fill="white")
-                elif self.battery_voltage == -1:
-                    draw.text((1, 1), "Battery Info", font=self.font, fill="white")
-                    draw.text((1, 24), f"Voltage: ???", font=self.font, fill="white")
-                else:
-                    draw.text((1, 1), "Battery Info", font=self.font, fill="white")
-                    draw.text((1, 24), f"Voltage: {self.battery_voltage:.2f} V", font=self.font, fill="white")
+        region = self.battery.region
+        voltage = round(self.battery_voltage, 2)
+
+        if not self.mbot_lcm_installed:
+            self.show("battery_unavailable", ip=self.ip_str)
+        elif region == battery.JUMPER_6V:
+            self.show("battery_6v", voltage=voltage, ip=self.ip_str)
+        elif region == battery.UNPLUGGED:
+            self.show("battery_unplugged", ip=self.ip_str)
+        elif region == battery.NO_CAP:
+            self.show("battery_no_cap", ip=self.ip_str)
+        elif self.battery_voltage == -1:
+            self.show("battery_unknown", ip=self.ip_str)
+        else:
+            trend = self.get_battery_trend()
+            if trend:
+                self.show("battery_trend", voltage=voltage, trend=trend, ip=self.ip_str)
             else:
-                draw.text((1, 24), "Not Available", font=self.font, fill="white")
-            draw.line((0, 48, 127, 48), fill="white")
-            draw.text((1, 49), self.ip_str, font=self.font, fill="white")
-        self.draw(draw_battery)
+                self.show("battery", voltage=voltage, ip=self.ip_str)
 
     def check_message_timeout(self):
-        current_time = time.time()
+        current_time = self.clock()
         if current_time - self.last_message_time > self.message_timeout:
             logging.warning("No new LCM messages received for a while.")
             self.battery_voltage = -1
+            self.battery.invalidate()
+
+    def get_battery_trend(self):
+        # "-0.42 V/h, 3h05m left" while discharging, None otherwise
+        time_left = self.battery.time_to_empty()
+        if time_left is None:
+            return None
+        hours, minutes = divmod(int(time_left) // 60, 60)
+        return f"{-self.battery.discharge_rate():.2f} V/h, {hours}h{minutes:02d}m left"
+
+    def flash_message(self, message, invert):
+        # Toggle inversion by switching text and background colors
+        self.show("alert_inverted" if invert else "alert", message=message)
+
+    def low_battery_active(self):
+        # Stop flashing if the battery messages stop as well
+        if self.clock() - self.last_message_time > self.message_timeout:
+            return False
+        return self.mbot_lcm_installed and self.battery.region == battery.LOW
 
-    def flash_message(self, message):
-        invert = False
-        while True:
-            # Toggle inversion by switching text and background colors
-            if invert:
-                # Draw inverted (white background, black text)
-                self.draw(lambda draw: (
-                    draw.rectangle(self.device.bounding_box, outline="white", fill="white"),
-                    draw.text((1, 20), message, font=self.font_large, fill="black")
-                ))
-            else:
-                # Draw normal (black background, white text)
-                self.draw(lambda draw: draw.text((1, 20), message, font=self.font_large, fill="white"))
-
-            # Toggle invert flag and pause for FLASH_INTERVAL
-            invert = not invert
-            time.sleep(FLASH_INTERVAL)
-            if self.battery_voltage < JUMPER_6V_HIGH:
-                self.low_battery_flag = False
-                break
-
-    def lcm_thread_func(self):
-        while True:
-            if self.lc:
-                self.lc.handle_timeout(10)
+    def start_rotation(self):
+        # Called by the scheduler each time the rotation starts over
+        self.ip_str = self.cache.get("ip", self.ip_str)
+        logging.debug(f"OLED frame stats: {self.device.stats()}")
+        if self.lcm_receiver:
+            logging.debug(f"LCM receive stats: {self.lcm_receiver.stats()}")
 
     def main_loop(self):
         if self.device is None or self.font is None or self.font_small is None:
@@ -320,34 +440,63 @@ class MBotOLED:
             return
 
         if self.lc:
-            self.lc.subscribe("MBOT_ANALOG_IN", self.battery_info_callback)
-            lcm_thread = threading.Thread(target=self.lcm_thread_func)
-            lcm_thread.daemon = True
-            lcm_thread.start()
-
-        while True:
-            try:
-                if self.mbot_lcm_installed and self.low_battery_flag:
-                    self.flash_message("LOW BATTERY")
-
-                self.get_wlan0_ip()
-
-                self.display_wifi_info()
-                time.sleep(SCREEN_CHANGE_DELAY)
-                self.display_battery_info()
-                time.sleep(SCREEN_CHANGE_DELAY)
-                self.display_qr_code()
-                time.sleep(QR_SCREEN_CHANGE_DELAY)
-                self.display_resources()
-                time.sleep(SCREEN_CHANGE_DELAY)
-                self.display_services()
-                time.sleep(SCREEN_CHANGE_DELAY)
-
-            except Exception as e:
-                logging.error(f"Unhandled exception during main loop: {e}")
-                time.sleep(5)
-                continue
+            self.start_lcm_receiver()
+
+        METRICS.add_source("display", self.device.stats)
+        METRICS.add_source("power", self.power.stats)
+        MetricsWriter(path=os.environ.get("MBOT_OLED_METRICS", METRICS_FILE), interval=METRICS_INTERVAL).start()
+
+        self.identity.start()
+        self.set_hostname(self.get_hostname())
+        if self.replay:
+            # The IP, probe outputs and battery messages come from mbot_replay.py
+            if self.lc:
+                logging.info(f"Replay mode, waiting for records on {REPLAY_CHANNEL}")
+            else:
+                logging.error("Replay mode needs lcm, nothing will be replayed.")
+        else:
+            if self.address_monitor.start():
+                self.address_changed("wlan0")
+            self.service_monitor.refresh()
+            self.service_monitor.start()
+            self.start_sampler()
+        self.start_health_publisher()
+        self.add_screens()
+        self.scheduler.run()
+
+    def start_lcm_receiver(self):
+        decode = self.mbot_analog_t.decode if self.mbot_lcm_installed else None
+        self.lcm_receiver = LatestMessageReceiver(self.lc, "MBOT_ANALOG_IN", decode, self.battery_info_callback)
+        if self.replay:
+            # Handled on the receiver's thread, in order with the battery messages
+            self.lc.subscribe(REPLAY_CHANNEL, self.replay_message)
+        lcm_thread = threading.Thread(target=self.lcm_receiver.run)
+        lcm_thread.daemon = True
+        lcm_thread.start()
+        METRICS.add_source("lcm", self.lcm_receiver.stats)
+
+    def start_health_publisher(self):
+        # Other processes read the sampled values from here instead of probing themselves
+        if self.lc and self.health_rate > 0:
+            self.health_publisher = HealthPublisher(self.get_health, lambda data: self.lc.publish(HEALTH_CHANNEL, data),
+                                                    self.health_rate)
+            self.health_publisher.start()
+
+    def add_screens(self):
+        self.scheduler.add_alert("low battery", lambda frame: self.flash_message("LOW BATTERY", frame % 2 == 1),
+                                 FLASH_INTERVAL, self.low_battery_active)
+        self.scheduler.add_screen("wifi", self.display_wifi_info, SCREEN_DURATIONS["wifi"])
+        self.scheduler.add_screen("battery", self.display_battery_info, SCREEN_DURATIONS["battery"])
+        self.scheduler.add_screen("qr", self.display_qr_code, SCREEN_DURATIONS["qr"])
+        self.scheduler.add_screen("resources", self.display_resources, SCREEN_DURATIONS["resources"])
+        self.scheduler.add_screen("top", self.display_top_processes, SCREEN_DURATIONS["top"])
+        self.scheduler.add_screen("services", self.display_services, SCREEN_DURATIONS["services"],
+                                  pages=self.services_page_count)
 
 if __name__ == '__main__':
-    mbot_oled = MBotOLED()
+    setup_logging("/var/log/mbot/mbot_oled.log")
+    # MBOT_OLED_BACKEND=memory runs without the OLED attached
+    # MBOT_OLED_RECORD=<file> records the inputs, MBOT_OLED_REPLAY=1 takes them from mbot_replay.py
+    mbot_oled = MBotOLED(backend=os.environ.get("MBOT_OLED_BACKEND", "i2c"),
+                         record=os.environ.get("MBOT_OLED_RECORD"), replay=os.environ.get("MBOT_OLED_REPLAY") == "1")
     mbot_oled.main_loop()
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+# Cached bitmaps for the OLED screens.
+import qrcode
+from PIL import Image
+
+
+def make_qr_bitmap(data, size):
+    # Sample the module matrix straight onto a size x size bitmap instead of
+    # rendering a large image and scaling it down. Modules are black on a
+    # white background, like qrcode's own make_image().
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    n = len(matrix)
+    index = [(2 * i + 1) * n // (2 * size) for i in range(size)]
+    pixels = [0 if matrix[y][x] else 255 for y in index for x in index]
+    bitmap = Image.new("1", (size, size))
+    bitmap.putdata(pixels)
+    return bitmap
+
+
+class QRCodeCache:
+    # Rebuilds the bitmap only when the encoded data changes.
+    def __init__(self, size):
+        self.size = size
+        self._data = None
+        self._bitmap = None
+
+    def get(self, data):
+        if data != self._data:
+            self._bitmap = make_qr_bitmap(data, self.size)
+            self._data = data
+        return self._bitmap
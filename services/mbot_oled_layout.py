@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+# Screen layouts shared by both OLED daemons.
+#
+# Each screen is declared as a list of elements. Text, Line and Box never
+# change, Field and Bitmap show a value the daemon passes by name. Fonts are
+# named by role ("regular", "small", "medium", "large") and each daemon maps
+# the roles to the fonts it loaded.
+#
+# With the NumPy frame buffer, LayoutPainter draws the static elements of a
+# screen once and keeps that layer. A screen shown again starts from the
+# frame it last sent and only the fields whose values changed are drawn, after
+# the area they covered is restored from the static layer. Without numpy the
+# whole screen is drawn through luma's canvas() every time.
+from luma.core.render import canvas
+
+from mbot_metrics import METRICS
+
+
+class Text:
+    def __init__(self, xy, text, font="regular", fill="white"):
+        self.xy = xy
+        self.text = text
+        self.font = font
+        self.fill = fill
+
+    def draw(self, draw, fonts):
+        draw.text(self.xy, self.text, font=fonts[self.font], fill=self.fill)
+
+
+class Line:
+    def __init__(self, xy, fill="white"):
+        self.xy = xy
+        self.fill = fill
+
+    def draw(self, draw, fonts):
+        draw.line(self.xy, fill=self.fill)
+
+
+class Box:
+    def __init__(self, xy, fill="white"):
+        self.xy = xy
+        self.fill = fill
+
+    def draw(self, draw, fonts):
+        draw.rectangle(self.xy, outline=self.fill, fill=self.fill)
+
+
+class Field:
+    # template.format(value) at xy, nothing when the value is None.
+    def __init__(self, xy, name, font="regular", template="{}", fill="white"):
+        self.xy = xy
+        self.name = name
+        self.font = font
+        self.template = template
+        self.fill = fill
+
+    def draw(self, draw, fonts, value):
+        # Returns the box drawn on when draw is a FrameBuffer.
+        if value is None:
+            return None
+        return draw.text(self.xy, self.template.format(value), font=fonts[self.font], fill=self.fill)
+
+
+class Bitmap:
+    # A mode "1" image at xy, like the QR code.
+    def __init__(self, xy, name, fill="white"):
+        self.xy = xy
+        self.name = name
+        self.fill = fill
+
+    def draw(self, draw, fonts, value):
+        if value is None:
+            return None
+        return draw.bitmap(self.xy, value, fill=self.fill)
+
+
+# The separator and IP at the bottom of most screens.
+FOOTER = [
+    Line((0, 48, 127, 48)),
+    Field((1, 49), "ip"),
+]
+
+LAYOUTS = {
+    "splash": [
+        Field((1, 1), "hostname"),
+        Text((1, 17), "Starting..."),
+    ] + FOOTER,
+    "wifi": [
+        Field((1, 1), "hostname"),
+        Field((1, 17), "ssid", template="SSID: {}"),
+        Field((1, 33), "uptime", "small", "Uptime: {}"),
+    ] + FOOTER,
+    "qr": [
+        Text((1, 1), "WebApp"),
+        Bitmap((80, 0), "qr"),
+    ] + FOOTER,
+    "resources": [
+        Text((1, 1), "Load Average: ", "small"),
+        Field((20, 17), "load_avg", "small"),
+        Field((1, 33), "mem", "small", "RAM Used: {}"),
+    ] + FOOTER,
+    # Up to three (short name, state) rows per page.
+    "services": [
+        Field((1, 1), "row0", "small", "{0[0]}: {0[1]}"),
+        Field((1, 17), "row1", "small", "{0[0]}: {0[1]}"),
+        Field((1, 33), "row2", "small", "{0[0]}: {0[1]}"),
+    ] + FOOTER,
+    # The busiest processes as (name, CPU percent, resident MB).
+    "top": [
+        Field((1, 1), "row0", "small", "{0[0]} {0[1]}% {0[2]}M"),
+        Field((1, 17), "row1", "small", "{0[0]} {0[1]}% {0[2]}M"),
+        Field((1, 33), "row2", "small", "{0[0]} {0[1]}% {0[2]}M"),
+    ] + FOOTER,
+    "battery": [
+        Text((1, 1), "Battery Info"),
+        Field((1, 24), "voltage", template="Voltage: {:.2f} V"),
+    ] + FOOTER,
+    "battery_trend": [
+        Text((1, 1), "Battery Info"),
+        Field((1, 17), "voltage", template="Voltage: {:.2f} V"),
+        Field((1, 33), "trend", "small"),
+    ] + FOOTER,
+    "battery_unknown": [
+        Text((1, 1), "Battery Info"),
+        Text((1, 24), "Voltage: ???"),
+    ] + FOOTER,
+    "battery_6v": [
+        Text((1, 1), "Voltage Select Jumper 6V", "small"),
+        Field((1, 24), "voltage", "medium", "Motor Volt: {:.2f} V"),
+    ] + FOOTER,
+    "battery_unplugged": [
+        Text((1, 1), "Control Board"),
+        Text((1, 24), "Not Powered"),
+    ] + FOOTER,
+    "battery_no_cap": [
+        Text((1, 1), "Voltage Select Jumper", "small"),
+        Text((1, 24), "Not Detected", "medium"),
+    ] + FOOTER,
+    "battery_unavailable": [
+        Text((1, 24), "Not Available"),
+    ] + FOOTER,
+    "alert": [
+        Field((1, 20), "message", "large"),
+    ],
+    # The alert inverted, black on white.
+    "alert_inverted": [
+        Box((0, 0, 127, 63)),
+        Field((1, 20), "message", "large", fill="black"),
+    ],
+}
+
+
+def overlaps(box, other):
+    return (box is not None and other is not None and
+            box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3])
+
+
+class CachedLayout:
+    # The static layer of one layout and what its fields show in the frame
+    # it last rendered.
+    def __init__(self, elements):
+        self.elements = elements
+        self.fields = [element for element in elements if isinstance(element, (Field, Bitmap))]
+        self.static = None
+        self.pixels = None
+        self.values = {}
+        self.boxes = {}
+
+    def render(self, frame, fonts, values):
+        # Leaves the frame in frame.pixels, returns the number of fields drawn.
+        if self.static is None:
+            frame.clear()
+            for element in self.elements:
+                if element not in self.fields:
+                    element.draw(frame, fonts)
+            self.static = frame.pixels.copy()
+            self.pixels = self.static.copy()
+
+        dirty = {field.name for field in self.fields
+                 if field.name not in self.values or values.get(field.name) != self.values[field.name]}
+        # Clearing a field also clears any other field drawn over the same area.
+        while True:
+            cleared = [self.boxes.get(name) for name in dirty]
+            overlapping = {field.name for field in self.fields if field.name not in dirty and
+                           any(overlaps(self.boxes.get(field.name), box) for box in cleared)}
+            if not overlapping:
+                break
+            dirty |= overlapping
+
+        frame.pixels[:] = self.pixels
+        for box in cleared:
+            if box is not None:
+                x0, y0, x1, y1 = box
+                frame.pixels[y0:y1, x0:x1] = self.static[y0:y1, x0:x1]
+        for field in self.fields:
+            if field.name in dirty:
+                value = values.get(field.name)
+                self.boxes[field.name] = field.draw(frame, fonts, value)
+                self.values[field.name] = value
+        self.pixels[:] = frame.pixels
+        return len(dirty)
+
+
+class LayoutPainter:
+    # Draws the layouts on the device. frame is a FrameBuffer, or None to
+    # draw with PIL; it can be set once numpy has been imported.
+    def __init__(self, device, fonts, frame=None):
+        self.device = device
+        self.fonts = fonts
+        self.frame = frame
+        self._cache = {}
+
+    def paint(self, name, values):
+        # Returns the number of fields drawn.
+        elements = LAYOUTS[name]
+        if self.frame is None:
+            drawn = 0
+            with canvas(self.device) as draw:
+                with METRICS.timer(f"render.{METRICS.screen}"):
+                    for element in elements:
+                        if isinstance(element, (Field, Bitmap)):
+                            element.draw(draw, self.fonts, values.get(element.name))
+                            drawn += 1
+                        else:
+                            element.draw(draw, self.fonts)
+            return drawn
+        if name not in self._cache:
+            self._cache[name] = CachedLayout(elements)
+        with METRICS.timer(f"render.{METRICS.screen}"):
+            drawn = self._cache[name].render(self.frame, self.fonts, values)
+        self.device.display_pages(self.frame.pages())
+        return drawn
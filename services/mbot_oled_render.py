@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# NumPy frame buffer for the OLED screens.
+#
+# With canvas(), PIL rasterizes every string through FreeType on every frame
+# and the device then repacks the image into SSD1306 page bytes. The screens
+# only show ASCII at a few fixed sizes, so GlyphAtlas rasterizes each
+# character of a font once into a 1-bit bitmap. FrameBuffer copies those
+# bitmaps into a NumPy array and packs it straight into the page format,
+# where each byte is one column of 8 pixels with the top pixel in bit 0.
+#
+# The frames match what ImageDraw draws with the same fonts. FreeType's
+# hinting moves a glyph by a pixel depending on its neighbours, so the
+# distance between two characters is measured from PIL once per pair rather
+# than taken from the font's advance widths.
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+ATLAS_CHARS = "".join(chr(code) for code in range(32, 127))
+PROBE_CHAR = "l"  # Always has ink, so the end of a string can be found
+
+
+def ink(fill):
+    # The colours the screens use, as pixel values.
+    return 0 if fill in (0, "black") else 1
+
+
+def union(box, other):
+    # Smallest box holding both, either may be None.
+    if box is None or other is None:
+        return box or other
+    return min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])
+
+
+class GlyphAtlas:
+    def __init__(self, font, chars=ATLAS_CHARS):
+        self.font = font
+        # Glyphs can reach past their bounding box, leave room around them.
+        self._pad = font.getbbox("Mgjl|")[3] + 2
+        self._glyphs = {}
+        self._pairs = {}
+        for char in chars:
+            self.glyph(char)
+
+    def _rasterize(self, text):
+        # text as ImageDraw draws it at (pad, 0), as an array of 0 and 1.
+        width = self.font.getbbox(text)[2] + 2 * self._pad
+        image = Image.new("1", (width, 2 * self._pad))
+        ImageDraw.Draw(image).text((self._pad, 0), text, font=self.font, fill=1)
+        return np.array(image, dtype=np.uint8)
+
+    def _right_edge(self, text):
+        return int(np.flatnonzero(self._rasterize(text).any(axis=0))[-1])
+
+    def glyph(self, char):
+        # (bitmap, dx, dy) of the inked part of char relative to the pen, or
+        # None for blanks. Characters outside the atlas, e.g. in an SSID, are
+        # rasterized the first time they are drawn.
+        if char not in self._glyphs:
+            pixels = self._rasterize(char)
+            rows = np.flatnonzero(pixels.any(axis=1))
+            cols = np.flatnonzero(pixels.any(axis=0))
+            if len(rows) == 0:
+                self._glyphs[char] = None
+            else:
+                bitmap = pixels[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+                self._glyphs[char] = (bitmap, int(cols[0]) - self._pad, int(rows[0]))
+        return self._glyphs[char]
+
+    def advance(self, prev, char):
+        # Pixels from prev to char when char follows prev in a string.
+        key = prev + char
+        if key not in self._pairs:
+            self._pairs[key] = (self._right_edge(prev + char + PROBE_CHAR) -
+                                self._right_edge(char + PROBE_CHAR))
+        return self._pairs[key]
+
+
+class FrameBuffer:
+    # Takes the ImageDraw calls the screens make (text, line, rectangle and
+    # bitmap) and draws them into a height x width array of 0 and 1.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = np.zeros((height, width), dtype=np.uint8)
+        self._atlases = {}
+
+    def add_font(self, font):
+        # Fonts are rasterized when first drawn, or up front from here.
+        if font is not None and font not in self._atlases:
+            self._atlases[font] = GlyphAtlas(font)
+
+    def clear(self):
+        self.pixels.fill(0)
+
+    def _blit(self, x, y, bitmap, value):
+        # Clipped to the frame, value 1 sets and 0 clears the bitmap's pixels.
+        # Returns the box that was drawn on as (x0, y0, x1, y1), or None.
+        height, width = bitmap.shape
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        target = self.pixels[y0:y1, x0:x1]
+        source = bitmap[y0 - y:y1 - y, x0 - x:x1 - x]
+        if value:
+            target |= source
+        else:
+            target &= 1 - source
+        return x0, y0, x1, y1
+
+    def text(self, xy, text, font=None, fill="white"):
+        # Returns the box the text was drawn in, see _blit().
+        self.add_font(font)
+        atlas = self._atlases[font]
+        x, y = xy
+        value = ink(fill)
+        box = None
+        prev = None
+        for char in text:
+            if prev is not None:
+                x += atlas.advance(prev, char)
+                if x >= self.width:
+                    break
+            glyph = atlas.glyph(char)
+            if glyph is not None:
+                bitmap, dx, dy = glyph
+                box = union(box, self._blit(x + dx, y + dy, bitmap, value))
+            prev = char
+        return box
+
+    def line(self, xy, fill="white", width=1):
+        # Straight lines, one pixel wide, like the separator above the IP.
+        x0, y0, x1, y1 = (int(round(v)) for v in xy)
+        steps = max(abs(x1 - x0), abs(y1 - y0))
+        xs = np.rint(np.linspace(x0, x1, steps + 1)).astype(int)
+        ys = np.rint(np.linspace(y0, y1, steps + 1)).astype(int)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        self.pixels[ys[inside], xs[inside]] = ink(fill)
+
+    def rectangle(self, xy, fill=None, outline=None, width=1):
+        x0, y0, x1, y1 = xy
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width - 1), min(y1, self.height - 1)
+        if fill is not None:
+            self.pixels[y0:y1 + 1, x0:x1 + 1] = ink(fill)
+        if outline is not None:
+            value = ink(outline)
+            self.pixels[(y0, y1), x0:x1 + 1] = value
+            self.pixels[y0:y1 + 1, (x0, x1)] = value
+
+    def bitmap(self, xy, bitmap, fill="white"):
+        # Like ImageDraw.bitmap(), the non-zero pixels of bitmap get fill.
+        return self._blit(xy[0], xy[1], (np.array(bitmap) != 0).astype(np.uint8), ink(fill))
+
+    def pages(self):
+        # One bytes object per 8-pixel page, as pack_pages() returns them.
+        packed = np.packbits(self.pixels.reshape(self.height // 8, 8, self.width), axis=1, bitorder="little")
+        return [page.tobytes() for page in packed[:, 0, :]]
+
+    @contextmanager
+    def canvas(self, device):
+        # Used like luma's canvas(device): starts from a blank frame and sends
+        # it to the device when the block ends.
+        self.clear()
+        yield self
+        device.display_pages(self.pages())
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+# Idle power policy for the OLED display.
+#
+# After dim_after seconds without an event worth showing (IP change, low
+# battery, service failure) the panel is dimmed and the screens rotate
+# slowdown times slower. After off_after seconds the panel is switched off
+# and the scheduler sleeps until the next event. Either step is disabled
+# by setting it to 0. wake() restores full brightness and speed.
+import time
+import logging
+import threading
+
+import mbot_sysinfo
+from mbot_metrics import METRICS
+
+ACTIVE = "active"
+DIM = "dim"
+OFF = "off"
+
+FULL_CONTRAST = 0xCF  # luma's ssd1306 default
+
+
+class PowerPolicy:
+    def __init__(self, device, dim_after=600, off_after=0, dim_contrast=0x10, slowdown=4):
+        self.device = device
+        self.dim_after = dim_after
+        self.off_after = off_after
+        self.dim_contrast = dim_contrast
+        self.slowdown = slowdown
+        self.state = ACTIVE
+        self._last_event = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats_time = time.monotonic()
+        self._stats_frames = 0
+        self._stats_wakeups = self._wakeups()
+
+    def wake(self, reason):
+        # Safe to call from any thread. The caller wakes the scheduler.
+        with self._lock:
+            self._last_event = time.monotonic()
+            if self.state != ACTIVE:
+                logging.info(f"Display woken up by {reason}")
+                METRICS.count("power.wake")
+                self._apply(ACTIVE)
+
+    def update(self):
+        # Called by the scheduler whenever it wakes up, returns the state.
+        with self._lock:
+            idle = time.monotonic() - self._last_event
+            if self.off_after and idle >= self.off_after:
+                state = OFF
+            elif self.dim_after and idle >= self.dim_after:
+                state = DIM
+            else:
+                state = ACTIVE
+            if state != self.state:
+                logging.info(f"Display idle for {idle:.0f} s, switching to {state}")
+                self._apply(state)
+            return state
+
+    def duration_scale(self):
+        return 1 if self.state == ACTIVE else self.slowdown
+
+    def _apply(self, state):
+        try:
+            if state == OFF:
+                self.device.hide()
+            else:
+                if self.state == OFF:
+                    self.device.show()
+                self.device.contrast(self.dim_contrast if state == DIM else FULL_CONTRAST)
+        except Exception as e:
+            logging.error(f"Failed to switch the display to {state}: {e}")
+        self.state = state
+
+    def _wakeups(self):
+        try:
+            return mbot_sysinfo.get_context_switches()
+        except (OSError, ValueError):
+            return 0
+
+    def stats(self):
+        # Rates since the previous call, to compare the power states.
+        now = time.monotonic()
+        frames = self.device.frames
+        wakeups = self._wakeups()
+        elapsed = max(now - self._stats_time, 1e-6)
+        stats = {
+            "state": self.state,
+            "wakeups_per_s": (wakeups - self._stats_wakeups) / elapsed,
+            "frames_per_min": (frames - self._stats_frames) * 60 / elapsed,
+        }
+        self._stats_time, self._stats_frames, self._stats_wakeups = now, frames, wakeups
+        return stats
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# Publishes the robot's hostname and IP to the shared IP registry repo.
+#
+# The registry is kept in a persistent shallow, sparse checkout that only
+# holds register_mbot.py and this robot's data file, so a boot costs one
+# small fetch instead of a full clone. Nothing is committed when the
+# registry already has the current IP. Pushes that lose a race against
+# other robots are retried after fetching the new tip and rebasing this
+# robot's commit onto it, with jittered exponential backoff so a classroom
+# of robots booting together spreads out. The access token is passed to
+# each git command in its environment and never written to the checkout.
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import socket
+import argparse
+import logging
+import subprocess
+import threading
+from logging.handlers import RotatingFileHandler
+
+import mbot_sysinfo
+from mbot_config import read_config
+
+LOG_FILE = "/var/log/mbot/mbot_publish_info.log"
+GIT_PATH = "/var/tmp/mbot_ip_registry"
+IP_TIMEOUT = 30  # Seconds to wait for an IP
+IP_POLL_INTERVAL = 1  # Seconds between checks when netlink is not available
+PUSH_ATTEMPTS = 8
+BACKOFF_BASE = 0.5  # Seconds, doubled after every failed push
+BACKOFF_MAX = 30
+
+
+class GitError(Exception):
+    pass
+
+
+def setup_logging(log_file):
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3),
+            logging.StreamHandler()
+        ]
+    )
+
+
+def auth_env(user, token):
+    # git reads these as "-c http.extraHeader=...", but unlike -c or a URL
+    # with credentials they do not show up in ps or .git/config.
+    credentials = base64.b64encode(f"{user}:{token}".encode()).decode()
+    return {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "http.extraHeader",
+            "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials}"}
+
+
+def first_ip():
+    # The first IPv4 address that is not loopback, like "hostname -I".
+    for _, ifname in socket.if_nameindex():
+        if ifname == "lo":
+            continue
+        try:
+            return mbot_sysinfo.get_interface_ip(ifname)
+        except OSError:
+            continue
+    return None
+
+
+def poll_for_ip(deadline):
+    while True:
+        ip = first_ip()
+        if ip or time.monotonic() >= deadline:
+            return ip
+        time.sleep(min(IP_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+
+def wait_for_ip(timeout):
+    # First address that is not loopback, from the rtnetlink address table
+    # instead of polling, or polled when netlink is not available.
+    from mbot_netlink import AddressMonitor
+
+    deadline = time.monotonic() + timeout
+    changed = threading.Event()
+    monitor = AddressMonitor(on_change=lambda ifname: changed.set())
+    if not monitor.start():
+        return poll_for_ip(deadline)
+    try:
+        while True:
+            for ifname, addresses in sorted(monitor.addresses().items()):
+                for address in addresses:
+                    if not address.startswith("127."):
+                        return address
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            changed.wait(remaining)
+            changed.clear()
+    finally:
+        monitor.stop()
+
+
+class Registry:
+    def __init__(self, path, url, hostname, env=None, user=None):
+        # env holds the credentials, see auth_env(). Commits are made as
+        # user (mbot_ip_list_user), or as the hostname without one.
+        self.path = path
+        self.url = url
+        self.hostname = hostname
+        identity = user or hostname
+        self.env = dict(os.environ, GIT_AUTHOR_NAME=identity, GIT_AUTHOR_EMAIL=identity,
+                        GIT_COMMITTER_NAME=identity, GIT_COMMITTER_EMAIL=identity, **(env or {}))
+        self.data_file = f"data/{hostname}.json"
+        self.commands = 0
+
+    def git(self, *args, check=True):
+        self.commands += 1
+        result = subprocess.run(["git", "-C", self.path] + list(args),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.env)
+        if check and result.returncode != 0:
+            raise GitError(f"git {args[0]} failed: {result.stderr.strip()}")
+        return result
+
+    def checkout(self):
+        # Reuse the checkout from the last boot when it points at the same
+        # repo. Older checkouts had the token in the URL and are replaced.
+        if os.path.isdir(os.path.join(self.path, ".git")):
+            result = self.git("remote", "get-url", "origin", check=False)
+            if result.returncode == 0 and result.stdout.strip() == self.url:
+                self.branch = self.git("rev-parse", "--abbrev-ref", "HEAD").stdout.strip()
+                self.update()
+                return
+            shutil.rmtree(self.path)
+
+        logging.info("Cloning the IP registry")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.commands += 1
+        result = subprocess.run(["git", "clone", "--quiet", "--depth=1", "--filter=blob:none", "--sparse",
+                                 "--no-checkout", self.url, self.path],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.env)
+        if result.returncode != 0:
+            raise GitError(f"git clone failed: {result.stderr.strip()}")
+        self.git("sparse-checkout", "set", "--no-cone", "/register_mbot.py", f"/{self.data_file}")
+        self.git("checkout", "--quiet")
+        self.branch = self.git("rev-parse", "--abbrev-ref", "HEAD").stdout.strip()
+
+    def update(self):
+        # Move to the remote tip, dropping anything left over from a failed run.
+        self.git("fetch", "--quiet", "--depth=1", "origin", self.branch)
+        self.git("reset", "--quiet", "--hard", "FETCH_HEAD")
+
+    def registered_ip(self):
+        try:
+            with open(os.path.join(self.path, self.data_file), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data.get("ip") if isinstance(data, dict) else None
+
+    def commit(self, ip, log_file):
+        # register_mbot.py comes with the registry and owns the file format.
+        subprocess.run([sys.executable, os.path.join(self.path, "register_mbot.py"),
+                        "-hostname", self.hostname, "-ip", ip, "-log", log_file],
+                       cwd=self.path, check=True)
+        self.git("add", self.data_file)
+        if self.git("diff", "--cached", "--quiet", check=False).returncode == 0:
+            return False
+        self.git("commit", "--quiet", "-m", f"Auto update {self.hostname} IP")
+        return True
+
+    def push(self):
+        return self.git("push", "--quiet", "origin", f"HEAD:{self.branch}", check=False).returncode == 0
+
+    def rebase(self):
+        # Replays the one local commit onto the new remote tip. Its parent is
+        # still in the shallow history, so no deeper fetch is needed.
+        self.git("fetch", "--quiet", "--depth=1", "origin", self.branch)
+        if self.git("rebase", "--quiet", "--onto", "FETCH_HEAD", "HEAD~1", check=False).returncode != 0:
+            self.git("rebase", "--abort", check=False)
+            return False
+        return True
+
+
+def publish(registry, ip, log_file=LOG_FILE, attempts=PUSH_ATTEMPTS):
+    # Returns "unchanged", "pushed" or raises GitError.
+    registry.checkout()
+    if registry.registered_ip() == ip:
+        logging.info(f"Registry already has {registry.hostname} at {ip}, nothing to push")
+        return "unchanged"
+
+    if not registry.commit(ip, log_file):
+        return "unchanged"
+    for attempt in range(attempts):
+        if registry.push():
+            logging.info(f"Pushed {registry.hostname} at {ip} after {attempt + 1} attempt(s)")
+            return "pushed"
+        # Somebody else pushed first. Each robot only touches its own file,
+        # so the rebase only fails if someone edited this robot's entry; then
+        # the update is made again on the new tip.
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        logging.warning(f"Push rejected, retrying in {delay:.1f} s")
+        time.sleep(delay)
+        if not registry.rebase():
+            registry.update()
+            if not registry.commit(ip, log_file):
+                return "unchanged"
+    raise GitError(f"Push still rejected after {attempts} attempts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish the MBot IP to the IP registry")
+    # The overrides are used by the benchmark; by default everything comes
+    # from mbot_config.txt and the network.
+    parser.add_argument("--hostname", default=socket.gethostname())
+    parser.add_argument("--ip")
+    parser.add_argument("--url", help="registry URL, pushed to without credentials")
+    parser.add_argument("--path", default=GIT_PATH)
+    parser.add_argument("--log", default=LOG_FILE)
+    args = parser.parse_args()
+    setup_logging(args.log)
+
+    config_file, config = (None, {}) if args.url else read_config()
+    if not args.url and config_file is None:
+        logging.error("No MBot configuration file found.")
+        return 1
+
+    logging.info(f"Updating IP, hostname= {args.hostname}")
+    ip = args.ip or wait_for_ip(IP_TIMEOUT)
+    if not ip:
+        logging.info("Timed out waiting for IP. Exiting.")
+        return 0
+    logging.info(f"IP= {ip}")
+
+    if config_file:
+        # Write the IP to the SD card.
+        ip_out_file = os.path.join(os.path.dirname(config_file), "ip_out.txt")
+        with open(ip_out_file, "w") as f:
+            f.write(f"My IP is {ip}!\n")
+
+    url, env, user = args.url, None, None
+    if not url:
+        user = config.get("mbot_ip_list_user")
+        token = config.get("mbot_ip_list_token")
+        url = config.get("mbot_ip_list_url")
+        if not (user and token and url):
+            logging.info("Git information not provided, not pushing IP information.")
+            return 0
+        env = auth_env(user, token)
+
+    try:
+        publish(Registry(args.path, url, args.hostname, env, user), ip, args.log)
+    except (GitError, OSError, subprocess.CalledProcessError) as e:
+        logging.error(f"Failed to publish IP: {e}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
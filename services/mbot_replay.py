@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+# Record and replay of the inputs of the OLED daemons.
+#
+# With MBOT_OLED_RECORD=<file> set, a daemon writes the battery messages it
+# handles, the values its probes return and the IP changes it sees to a
+# gzipped file of JSON lines. The first line is a header, every other line
+# is [seconds since start, kind, ...]:
+#   [12.301,"b",0.0,0.0,0.0,11.523,0.0,0.0]      battery message volts
+#   [12.344,"p","load_avg","0.42, 0.37, 0.30"]   probe output
+#   [15.020,"ip","192.168.3.14"]                 IP change
+#
+# With MBOT_OLED_REPLAY=1 set, a daemon runs no probes and does not watch
+# the addresses. Instead
+#   python3 mbot_replay.py replay <file> [--speed 10]
+# publishes the recorded battery messages on MBOT_ANALOG_IN (or battery_adc
+# on ROS 2) and everything else on MBOT_OLED_REPLAY (mbot_oled_replay).
+# Before each battery message it sends the recording time, and the daemon's
+# clock follows it, so the message timeout and the battery filter and trend
+# see the recorded timing at any speed. The screens still rotate in real time.
+import sys
+import gzip
+import json
+import time
+import zlib
+import atexit
+import argparse
+import threading
+
+RECORD_VERSION = 1
+REPLAY_CHANNEL = "MBOT_OLED_REPLAY"
+REPLAY_TOPIC = "mbot_oled_replay"
+BATTERY_CHANNEL = "MBOT_ANALOG_IN"
+BATTERY_TOPIC = "battery_adc"
+LCM_URL = "udpm://239.255.76.67:7667?ttl=0"
+FLUSH_INTERVAL = 5  # Seconds the recording is buffered for before a sync flush
+
+# Record kinds
+BATTERY = "b"
+PROBE = "p"
+IP = "ip"
+CLOCK = "c"  # Only sent while replaying, [recording time, "c", speed]
+
+
+class Recorder:
+    # Safe to call from any thread. clock is the daemon's time.monotonic().
+    def __init__(self, path, source, clock=time.monotonic, flush_interval=FLUSH_INTERVAL):
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._lock = threading.Lock()
+        self._start = clock()
+        # In real time, the clock follows the recording while replaying
+        self._next_flush = time.monotonic() + flush_interval
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._write({"version": RECORD_VERSION, "source": source, "start": round(time.time(), 3)})
+        self._file.flush()
+        atexit.register(self.close)
+
+    def _write(self, entry):
+        # Values that JSON has no type for, if any, are kept as strings.
+        self._file.write(json.dumps(entry, separators=(",", ":"), default=str) + "\n")
+
+    def add(self, kind, *values):
+        with self._lock:
+            if self._file is None:
+                return
+            self._write([round(self.clock() - self._start, 3), kind] + list(values))
+            self.records += 1
+            now = time.monotonic()
+            if now >= self._next_flush:
+                # A sync flush, so a killed daemon leaves a readable file
+                self._file.flush()
+                self._next_flush = now + self.flush_interval
+
+    def battery(self, volts):
+        # float() as ROS 2 arrays hold NumPy floats
+        self.add(BATTERY, *(round(float(v), 3) for v in volts))
+
+    def probe(self, key, value):
+        self.add(PROBE, key, value)
+
+    def ip(self, address):
+        self.add(IP, address)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path):
+    # Returns (header, records). A file cut off by a killed daemon ends at
+    # its last flush.
+    header, records = None, []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            try:
+                header = json.loads(f.readline())
+            except json.JSONDecodeError:
+                pass
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        except (EOFError, zlib.error):
+            pass
+    if not isinstance(header, dict) or header.get("version") != RECORD_VERSION:
+        raise ValueError(f"{path} is not a version {RECORD_VERSION} recording")
+    return header, records
+
+
+def encode_record(record):
+    return json.dumps(record, separators=(",", ":")).encode()
+
+
+def decode_record(data):
+    return json.loads(data)
+
+
+class ReplayClock:
+    # Takes the place of time.monotonic() in a daemon being replayed into.
+    # Runs on from the recording time of the last sync at the replay speed.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._base = 0.0
+        self._synced = time.monotonic()
+        self._speed = 1.0
+
+    def sync(self, t, speed):
+        with self._lock:
+            self._base, self._synced, self._speed = t, time.monotonic(), speed
+
+    def __call__(self):
+        with self._lock:
+            return self._base + (time.monotonic() - self._synced) * self._speed
+
+
+class BatteryMessage:
+    # The fields the battery callbacks read from mbot_analog_t / BatteryADC.
+    def __init__(self, utime, volts):
+        self.utime = utime
+        self.volts = list(volts)
+
+
+def fit(values, template):
+    # values sized like the message's volts array, if it has a fixed size.
+    size = len(template)
+    if size == 0:
+        return list(values)
+    return (list(values) + [0.0] * size)[:size]
+
+
+def apply_record(daemon, record):
+    # Applies a record sent on the replay channel to a daemon in replay mode.
+    # Battery records arrive on the battery channel instead.
+    t, kind = record[0], record[1]
+    if kind == CLOCK:
+        daemon.clock.sync(t, record[2])
+    elif kind == PROBE:
+        # No expiry, the value is only replaced by the next record
+        daemon.cache.set(record[2], record[3], float("inf"))
+    elif kind == IP:
+        daemon.ip_changed(record[2])
+
+
+class DirectSink:
+    # Applies the records to a daemon in the same process.
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def send(self, record, speed):
+        self.daemon.clock.sync(record[0], speed)
+        if record[1] == BATTERY:
+            self.daemon.battery_info_callback(BatteryMessage(int(round(record[0] * 1e6)), record[2:]))
+        else:
+            apply_record(self.daemon, record)
+
+
+class LcmSink:
+    # encode(record) returns the MBOT_ANALOG_IN message of a battery record,
+    # by default an mbot_analog_t.
+    def __init__(self, lc, encode=None):
+        self.lc = lc
+        self.encode = encode or self.encode_analog
+        if encode is None:
+            from mbot_lcm_msgs.mbot_analog_t import mbot_analog_t
+            self.mbot_analog_t = mbot_analog_t
+
+    def encode_analog(self, record):
+        msg = self.mbot_analog_t()
+        msg.utime = int(round(record[0] * 1e6))
+        msg.volts = fit(record[2:], msg.volts)
+        return msg.encode()
+
+    def send(self, record, speed):
+        if record[1] == BATTERY:
+            self.lc.publish(REPLAY_CHANNEL, encode_record([record[0], CLOCK, speed]))
+            self.lc.publish(BATTERY_CHANNEL, self.encode(record))
+        else:
+            self.lc.publish(REPLAY_CHANNEL, encode_record(record))
+
+
+class RosSink:
+    def __init__(self, node):
+        from rclpy.qos import QoSProfile, QoSReliabilityPolicy
+        from std_msgs.msg import String
+        from mbot_interfaces.msg import BatteryADC
+        self.String = String
+        self.BatteryADC = BatteryADC
+        # Best effort like the firmware, which the daemon subscribes with
+        qos_profile = QoSProfile(depth=10, reliability=QoSReliabilityPolicy.BEST_EFFORT)
+        self.battery_publisher = node.create_publisher(BatteryADC, BATTERY_TOPIC, qos_profile)
+        self.replay_publisher = node.create_publisher(String, REPLAY_TOPIC, 10)
+
+    def send(self, record, speed):
+        if record[1] == BATTERY:
+            self.replay_publisher.publish(self.String(data=encode_record([record[0], CLOCK, speed]).decode()))
+            msg = self.BatteryADC()
+            msg.volts = fit(record[2:], msg.volts)
+            self.battery_publisher.publish(msg)
+        else:
+            self.replay_publisher.publish(self.String(data=encode_record(record).decode()))
+
+
+class Replayer:
+    # Sends the records at their recorded times divided by speed, a speed
+    # of 0 sends them as fast as possible.
+    def __init__(self, records, sink, speed=1.0):
+        self.records = records
+        self.sink = sink
+        self.speed = speed
+        self.sent = 0
+        self.late_max = 0.0  # Seconds the most delayed record was sent late
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        t0 = self.records[0][0] if self.records else 0.0
+        for record in self.records:
+            if self.speed > 0:
+                delay = start + (record[0] - t0) / self.speed - time.monotonic()
+                if delay > 0:
+                    if self._stop.wait(delay):
+                        break
+                else:
+                    self.late_max = max(self.late_max, -delay)
+            elif self._stop.is_set():
+                break
+            self.sink.send(record, self.speed)
+            self.sent += 1
+        self.elapsed = time.monotonic() - start
+
+    def stop(self):
+        self._stop.set()
+
+
+def summarize(path):
+    header, records = read_recording(path)
+    kinds = {}
+    for record in records:
+        kinds[record[1]] = kinds.get(record[1], 0) + 1
+    duration = records[-1][0] if records else 0.0
+    print(f"{path}: {header['source']} recording of {duration:.1f} s, started "
+          f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['start']))}")
+    for kind, name in ((BATTERY, "battery messages"), (PROBE, "probe outputs"), (IP, "IP changes")):
+        print(f"  {kinds.get(kind, 0):8d} {name}")
+
+
+def replay(path, speed, target, lcm_url):
+    header, records = read_recording(path)
+    target = target or header["source"]
+    print(f"Replaying {len(records)} records at {'full' if speed <= 0 else f'{speed:g}x'} speed over {target}")
+    if target == "lcm":
+        import lcm
+        replayer = Replayer(records, LcmSink(lcm.LCM(lcm_url)), speed)
+        replayer.run()
+    else:
+        import rclpy
+        from rclpy.node import Node
+        rclpy.init(args=None)
+        node = Node("mbot_oled_replay")
+        try:
+            replayer = Replayer(records, RosSink(node), speed)
+            replayer.run()
+        finally:
+            node.destroy_node()
+            rclpy.try_shutdown()
+    print(f"Sent {replayer.sent} records in {replayer.elapsed:.1f} s, at most {replayer.late_max * 1e3:.1f} ms late")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay OLED daemon recordings")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    info_parser = subparsers.add_parser("info", help="show what a recording holds")
+    info_parser.add_argument("file")
+    replay_parser = subparsers.add_parser("replay", help="send a recording to a daemon in replay mode")
+    replay_parser.add_argument("file")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="0 replays as fast as possible")
+    replay_parser.add_argument("--target", choices=["lcm", "ros2"], help="the recording's source by default")
+    replay_parser.add_argument("--lcm-url", default=LCM_URL)
+    args = parser.parse_args()
+
+    try:
+        if args.command == "info":
+            summarize(args.file)
+        else:
+            replay(args.file, args.speed, args.target, args.lcm_url)
+    except (OSError, ValueError, ImportError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# Background sampling of the values shown on the OLED screens.
+#
+# Each metric is refreshed by a worker pool at its own interval and stored
+# in a SnapshotCache together with an expiry time. The display methods only
+# read the cache, so a slow probe never delays a frame.
+import time
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mbot_metrics import METRICS
+
+
+class SnapshotCache:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ttl)
+
+    def get(self, key, default=None):
+        # Values past their TTL are treated as missing.
+        with self._lock:
+            entry = self._values.get(key)
+        if entry is None or time.monotonic() > entry[1]:
+            return default
+        return entry[0]
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {key: value for key, (value, expiry) in self._values.items() if now <= expiry}
+
+
+class Sampler:
+    def __init__(self, cache, max_workers=2, on_sample=None):
+        # on_sample(key, value) is called after each successful sample,
+        # e.g. to record it.
+        self.cache = cache
+        self.on_sample = on_sample
+        self.max_workers = max_workers
+        self._probes = {}
+        self._running = set()
+        self._queue = []
+        self._next = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = None
+
+    def add(self, key, func, interval, ttl=None):
+        # By default a value stays valid for three missed refreshes.
+        self._probes[key] = (func, interval, ttl if ttl is not None else 3 * interval)
+
+    def intervals(self):
+        return {key: interval for key, (func, interval, ttl) in self._probes.items()}
+
+    def sample(self, key):
+        # Runs one probe on the calling thread, for callers that schedule the
+        # probes themselves instead of calling start(). Skipped while the
+        # previous sample of the same key is still in flight.
+        with self._lock:
+            if key in self._running:
+                return
+            self._running.add(key)
+        func, interval, ttl = self._probes[key]
+        self._sample(key, func, ttl)
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mbot-sampler")
+        now = time.monotonic()
+        with self._lock:
+            self._next = {key: now for key in self._probes}
+            self._queue = [(now, key) for key in self._probes]
+            heapq.heapify(self._queue)
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def request(self, key):
+        # Refresh a value now instead of waiting for its next interval.
+        if key not in self._probes:
+            return
+        with self._lock:
+            self._next[key] = time.monotonic()
+            heapq.heappush(self._queue, (self._next[key], key))
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    # No probes, nothing to do until request() queues one.
+                    deadline, delay = None, None
+                else:
+                    deadline, key = self._queue[0]
+                    delay = deadline - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._queue)
+            if delay is None or delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+
+            func, interval, ttl = self._probes[key]
+            with self._lock:
+                if deadline != self._next[key]:
+                    # Superseded by a request() for the same key.
+                    continue
+                self._next[key] = time.monotonic() + interval
+                heapq.heappush(self._queue, (self._next[key], key))
+                if key in self._running:
+                    # The previous sample is still in flight, skip this one.
+                    continue
+                self._running.add(key)
+            try:
+                self._executor.submit(self._sample, key, func, ttl)
+            except RuntimeError:
+                # The interpreter is shutting down.
+                return
+
+    def _sample(self, key, func, ttl):
+        try:
+            with METRICS.timer(f"collect.{key}"):
+                value = func()
+            self.cache.set(key, value, ttl)
+            if self.on_sample:
+                self.on_sample(key, value)
+        except Exception as e:
+            logging.error(f"Failed to sample {key}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(key)
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# Deadline based screen scheduler for the OLED daemons.
+#
+# Screens are shown in rotation, each for its own duration. Alerts (such as
+# low battery) are checked whenever the scheduler wakes up, and callbacks
+# call notify() to wake it immediately, so an alert replaces the current
+# screen within one frame instead of waiting for the rotation to finish.
+# redraw() draws the current screen again when a value on it changed.
+# An optional PowerPolicy slows the rotation down or stops it while idle.
+# run() is the scheduler's own loop; step() lets an event loop such as a
+# ROS 2 executor drive it instead.
+import time
+import logging
+import threading
+
+from mbot_metrics import METRICS
+from mbot_power import OFF
+
+
+class ScreenScheduler:
+    def __init__(self, on_rotation=None, power=None):
+        self.screens = []
+        self.alerts = []
+        self.on_rotation = on_rotation
+        self.power = power
+        self.lag = 0.0  # How late the last screen change was, in seconds
+        self._cond = threading.Condition()
+        self._notified = False
+        self._redraw = False
+        self._running = False
+        # Called by notify() as well, for callers that run step() from their
+        # own event loop instead of run().
+        self.wakeup = None
+
+    def add_screen(self, name, render, duration, pages=None):
+        # A paged screen is called as render(page) for each of its pages.
+        # pages may be a callable so the count can change between rotations.
+        self.screens.append((name, render, duration, pages))
+
+    def add_alert(self, name, render, interval, active):
+        # While active() is true, render(frame) is called every interval
+        # seconds in place of the rotation. Earlier alerts take priority.
+        self.alerts.append((name, render, interval, active))
+
+    def notify(self):
+        # Safe to call from any thread.
+        with self._cond:
+            self._notified = True
+            self._cond.notify()
+        if self.wakeup:
+            self.wakeup()
+
+    def redraw(self):
+        # Draw the current screen again with fresh values, without changing
+        # how long it stays up. Safe to call from any thread.
+        self._redraw = True
+        self.notify()
+
+    def stop(self):
+        self._running = False
+        self.notify()
+
+    def _wait(self, deadline):
+        # A deadline of None waits until notify() is called.
+        with self._cond:
+            while self._running and not self._notified:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._notified = False
+
+    def _page_count(self, pages):
+        if pages is None:
+            return 1
+        return pages() if callable(pages) else pages
+
+    def _render(self, name, render, *args):
+        METRICS.screen = name
+        try:
+            with METRICS.timer(f"screen.{name}"):
+                render(*args)
+        except Exception as e:
+            logging.error(f"Unhandled exception while drawing {name}: {e}")
+
+    def _active_alert(self):
+        for alert in self.alerts:
+            if alert[3]():
+                return alert
+        return None
+
+    def start(self):
+        # Resets the rotation, for callers that call step() themselves.
+        self._running = True
+        self._index, self._page = 0, 0
+        self._deadline = None  # None means the current screen still has to be drawn
+        self._alert_frame = 0
+        if self.on_rotation:
+            self.on_rotation()
+
+    def run(self):
+        self.start()
+        while self._running:
+            self._wait(self.step())
+
+    def step(self):
+        # Draws whatever is due and returns the monotonic time of the next
+        # step, or None to sleep until notify().
+        alert = self._active_alert()
+        if alert:
+            name, render, interval, _ = alert
+            if self.power:
+                self.power.wake(name)
+            frame_deadline = time.monotonic() + interval
+            self._render(name, render, self._alert_frame)
+            self._alert_frame += 1
+            # Redraw the interrupted screen once the alert is over.
+            self._deadline = None
+            return frame_deadline
+        self._alert_frame = 0
+
+        if self.power and self.power.update() == OFF:
+            # The panel is off, sleep until an event wakes it up.
+            self._deadline = None
+            return None
+
+        now = time.monotonic()
+        if self._deadline is not None and now >= self._deadline:
+            self.lag = now - self._deadline
+            METRICS.observe("scheduler_lag", self.lag)
+            name, render, duration, pages = self.screens[self._index]
+            self._page += 1
+            if self._page >= self._page_count(pages):
+                self._index, self._page = (self._index + 1) % len(self.screens), 0
+                if self._index == 0 and self.on_rotation:
+                    self.on_rotation()
+            self._deadline = None
+
+        redraw, self._redraw = self._redraw, False
+        if self._deadline is None:
+            name, render, duration, pages = self.screens[self._index]
+            if self.power:
+                duration *= self.power.duration_scale()
+            self._deadline = time.monotonic() + duration
+            if pages is not None and self._page_count(pages) == 0:
+                # Nothing to show on this screen, move straight on.
+                self._deadline = time.monotonic()
+            else:
+                self._draw_screen(self._index, self._page)
+        elif redraw:
+            self._draw_screen(self._index, self._page)
+        return self._deadline
+
+    def _draw_screen(self, index, page):
+        name, render, duration, pages = self.screens[index]
+        if pages is None:
+            self._render(name, render)
+        else:
+            self._render(name, render, page)
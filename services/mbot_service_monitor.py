@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# Tracks the state of the MBot systemd units for the OLED services screen.
+#
+# All units are fetched in one batch, either with a single "systemctl show"
+# or over D-Bus, and kept current from the PropertiesChanged signals systemd
+# emits when a unit changes state. When D-Bus is not available the states
+# are re-fetched in one batch at most every poll_interval seconds.
+import time
+import logging
+import threading
+import subprocess
+
+from mbot_metrics import METRICS
+
+SYSTEMD_BUS_NAME = "org.freedesktop.systemd1"
+SYSTEMD_PATH = "/org/freedesktop/systemd1"
+SYSTEMD_MANAGER_IFACE = "org.freedesktop.systemd1.Manager"
+SYSTEMD_UNIT_IFACE = "org.freedesktop.systemd1.Unit"
+SYSTEMD_SERVICE_IFACE = "org.freedesktop.systemd1.Service"
+DBUS_PROPERTIES_IFACE = "org.freedesktop.DBus.Properties"
+
+UNIT_PROPERTIES = ["LoadState", "ActiveState", "SubState", "Result"]
+
+
+def format_unit_state(props):
+    # Mirrors what the screen showed when it parsed "systemctl status".
+    if not props or props.get("LoadState") == "not-found":
+        return "not found"
+    active = props.get("ActiveState", "unknown")
+    if active == "failed":
+        return f"failed ({props.get('Result', 'unknown')})"
+    sub = props.get("SubState")
+    return f"{active} ({sub})" if sub else active
+
+
+def parse_service_list(value):
+    # "unit:short,unit:short" as used by the mbot_oled_services config key.
+    services = []
+    for entry in value.split(","):
+        unit, _, short = entry.strip().partition(":")
+        if unit:
+            services.append((unit, short or unit))
+    return services
+
+
+class ServiceMonitor:
+    def __init__(self, units, bus_address=None, poll_interval=30, on_change=None):
+        # on_change(unit, state) is called when the state of a unit changes.
+        self.units = list(units)
+        self.bus_address = bus_address
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        self._props = {unit: {} for unit in self.units}
+        self._lock = threading.Lock()
+        self._last_refresh = 0
+        self._dbus_active = False
+        self._unit_paths = {}
+
+    def refresh(self):
+        try:
+            with METRICS.timer("subprocess.systemctl"):
+                output = subprocess.check_output(
+                    ["systemctl", "show", "--property=Id," + ",".join(UNIT_PROPERTIES), "--"] +
+                    [f"{unit}.service" for unit in self.units],
+                    stderr=subprocess.DEVNULL
+                ).decode()
+        except (subprocess.CalledProcessError, OSError) as e:
+            logging.error(f"Failed to query services: {e}")
+            return
+
+        # One block of key=value lines per unit, in the order requested.
+        blocks = [block for block in output.split("\n\n") if block.strip()]
+        for unit, block in zip(self.units, blocks):
+            props = {}
+            for line in block.splitlines():
+                key, _, value = line.partition("=")
+                props[key] = value
+            self._set_props(unit, props)
+        self._last_refresh = time.monotonic()
+
+    def get_states(self):
+        if not self._dbus_active and time.monotonic() - self._last_refresh > self.poll_interval:
+            self.refresh()
+        with self._lock:
+            return {unit: format_unit_state(self._props[unit]) for unit in self.units}
+
+    def start(self):
+        try:
+            import dbus
+            from dbus.mainloop.glib import DBusGMainLoop
+            from gi.repository import GLib
+        except ImportError:
+            logging.warning("python3-dbus not available, polling service states instead.")
+            return False
+
+        try:
+            DBusGMainLoop(set_as_default=True)
+            if self.bus_address:
+                bus = dbus.bus.BusConnection(self.bus_address)
+            else:
+                bus = dbus.SystemBus()
+            manager = dbus.Interface(bus.get_object(SYSTEMD_BUS_NAME, SYSTEMD_PATH), SYSTEMD_MANAGER_IFACE)
+            # systemd only broadcasts unit signals while somebody is subscribed.
+            manager.Subscribe()
+            for unit in self.units:
+                path = str(manager.LoadUnit(f"{unit}.service"))
+                self._unit_paths[path] = unit
+                self._fetch_unit(bus, unit, path)
+            bus.add_signal_receiver(
+                self._properties_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROPERTIES_IFACE,
+                bus_name=SYSTEMD_BUS_NAME,
+                path_keyword="path"
+            )
+        except dbus.exceptions.DBusException as e:
+            logging.warning(f"Failed to subscribe to systemd over D-Bus, polling instead: {e}")
+            return False
+
+        self._bus = bus
+        self._dbus_active = True
+        loop_thread = threading.Thread(target=GLib.MainLoop().run, daemon=True)
+        loop_thread.start()
+        return True
+
+    def _fetch_unit(self, bus, unit, path):
+        props_iface = bus.get_object(SYSTEMD_BUS_NAME, path)
+        props = {}
+        for iface in (SYSTEMD_UNIT_IFACE, SYSTEMD_SERVICE_IFACE):
+            try:
+                values = props_iface.GetAll(iface, dbus_interface=DBUS_PROPERTIES_IFACE)
+            except Exception:
+                # Units that are not found do not implement the Service interface.
+                continue
+            props.update({key: str(values[key]) for key in UNIT_PROPERTIES if key in values})
+        self._set_props(unit, props)
+
+    def _set_props(self, unit, props):
+        with self._lock:
+            old = format_unit_state(self._props[unit])
+            self._props[unit] = props
+        state = format_unit_state(props)
+        if self.on_change and state != old:
+            self.on_change(unit, state)
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        unit = self._unit_paths.get(path)
+        if unit is None or interface not in (SYSTEMD_UNIT_IFACE, SYSTEMD_SERVICE_IFACE):
+            return
+        METRICS.count("callback.systemd")
+        if any(key in invalidated for key in UNIT_PROPERTIES):
+            self._fetch_unit(self._bus, unit, path)
+            return
+        with self._lock:
+            props = dict(self._props[unit])
+        for key in UNIT_PROPERTIES:
+            if key in changed:
+                props[key] = str(changed[key])
+        self._set_props(unit, props)
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# System information probes for the MBot OLED daemons.
+#
+# Every value is read straight from procfs or through a socket ioctl so the
+# display loop never has to fork a process. The output formats match the
+# commands these probes replace (hostname, uptime -p, iwgetid -r, free, top
+# and ifconfig), so the screens look the same as before.
+import os
+import re
+import time
+import array
+import fcntl
+import socket
+import struct
+
+SIOCGIFADDR = 0x8915
+SIOCGIWESSID = 0x8B1B
+IW_ESSID_MAX_SIZE = 32
+IFNAMSIZ = 16
+PF_KTHREAD = 0x00200000  # Process flag of kernel threads, field 9 of /proc/<pid>/stat
+
+# Root of the proc filesystem. Benchmarks point this at a fake tree.
+PROC_ROOT = "/proc"
+
+
+def _read(name):
+    with open(os.path.join(PROC_ROOT, name), "r") as f:
+        return f.read()
+
+
+def get_hostname():
+    return socket.gethostname()
+
+
+def format_uptime_pretty(seconds):
+    # Same wording as procps "uptime -p": only non-zero units, pluralized.
+    minutes = int(seconds) // 60
+    units = [("year", 525600), ("week", 10080), ("day", 1440), ("hour", 60), ("minute", 1)]
+    parts = []
+    for name, size in units:
+        count, minutes = divmod(minutes, size)
+        if count:
+            parts.append(f"{count} {name}{'s' if count != 1 else ''}")
+    return "up " + (", ".join(parts) if parts else "0 minutes")
+
+
+def get_uptime():
+    uptime_output = format_uptime_pretty(float(_read("uptime").split()[0]))
+    pattern = r'up (\d+) hour[s]*, (\d+) minute[s]*|up (\d+) minute[s]*'
+    match = re.match(pattern, uptime_output)
+
+    if match:
+        hours, minutes, minutes_only = match.groups()
+        return f'{minutes_only}m' if minutes_only else f'{hours}h{minutes}m'
+    return uptime_output[3:]
+
+
+def get_process_age(pid="self"):
+    # Seconds since the process was started, from its start time in clock
+    # ticks after boot (field 22 of /proc/<pid>/stat).
+    stat = _read(f"{pid}/stat")
+    start_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+    uptime = float(_read("uptime").split()[0])
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def get_context_switches(pid="self"):
+    # Voluntary and involuntary context switches of all threads of a
+    # process, i.e. how often it was woken up or preempted.
+    total = 0
+    for tid in os.listdir(os.path.join(PROC_ROOT, str(pid), "task")):
+        try:
+            status = _read(f"{pid}/task/{tid}/status")
+        except FileNotFoundError:
+            continue  # The thread exited meanwhile
+        for line in status.splitlines():
+            # voluntary_ctxt_switches and nonvoluntary_ctxt_switches
+            if line.startswith(("voluntary_ctxt_switches:", "nonvoluntary_ctxt_switches:")):
+                total += int(line.split()[1])
+    return total
+
+
+def get_mem_used_percent():
+    meminfo = {}
+    for line in _read("meminfo").splitlines():
+        key, _, value = line.partition(":")
+        fields = value.split()
+        if fields:
+            meminfo[key] = int(fields[0])
+
+    total = meminfo["MemTotal"]
+    if "MemAvailable" in meminfo:
+        used = total - meminfo["MemAvailable"]
+    else:
+        # Kernels older than 3.14 do not report MemAvailable.
+        used = total - meminfo["MemFree"] - meminfo.get("Buffers", 0) - meminfo.get("Cached", 0)
+    return f"{used * 100 / total:.2f}%"
+
+
+def get_load_avg():
+    fields = _read("loadavg").split()
+    return ", ".join(f"{float(v):.2f}" for v in fields[:3])
+
+
+def get_wireless_interfaces():
+    # The first two lines of /proc/net/wireless are table headers.
+    try:
+        lines = _read("net/wireless").splitlines()[2:]
+    except FileNotFoundError:
+        return []
+    return [line.split(":", 1)[0].strip() for line in lines if ":" in line]
+
+
+def get_interface_ssid(ifname):
+    # struct iwreq: interface name followed by an iw_point that the kernel
+    # fills with the ESSID, padded to the size of the iwreq_data union.
+    essid = array.array("B", bytes(IW_ESSID_MAX_SIZE + 1))
+    essid_addr, essid_len = essid.buffer_info()
+    request = bytearray(struct.pack("16sPHH", ifname.encode()[:IFNAMSIZ - 1], essid_addr, essid_len, 0))
+    request.extend(bytes(max(0, 32 - len(request))))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        fcntl.ioctl(sock.fileno(), SIOCGIWESSID, request)
+    length = struct.unpack_from("16sPH", request)[2]
+    return essid.tobytes()[:length].decode(errors="replace").rstrip("\0")
+
+
+def get_connected_ssid():
+    for ifname in get_wireless_interfaces():
+        ssid = get_interface_ssid(ifname)
+        if ssid:
+            return ssid
+    return ""
+
+
+def get_interface_ip(ifname):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        request = struct.pack("256s", ifname.encode()[:IFNAMSIZ - 1])
+        return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+
+
+def get_default_route_ip():
+    # Connecting a UDP socket only selects a route, no packet is sent.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect(("8.8.8.8", 80))
+        return sock.getsockname()[0]
+
+
+class ProcessTop:
+    # The processes that used the most CPU since the previous sample, from
+    # /proc/<pid>/stat. The stat files stay open between samples and are
+    # re-read with pread(), so a sample costs one listing of /proc and one
+    # read per process. Kernel threads are skipped after the first look.
+    # Processes beyond max_open are opened and closed on every sample.
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self._tick = os.sysconf("SC_CLK_TCK")
+        self._page_mb = os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+        self._fds = {}  # pid -> open stat file
+        self._ticks = {}  # (pid, start time) -> CPU ticks at the previous sample
+        self._kernel = set()
+        self._last_time = None
+
+    def _read_stat(self, pid):
+        fd = self._fds.get(pid)
+        if fd is not None:
+            try:
+                return os.pread(fd, 1024, 0).decode(errors="replace")
+            except OSError:
+                # The process exited, its pid may already be taken again.
+                os.close(fd)
+                del self._fds[pid]
+                return None
+        path = os.path.join(PROC_ROOT, pid, "stat")
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return None
+        try:
+            data = os.pread(fd, 1024, 0).decode(errors="replace")
+        except OSError:
+            os.close(fd)
+            return None
+        if len(self._fds) < self.max_open:
+            self._fds[pid] = fd
+        else:
+            os.close(fd)
+        return data
+
+    def sample(self, count=3):
+        # [(name, cpu percent of one core, resident MB)], busiest first. The
+        # first sample only records the CPU times and returns [].
+        now = time.monotonic()
+        pids = {name for name in os.listdir(PROC_ROOT) if name.isdigit()}
+        for pid in set(self._fds) - pids:
+            os.close(self._fds.pop(pid))
+        self._kernel &= pids
+
+        ticks = {}
+        usage = []
+        elapsed = (now - self._last_time) * self._tick if self._last_time is not None else None
+        for pid in pids - self._kernel:
+            stat = self._read_stat(pid)
+            if stat is None:
+                continue
+            name = stat[stat.find("(") + 1:stat.rfind(")")]
+            fields = stat[stat.rfind(")") + 2:].split()
+            if int(fields[6]) & PF_KTHREAD:
+                self._kernel.add(pid)
+                fd = self._fds.pop(pid, None)
+                if fd is not None:
+                    os.close(fd)
+                continue
+            # With the start time, so a reused pid is not taken for the old process
+            key = (pid, fields[19])
+            ticks[key] = int(fields[11]) + int(fields[12])  # utime + stime
+            if elapsed and key in self._ticks:
+                cpu = (ticks[key] - self._ticks[key]) * 100 / elapsed
+                usage.append((cpu, name, int(fields[21]) * self._page_mb))
+        self._ticks = ticks
+        self._last_time = now
+        usage.sort(key=lambda entry: entry[0], reverse=True)
+        return [(name, cpu, rss) for cpu, name, rss in usage[:count]]
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
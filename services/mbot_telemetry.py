@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# System health telemetry published by the OLED daemons.
+#
+# The OLED daemon already samples everything the screens show, so it also
+# publishes those values for other processes (web app, fleet scripts)
+# instead of each of them running the same probes. A health message is a
+# compact JSON object with short keys, e.g.
+#   {"t":1700000000.0,"host":"mbot-0000","ip":"192.168.3.1","ssid":"Lab",
+#    "up":"2h5m","mem":"42.10%","load":"0.42, 0.37, 0.30",
+#    "svc":{"lidar-drv":"active (running)"},"batt":11.52}
+# It is sent as raw bytes on an LCM channel, or as a std_msgs/String on ROS 2.
+import json
+import time
+import logging
+import threading
+
+from mbot_metrics import METRICS
+
+HEALTH_CHANNEL = "MBOT_SYSTEM_HEALTH"
+HEALTH_TOPIC = "mbot_system_health"
+
+# Sampler cache key -> message key
+HEALTH_FIELDS = {
+    "hostname": "host",
+    "ip": "ip",
+    "ssid": "ssid",
+    "uptime": "up",
+    "mem": "mem",
+    "load_avg": "load",
+    "services": "svc",
+}
+
+
+def health_message(values, battery_voltage):
+    # values is a sampler cache snapshot, missing (expired) values are left out.
+    msg = {"t": round(time.time(), 1)}
+    for key, short in HEALTH_FIELDS.items():
+        if key in values:
+            msg[short] = values[key]
+    msg["batt"] = round(battery_voltage, 2)
+    return msg
+
+
+def encode_health(msg):
+    return json.dumps(msg, separators=(",", ":")).encode()
+
+
+def decode_health(data):
+    return json.loads(data)
+
+
+class HealthPublisher:
+    def __init__(self, collect, publish, rate_hz):
+        # collect() returns the health message, publish(data) sends the
+        # encoded bytes.
+        self.collect = collect
+        self.publish = publish
+        self.period = 1.0 / rate_hz
+        self.published = 0
+        self.bytes_sent = 0
+        self._stop = threading.Event()
+
+    def publish_once(self):
+        data = encode_health(self.collect())
+        self.publish(data)
+        self.published += 1
+        self.bytes_sent += len(data)
+        METRICS.count("telemetry.published")
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.wait(max(0.0, deadline - time.monotonic())):
+            try:
+                self.publish_once()
+            except Exception as e:
+                logging.error(f"Failed to publish health message: {e}")
+            # Keep a steady rate, but do not try to catch up after a stall.
+            deadline = max(deadline + self.period, time.monotonic())
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
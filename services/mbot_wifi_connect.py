@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# Brings up the robot's WiFi for mbot_start_networking.sh.
+#
+# The BSSID and channel of the last successful connection are cached. On
+# boot the cached access point is tried right away while a scan runs in
+# parallel, and the fallback access point profile is checked at the same
+# time. Without a cached access point, the robot switches to AP mode as
+# soon as the scan shows the home network is missing. AP mode is never
+# started while a connection attempt is still running.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import subprocess
+from concurrent.futures import Future
+
+from mbot_config import read_config
+
+NMCLI = "nmcli"
+WIFI_DEVICE = "wlan0"
+CACHE_FILE = "/var/lib/mbot/wifi_last_good.json"
+AP_CONNECTION = "mbot_wifi_ap"
+AP_ADDRESS = "192.168.3.1"
+AP_START_DELAY = 10  # Seconds NetworkManager needs between creating and starting the AP
+CONNECT_TIMEOUT = 30
+
+
+def nmcli(*args, check=True, timeout=60):
+    result = subprocess.run([NMCLI] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            text=True, timeout=timeout)
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, [NMCLI] + list(args), result.stdout, result.stderr)
+    return result
+
+
+def split_terse(line):
+    # nmcli -t separates fields with ":" and escapes ":" and "\" in values.
+    fields, field, escaped = [], "", False
+    for char in line:
+        if escaped:
+            field += char
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == ":":
+            fields.append(field)
+            field = ""
+        else:
+            field += char
+    fields.append(field)
+    return fields
+
+
+def active_wifi():
+    # Name of the active connection on the WiFi device, or None.
+    output = nmcli("-t", "-f", "NAME,DEVICE,STATE", "connection", "show", "--active").stdout
+    for line in output.splitlines():
+        fields = split_terse(line)
+        if len(fields) == 3 and fields[1] == WIFI_DEVICE and fields[2] == "activated":
+            return fields[0]
+    return None
+
+
+def scan(ssid):
+    # Access points of the network, strongest first, as (signal, channel, bssid).
+    output = nmcli("-t", "-f", "BSSID,SSID,CHAN,SIGNAL", "device", "wifi", "list", "--rescan", "yes").stdout
+    found = []
+    for line in output.splitlines():
+        fields = split_terse(line)
+        if len(fields) == 4 and fields[1] == ssid:
+            bssid, _, channel, signal = fields
+            found.append((int(signal or 0), channel, bssid))
+    return sorted(found, reverse=True)
+
+
+def connect(target, password):
+    # target is an SSID or a BSSID of the network.
+    args = ["--wait", str(CONNECT_TIMEOUT), "device", "wifi", "connect", target]
+    if password:
+        args += ["password", password]
+    try:
+        result = nmcli(*args, check=False, timeout=CONNECT_TIMEOUT + 5)
+    except subprocess.TimeoutExpired:
+        return False
+    if result.returncode != 0:
+        logging.info(f"Connecting to {target} failed: {result.stderr.strip()}")
+    return result.returncode == 0
+
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache_file, ssid, bssid, channel):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"ssid": ssid, "bssid": bssid, "channel": channel}, f)
+    os.replace(tmp_file, cache_file)
+
+
+def ap_profile():
+    # (ssid, psk) of the existing AP profile, or None.
+    result = nmcli("--show-secrets", "-g", "802-11-wireless.ssid,wifi-sec.psk", "connection", "show",
+                   AP_CONNECTION, check=False)
+    values = [line.replace("\\:", ":").replace("\\\\", "\\") for line in result.stdout.splitlines()]
+    if result.returncode != 0 or len(values) != 2:
+        return None
+    return tuple(values)
+
+
+def prepare_ap(ap_ssid, ap_password):
+    # Returns when the AP profile was created. A profile from an earlier
+    # boot with the same SSID and password is kept.
+    if ap_profile() == (ap_ssid, ap_password):
+        return 0.0
+    # Recreated in one nmcli call.
+    nmcli("connection", "delete", AP_CONNECTION, check=False)
+    nmcli("connection", "add", "type", "wifi", "ifname", "*", "con-name", AP_CONNECTION, "autoconnect", "no",
+          "ssid", ap_ssid, "802-11-wireless.mode", "ap", "802-11-wireless.band", "a", "ipv4.method", "shared",
+          "wifi-sec.key-mgmt", "wpa-psk", "wifi-sec.psk", ap_password,
+          "ipv4.addresses", f"{AP_ADDRESS}/24", "ipv4.gateway", AP_ADDRESS)
+    logging.info("Access point created successfully.")
+    return time.monotonic()
+
+
+def start_ap(created_at):
+    # The delay since the profile was created overlaps with the scan.
+    remaining = created_at + AP_START_DELAY - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+    nmcli("connection", "up", AP_CONNECTION)
+    logging.info("Access point started.")
+
+
+def in_background(func, *args):
+    # Daemon thread, so a scan still running does not hold up the exit once
+    # the robot is connected.
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def bring_up(ssid, password, ap_ssid, ap_password, cache_file=CACHE_FILE):
+    # Returns "active", "connected" or "ap".
+    name = active_wifi()
+    if name:
+        logging.info(f"Connected to active WiFi network '{name}'. Done.")
+        return "active"
+
+    ap_future = in_background(prepare_ap, ap_ssid, ap_password)
+    if not ssid:
+        logging.info("No home network configured.")
+        start_ap(ap_future.result())
+        return "ap"
+
+    logging.info(f"Looking for home network '{ssid}'")
+    scan_future = in_background(scan, ssid)
+    cache = load_cache(cache_file)
+    tried = None
+    if cache.get("ssid") == ssid and cache.get("bssid"):
+        tried = cache["bssid"]
+        logging.info(f"Trying last good BSSID {tried} on channel {cache.get('channel')}")
+        # The scan keeps running meanwhile. Even if it finishes first without
+        # the network, the attempt is waited for, AP mode would cut it off.
+        if connect(tried, password):
+            logging.info(f"Connected to '{ssid}' through {tried}.")
+            return "connected"
+
+    try:
+        found = scan_future.result()
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        # NetworkManager may refuse to scan while the cached access point
+        # is being tried. Let it pick an access point of the network itself.
+        logging.error(f"WiFi scan failed: {e}")
+        if connect(ssid, password):
+            logging.info(f"Connected to '{ssid}'.")
+            return "connected"
+        logging.info("Connection failed! Check your password!")
+        logging.info("Starting Access Point")
+        start_ap(ap_future.result())
+        return "ap"
+    for signal, channel, bssid in found:
+        logging.info(f"{bssid} {ssid} {channel} {signal}")
+
+    if not found:
+        logging.info("Home network not found.")
+    else:
+        _, channel, bssid = found[0]
+        # If the strongest access point is the one that just failed, let
+        # NetworkManager pick any access point of the network instead.
+        if connect(ssid if bssid == tried else bssid, password):
+            save_cache(cache_file, ssid, bssid, channel)
+            logging.info(f"Connected to '{ssid}' through {bssid}.")
+            return "connected"
+        logging.info("Connection failed! Check your password!")
+
+    logging.info("Starting Access Point")
+    start_ap(ap_future.result())
+    return "ap"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect to the home WiFi or start the MBot access point")
+    parser.add_argument("--config", required=True, help="path of mbot_config.txt")
+    parser.add_argument("--ap-ssid", required=True)
+    parser.add_argument("--cache", default=CACHE_FILE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
+    _, config = read_config([args.config])
+    try:
+        bring_up(config.get("new_wifi_ssid", ""), config.get("new_wifi_password", ""),
+                 args.ap_ssid, config.get("mbot_ap_password", ""), args.cache)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        logging.error(f"Network bring-up failed: {e}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())